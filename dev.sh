@@ -2,7 +2,8 @@
 
 
 # Convenience script:  Starts, stops, or restarts all fake Rhizome 
-# servers and all monitors (assuming sensor IDs are 1, 2, ..., 13).
+# servers (assuming sensor IDs are 1, 2, ..., 17) and the monitor
+# (energymon_all, which watches every sensor from one process).
 # Can also initialize the development environment (recreate the DB,
 # initialize with development-friendly data).
 # Expects the command (start, stop, restart, init) as an argument.
@@ -31,7 +32,7 @@ if [ "$1" == "init" ] ; then
         && echo_and_do "python manage.py develdb"
 else
     for i in {1..17} ; do # MAGIC NUMBER: 1..X where X is the number of sensors we have
-        echo_and_do "python manage.py energymon $i $1"
         echo_and_do "python manage.py energyfaker $i $1"
     done
+    echo_and_do "python manage.py energymon_all $1"
 fi
@@ -0,0 +1,352 @@
+'''
+    Columnar archive files of old sensor readings and power averages.
+
+    archive_readings writes one file per sensor and closed month,
+    settings.ARCHIVE_DIR/<sensor id>/<YYYY-MM>.ewa, holding two tables:
+    the month's sensor readings and the power averages whose periods
+    start in it.  Each column is stored separately and compressed with
+    zlib; times and integers are delta-encoded first (readings arrive
+    every 10 seconds, so the deltas are nearly constant and compress
+    to almost nothing).  A file is laid out as
+
+        MAGIC
+        header length (4 bytes, big-endian)
+        header (JSON: sensor, month, and for each table the number of
+                rows and the [name, kind, compressed length] of each
+                column)
+        the compressed columns, in header order
+
+    Once a month has been archived (and, with --purge, deleted from
+    the database), graph_rows() reads its power averages back, so that
+    data._build_db_results can still graph it.  The archived months are
+    listed in settings.ARCHIVE_DIR/manifest.json.
+'''
+
+import calendar, datetime, os, struct, zlib
+import simplejson
+from django.conf import settings
+from energyweb.graph.models import PowerAverage
+from energyweb.graph.rhizome import READING_FIELDS
+
+
+MAGIC = 'EWARC2\n'
+# Earlier versions still read:  EWARC1 files' averages have no
+# watt_hours column.
+OLD_MAGICS = ('EWARC1\n',)
+FILE_EXTENSION = '.ewa'
+MANIFEST_NAME = 'manifest.json'
+
+# Columns of each table: (name, kind).  'time' columns hold
+# datetimes (stored as delta-encoded microseconds), 'int' columns
+# delta-encoded integers, and 'float' columns raw doubles.
+READING_COLUMNS = (('reading_time', 'time'),) \
+                  + tuple([(f, 'int') for f in READING_FIELDS])
+AVERAGE_COLUMNS = (('average_type', 'int'), # index into AVERAGE_TYPES
+                   ('trunc_reading_time', 'time'),
+                   ('first_reading_time', 'time'),
+                   ('last_reading_time', 'time'),
+                   ('num_points', 'int'),
+                   ('watts', 'float'),
+                   ('watt_hours', 'float'))
+TABLES = (('readings', READING_COLUMNS), ('averages', AVERAGE_COLUMNS))
+
+# How many decoded files graph_rows keeps in memory.
+CACHE_SIZE = 64
+
+
+def _dt_to_us(dt):
+    # Datetimes from the database are naive local times; they are
+    # stored as if they were UTC, which round-trips exactly.
+    return (calendar.timegm(dt.timetuple()) * 1000000 + dt.microsecond)
+
+
+def _us_to_dt(us):
+    return (datetime.datetime(1970, 1, 1)
+            + datetime.timedelta(microseconds=us))
+
+
+def month_label(month):
+    return month.strftime('%Y-%m')
+
+
+def archive_path(sensor_id, month):
+    return os.path.join(settings.ARCHIVE_DIR, str(sensor_id),
+                        month_label(month) + FILE_EXTENSION)
+
+
+class ColumnEncoder(object):
+    '''
+    Compresses one column incrementally, as rows are added in chunks.
+    '''
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.previous = 0
+        self.compressor = zlib.compressobj(9)
+        self.pieces = []
+
+    def add(self, values):
+        if not values:
+            return
+        if self.kind == 'float':
+            packed = struct.pack('>%dd' % len(values), *values)
+        else:
+            if self.kind == 'time':
+                values = [_dt_to_us(v) for v in values]
+            deltas = []
+            previous = self.previous
+            for v in values:
+                deltas.append(v - previous)
+                previous = v
+            self.previous = previous
+            packed = struct.pack('>%dq' % len(deltas), *deltas)
+        self.pieces.append(self.compressor.compress(packed))
+
+    def finish(self):
+        self.pieces.append(self.compressor.flush())
+        return ''.join(self.pieces)
+
+
+def decode_column(kind, data, rows):
+    '''
+    Return the list of values of a column, given its kind, compressed
+    data, and number of rows.
+    '''
+    raw = zlib.decompress(data)
+    if kind == 'float':
+        return list(struct.unpack('>%dd' % rows, raw))
+    values = []
+    v = 0
+    for delta in struct.unpack('>%dq' % rows, raw):
+        v += delta
+        values.append(v)
+    if kind == 'time':
+        values = [_us_to_dt(v) for v in values]
+    return values
+
+
+class ArchiveWriter(object):
+    '''
+    Writes the archive file of one sensor and month.  Rows are added
+    with add_readings() and add_averages() (in time order, in as many
+    chunks as is convenient), and the file is written by close().
+    '''
+
+    def __init__(self, sensor_id, month):
+        self.sensor_id = sensor_id
+        self.month = month
+        self.rows = {}
+        self.encoders = {}
+        for table, columns in TABLES:
+            self.rows[table] = 0
+            self.encoders[table] = [ColumnEncoder(kind)
+                                    for name, kind in columns]
+
+    def _add(self, table, rows):
+        self.rows[table] += len(rows)
+        for i, encoder in enumerate(self.encoders[table]):
+            encoder.add([r[i] for r in rows])
+
+    def add_readings(self, rows):
+        '''
+        Add sensor readings, as tuples of READING_COLUMNS values.
+        '''
+        self._add('readings', rows)
+
+    def add_averages(self, rows):
+        '''
+        Add power averages, as tuples of AVERAGE_COLUMNS values
+        (average_type as a name).
+        '''
+        self._add('averages',
+                  [(PowerAverage.AVERAGE_TYPES.index(r[0]),) + tuple(r[1:])
+                   for r in rows])
+
+    def close(self):
+        '''
+        Write the file (atomically, so a reader never sees part of
+        one) and return its size in bytes.
+        '''
+        header = {'sensor': self.sensor_id,
+                  'month': month_label(self.month),
+                  'tables': {}}
+        blobs = []
+        for table, columns in TABLES:
+            column_headers = []
+            for (name, kind), encoder in zip(columns, self.encoders[table]):
+                blob = encoder.finish()
+                column_headers.append([name, kind, len(blob)])
+                blobs.append(blob)
+            header['tables'][table] = {'rows': self.rows[table],
+                                       'columns': column_headers}
+        header_data = simplejson.dumps(header)
+
+        path = archive_path(self.sensor_id, self.month)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(path + '.tmp', 'wb')
+        try:
+            f.write(MAGIC)
+            f.write(struct.pack('>I', len(header_data)))
+            f.write(header_data)
+            for blob in blobs:
+                f.write(blob)
+        finally:
+            f.close()
+        os.rename(path + '.tmp', path)
+        return os.path.getsize(path)
+
+
+def read_archive(path, tables=None):
+    '''
+    Read an archive file.  Return (header, data), where data maps each
+    table (of those named in tables, default all) to a dictionary of
+    column name to list of values.
+    '''
+    f = open(path, 'rb')
+    try:
+        contents = f.read()
+    finally:
+        f.close()
+    for magic in (MAGIC,) + OLD_MAGICS:
+        if contents.startswith(magic):
+            break
+    else:
+        raise ValueError('%s is not an archive file.' % path)
+    offset = len(magic)
+    (header_length,) = struct.unpack_from('>I', contents, offset)
+    offset += 4
+    header = simplejson.loads(contents[offset:offset + header_length])
+    offset += header_length
+
+    data = {}
+    for table, columns in TABLES:
+        table_header = header['tables'][table]
+        wanted = tables is None or table in tables
+        if wanted:
+            data[table] = {}
+        for name, kind, length in table_header['columns']:
+            if wanted:
+                data[table][name] = decode_column(
+                    kind, contents[offset:offset + length],
+                    table_header['rows'])
+            offset += length
+    return (header, data)
+
+
+##############################
+# The manifest of archived months
+##############################
+
+def load_manifest():
+    '''
+    Return the manifest:  a dictionary mapping each sensor id (as a
+    string) to a dictionary mapping each archived month ('YYYY-MM') to
+    {'readings': rows, 'averages': rows, 'bytes': file size,
+    'purged': whether the rows were deleted from the database}.
+    '''
+    path = os.path.join(settings.ARCHIVE_DIR, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    f = open(path)
+    try:
+        return simplejson.load(f)
+    finally:
+        f.close()
+
+
+def save_manifest(manifest):
+    path = os.path.join(settings.ARCHIVE_DIR, MANIFEST_NAME)
+    if not os.path.isdir(settings.ARCHIVE_DIR):
+        os.makedirs(settings.ARCHIVE_DIR)
+    f = open(path + '.tmp', 'w')
+    try:
+        simplejson.dump(manifest, f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+    os.rename(path + '.tmp', path)
+
+
+##############################
+# Reading archived averages for graphs
+##############################
+
+_manifest_cache = [None, None] # [mtime, manifest]
+_average_cache = {}
+
+
+def _purged_months():
+    '''
+    Return {sensor id: set of purged months (as datetimes)}, reloading
+    the manifest only when it has changed.
+    '''
+    path = os.path.join(settings.ARCHIVE_DIR, MANIFEST_NAME)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return {}
+    if _manifest_cache[0] != mtime:
+        purged = {}
+        for sensor_id, months in load_manifest().iteritems():
+            purged[int(sensor_id)] = set(
+                [datetime.datetime.strptime(m, '%Y-%m')
+                 for m, info in months.iteritems() if info['purged']])
+        _manifest_cache[0] = mtime
+        _manifest_cache[1] = purged
+    return _manifest_cache[1]
+
+
+def _archived_averages(sensor_id, month):
+    path = archive_path(sensor_id, month)
+    mtime = os.path.getmtime(path)
+    key = (sensor_id, month)
+    if key in _average_cache and _average_cache[key][0] == mtime:
+        return _average_cache[key][1]
+    if len(_average_cache) >= CACHE_SIZE:
+        _average_cache.clear()
+    averages = read_archive(path, ('averages',))[1]['averages']
+    _average_cache[key] = (mtime, averages)
+    return averages
+
+
+def has_purged(start_dt):
+    '''
+    Return whether any month that was purged from the database ends
+    after datetime start_dt (i.e. whether a query starting at start_dt
+    needs the archive).
+    '''
+    for months in _purged_months().itervalues():
+        for month in months:
+            if _next_month(month) > start_dt:
+                return True
+    return False
+
+
+def _next_month(month):
+    if month.month == 12:
+        return datetime.datetime(month.year + 1, 1, 1)
+    return datetime.datetime(month.year, month.month + 1, 1)
+
+
+def graph_rows(res, start_dt, end_dt=None):
+    '''
+    Return the rows PowerAverage.graph_data_execute would have
+    selected from the purged months:  (kilowatts, sensor id, truncated
+    reading time) for each power average of type res between start_dt
+    and end_dt (inclusive).  The rows are not in any particular order.
+    '''
+    average_type = PowerAverage.AVERAGE_TYPES.index(res)
+    rows = []
+    for sensor_id, months in _purged_months().iteritems():
+        for month in months:
+            if _next_month(month) <= start_dt \
+                    or (end_dt is not None and month > end_dt):
+                continue
+            averages = _archived_averages(sensor_id, month)
+            for t, trunc, watts in zip(averages['average_type'],
+                                       averages['trunc_reading_time'],
+                                       averages['watts']):
+                if t == average_type and trunc >= start_dt \
+                        and (end_dt is None or trunc <= end_dt):
+                    rows.append((watts / 1000, sensor_id, trunc))
+    return rows
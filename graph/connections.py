@@ -0,0 +1,27 @@
+'''
+    Database connections of our own, for work that cannot use
+    Django's:  Django's connection is per thread, takes part in the
+    request's transaction, and is closed when the request finishes,
+    which for a streamed response is before the response is sent.
+'''
+
+import psycopg2, psycopg2.extensions
+from django.conf import settings
+
+
+def connect(autocommit=False):
+    '''
+    Open a new psycopg2 connection to the default database.  The
+    caller must close it.
+    '''
+    db = settings.DATABASES['default']
+    kwargs = {'database': db['NAME']}
+    for key, name in (('USER', 'user'), ('PASSWORD', 'password'),
+                      ('HOST', 'host'), ('PORT', 'port')):
+        if db.get(key):
+            kwargs[name] = db[key]
+    conn = psycopg2.connect(**kwargs)
+    if autocommit:
+        conn.set_isolation_level(
+            psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    return conn
@@ -0,0 +1,145 @@
+'''
+    The control channel of the energy monitors:  how to tell a running
+    energymon or energymon_all to stop, reload its settings, or
+    resynchronize with its devices, without it having to poll the
+    database for requests.
+
+    A request is recorded in the Signal table (name 'mon_stop' or
+    'mon_resync', data the daemon it is for:  a sensor id, or 'all'
+    for energymon_all) and announced with a NOTIFY on CHANNEL, in the
+    same transaction.  Each daemon keeps a ControlChannel LISTENing,
+    and selects on it alongside its device sockets; only when it is
+    notified does it reload its settings and take its pending
+    requests.  Saving a Setting also notifies (see Setting.save()), so
+    the daemons pick up changes at once.  Requests made while a daemon
+    is not listening wait in the table until it next checks.
+
+    The notification carries no payload (PostgreSQL 8.4 cannot send
+    one), which is why the requests themselves go through the table.
+'''
+
+import time, logging
+import psycopg2
+from django.conf import settings
+from django.db import connection, transaction
+from energyweb.graph.models import Signal
+from energyweb.graph import connections
+
+
+CHANNEL = 'energyweb_control'
+
+# Requests that go through the Signal table.  ('reload' does not:
+# every notification reloads the settings.)
+QUEUED_COMMANDS = ('stop', 'resync')
+COMMANDS = ('stop', 'reload', 'resync')
+
+
+def notify(cur):
+    '''
+    Wake the listening daemons.  As with any NOTIFY, this is only
+    delivered if and when the current transaction commits.
+    '''
+    cur.execute('NOTIFY ' + CHANNEL + ';')
+
+
+def send(command, target='all'):
+    '''
+    Ask the daemon target (a sensor id as a string, or 'all') to carry
+    out command, one of COMMANDS.
+    '''
+    if command not in COMMANDS:
+        raise ValueError('Invalid command: \'%s\'.' % command)
+    if command in QUEUED_COMMANDS:
+        Signal.enqueue('mon_' + command, target)
+    notify(connection.cursor())
+    transaction.commit_unless_managed()
+
+
+def connect_listener(channel):
+    '''
+    Open a new autocommit connection (see connections.py) and LISTEN
+    on channel.
+    '''
+    conn = connections.connect(autocommit=True)
+    conn.cursor().execute('LISTEN ' + channel + ';')
+    return conn
+
+
+def collect_notifies(conn):
+    '''
+    Read what has arrived on a listening connection (which select()
+    found readable) and return how many notifications there were.
+    '''
+    if hasattr(conn, 'poll'):
+        conn.poll()
+    else:
+        # (Older psycopg2 only collects notifications when a
+        # statement is executed.)
+        conn.cursor().execute('SELECT 1;')
+    n = len(conn.notifies)
+    del conn.notifies[:]
+    return n
+
+
+class ControlChannel(object):
+    '''
+    A daemon's end of the control channel.  Include it in select()
+    while is_open(), and call receive() when it is readable, and
+    whenever retry_at has passed while it is closed.
+
+    target: the Signal data of requests for this daemon.
+    '''
+
+    def __init__(self, target):
+        self.target = target
+        self.conn = None
+        # time.time() after which another connection attempt is made.
+        self.retry_at = 0
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def is_open(self):
+        return self.conn is not None
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except psycopg2.Error:
+                pass
+        self.conn = None
+
+    def receive(self):
+        '''
+        Return the commands (in COMMANDS) sent since the last call, or
+        [] if there were none.  After (re)connecting, always reloads
+        and checks for requests, since notifications sent while the
+        channel was closed are lost.  Uses (without committing) the
+        Django connection to read the Signal table.
+        '''
+        try:
+            if self.conn is None:
+                if time.time() < self.retry_at:
+                    return []
+                self.conn = connect_listener(CHANNEL)
+                logging.info('Listening for control requests.')
+            elif not collect_notifies(self.conn):
+                return []
+        except psycopg2.Error, detail:
+            logging.error('Control channel: %s  Reconnecting in %d s.'
+                          % (str(detail).strip(), settings.ERROR_PAUSE))
+            self.close()
+            self.retry_at = time.time() + settings.ERROR_PAUSE
+            return []
+
+        commands = ['reload']
+        for command in QUEUED_COMMANDS:
+            if Signal.dequeue('mon_' + command, data=self.target) is not None:
+                # (Repeats of a request mean nothing more.)
+                while Signal.dequeue('mon_' + command,
+                                     data=self.target) is not None:
+                    pass
+                commands.append(command)
+        return commands
+
@@ -16,9 +16,11 @@ from django import forms
 from django.db.models import Avg, Max, Min, Count
 
 from energyweb.graph.models import SensorGroup, SensorReading, Sensor, \
-                                   PowerAverage, SRProfile, LogMessage, \
-                                   viewCount
-import calendar, datetime, simplejson, time, os, subprocess
+                                   PowerAverage, SensorGroupAverage, \
+                                   SRProfile, LogMessage, viewCount
+from energyweb.graph import archive, connections, downsample, energy, \
+                            pivot
+import calendar, datetime, simplejson, time, os, subprocess, zlib
 
 from constants import *
 
@@ -145,25 +147,52 @@ class StaticGraphForm(CustomGraphForm):
     '''
     Used to limit data queries for the Public Custom Graph.
     '''
-    GRAPH_MAX_POINTS = 2000
 
     def clean(self):
         '''
         Ensure the data is sane.
         This version also checks that ordinary users are not asking
         for too much data, because it might kill the server.
-        Really only an issue for users who specified resolutions.
+        Since the graph is downsampled to GRAPH_MAX_POINTS points
+        (see _make_column_dump), auto picks the finest resolution
+        with no more than GRAPH_SOURCE_POINTS periods, rather than one
+        with only as many periods as the graph has points; a
+        resolution the user specified may have as many.
         '''
         cleaned_data = CustomGraphForm.clean(self)
 
-        if _graph_max_points(cleaned_data['start'], 
-                             cleaned_data['end'], 
-                             cleaned_data['computed_res']) \
-                             > self.GRAPH_MAX_POINTS:
+        if cleaned_data['res'] not in self.RES_LIST:
+            # RES_LIST goes from coarsest to finest.
+            cleaned_data['computed_res'] = self.RES_LIST[0]
+            for res in reversed(self.RES_LIST):
+                if _graph_max_points(cleaned_data['start'],
+                                     cleaned_data['end'], res) \
+                                     <= settings.GRAPH_SOURCE_POINTS:
+                    cleaned_data['computed_res'] = res
+                    break
+        elif _graph_max_points(cleaned_data['start'], 
+                               cleaned_data['end'], 
+                               cleaned_data['computed_res']) \
+                               > settings.GRAPH_SOURCE_POINTS:
             raise forms.ValidationError('Too many points in graph '
                                         '(resolution too fine).')
         return cleaned_data                
 
+class DataAccessForm(CustomGraphForm):
+    '''
+    The form of the data access page, which can also export the raw
+    readings of chosen sensors.
+    '''
+    sensors = forms.MultipleChoiceField(
+        required=False, widget=forms.CheckboxSelectMultiple,
+        help_text='For the raw readings; all if none are chosen.')
+
+    def __init__(self, *args, **kwargs):
+        CustomGraphForm.__init__(self, *args, **kwargs)
+        self.fields['sensors'].choices = [
+            (str(s.pk), ('%s %s' % (s.sensor_group.name, s.name)).strip())
+            for s in Sensor.objects.select_related().order_by('pk')]
+
 ##############################
 # Average Collecting
 ##############################
@@ -197,83 +226,21 @@ def _get_averages():
     Obtains minute, week, and month averages over those
     last cycles for certain sensors.
     sensor_ids must be a list of sensors.
+    The week and month averages (since Monday and since the first)
+    come from the running energy totals (see energy.py), so take the
+    same time however far into the week or month it is.
     '''
-    res_choices = ['minute','week','month']
-    all_averages = dict([[res,{}] for res in res_choices])
+    now = datetime.datetime.utcnow()
+    all_averages = {'minute': _query_averages('minute', now)}
 
-    for average_type in res_choices:
+    for average_type in ('week', 'month'):
+        averages = energy.average_by_sensor(
+            SENSOR_IDS, PowerAverage.date_trunc(average_type, now), now)
         all_averages[average_type] = \
-                _query_averages(average_type,datetime.datetime.utcnow())
-
-    return all_averages
-
-def _get_detail_averages(res):
-    '''
-    Gets the averages for detail graphs.
-    Gets it both for cycle and diagnostic modes.
-    '''
-    all_averages = dict([[sid,{}] for sid in SENSOR_IDS])
-    # Use start_offsets to mark each cycle
-    for start_offset in range(len(CYCLE_START_DIFFS[res])):
-        results = _query_averages(res, datetime.datetime.utcnow()
-                                  - CYCLE_START_DIFFS[res][start_offset]
-                                  * RESOLUTION_DELTAS[res])
-        for sid,value in results.iteritems():
-            all_averages[sid][start_offset] = value
+            dict([[sid, value or 0] for sid, value in averages.iteritems()])
 
     return all_averages
 
-###############
-# Integrate
-###############
-
-def _integrate(start_dt,end_dt,res,splitSensors=True):
-    '''
-    Reports the integrated power usage from start to stop via Riemann sum.
-    Returns in kilowatt*hr
-    Uses data points of res resolution for the integration.
-    '''
-    corrections = {
-        'minute*10':1/6.0,#6 of these per hour
-        'hour':1,
-        'day':24,}
-    
-    if splitSensors:
-        watt_totals = dict([ [sid,0] for sid in SENSOR_IDS])
-        # These functions ensure we store by sensor, not by building
-        def _acc_call(sg,x,y,rtn_obj):
-            pass
-        def _snr_call(sid,x,y,rtn_obj):
-            try:
-                rtn_obj[sid] += y
-            except:
-                rtn_obj[sid] += 0
-    else:
-        watt_totals = dict([ [sg[0], 0] for sg in SENSOR_GROUPS])
-        # These functions store by building, not by sensor.
-        def _acc_call(sg,x,y,rtn_obj):
-            try:
-                rtn_obj[sg] += y
-            except:
-                pass
-        def _snr_call(sid,x,y,rtn_obj):
-            pass
-
-    _build_db_results(res,start_dt,end_dt,
-                      watt_totals,
-                      lambda a,b : None, # Don't care about having a timestamp
-                      _acc_call,
-                      _snr_call)
-    if not watt_totals:
-        return None
-
-    # Corrections will change it such that we are in kw*hr
-    # no matter what integrating interval.
-    for reading in watt_totals.iterkeys():
-        watt_totals[reading] = watt_totals[reading]*corrections[res]
-
-    return watt_totals
-    
 ##############################
 # Converting data to a serializable form
 ##############################
@@ -301,7 +268,7 @@ def _make_data_dump(start, end=None, res='second*10'):
 
     sg_xy_pairs = dict([[sg[0], []] for sg in SENSOR_GROUPS])
         
-    _build_db_results(res,start_dt,end_dt,
+    _build_group_results(res,start_dt,end_dt,
                       sg_xy_pairs,
                       lambda x,rtn_obj : int(calendar.timegm(x))*1000, # ms for graph
                       # entries by building
@@ -327,6 +294,79 @@ def _make_data_dump(start, end=None, res='second*10'):
 
     return d
 
+def _make_column_dump(start, end, res):
+    '''
+    Like _make_data_dump, but in the more compact form the static
+    graph asks for (format=columns):  as the periods of a graph are
+    evenly spaced, instead of sg_xy_pairs it has
+       point_start, point_interval:
+           The time of the first point and between points (ms)
+       sg_values:
+           The y value of each point for each building (None where
+           missing), rounded to GRAPH_DECIMALS places
+    which Highcharts takes as they are (as pointStart, pointInterval
+    and data).  The timestamps are therefore sent once rather than
+    once per building, and the values are not padded with digits no
+    graph shows.
+    If there are more than GRAPH_MAX_POINTS periods, each building's
+    line is instead downsampled to about that many points (see
+    downsample.py), which are no longer evenly spaced, so it has
+    sg_xy_pairs as _make_data_dump does (and downsampled is True).
+    '''
+    start_dt = datetime.datetime.utcfromtimestamp(int(start))
+    end_dt = datetime.datetime.utcfromtimestamp(int(end))
+
+    p = _group_pivot(res, start_dt, end_dt)
+    if p is None:
+        return {'no_results': True,
+                'sensor_groups': SENSOR_GROUPS}
+    if len(p) > settings.GRAPH_MAX_POINTS:
+        d = _pivot_downsampled(p, settings.GRAPH_MAX_POINTS)
+    else:
+        d = _pivot_columns(p)
+    return dict(d, no_results=False,
+                sensor_groups=SENSOR_GROUPS,
+                desired_first_record=int(start)*1000)
+
+def _pivot_columns(p):
+    '''
+    Return the point_start, point_interval and sg_values of
+    _make_column_dump for a Pivot with one column per building.
+    '''
+    point_start = int(calendar.timegm(p.periods[0].timetuple()))*1000
+    if len(p) > 1:
+        point_interval = \
+            int(calendar.timegm(p.periods[1].timetuple()))*1000 - point_start
+    else:
+        point_interval = 0
+    values = p.values.round(settings.GRAPH_DECIMALS).tolist()
+    sg_values = {}
+    for i, (sg_id, sensor_ids) in enumerate(p.layout):
+        column = []
+        for row in values:
+            y = row[i]
+            if y != y: # NaN: missing
+                y = None
+            column.append(y)
+        sg_values[sg_id] = column
+    return {'point_start': point_start,
+            'point_interval': point_interval,
+            'sg_values': sg_values}
+
+def _pivot_downsampled(p, threshold):
+    '''
+    Return the sg_xy_pairs and downsampled of _make_column_dump for a
+    Pivot with one column per building, of about threshold points per
+    building.
+    '''
+    x = p.timestamps_ms()
+    values = p.values.round(settings.GRAPH_DECIMALS)
+    sg_xy_pairs = {}
+    for i, (sg_id, sensor_ids) in enumerate(p.layout):
+        sg_xy_pairs[sg_id] = downsample.downsample(x, values[:, i], threshold)
+    return {'sg_xy_pairs': sg_xy_pairs,
+            'downsampled': True}
+
 def download_csv(request, start, end, res):
     '''
     A view returning the CSV data points of the static graph.
@@ -336,38 +376,102 @@ def download_csv(request, start, end, res):
     use a significantly different structuring than the list of points.
     Thus while the algorithm is effectively the same,
     how it stores data differs.
+    The file is streamed as it is generated, a chunk of periods at a
+    time (see _csv_chunks), so a long range takes no more memory than
+    a short one; it is gzipped if the browser accepts that.
     '''
-    # Start writing the csv output
-    data = ''
-    
     start_dt = datetime.datetime.utcfromtimestamp(int(start))
     end_dt = datetime.datetime.utcfromtimestamp(int(end))
 
-    # Write down the column headings
-    data += ',Time,'
-    for building in SENSOR_GROUPS:
-        data += building[1] + ','
+    chunks = _csv_chunks(res, start_dt, end_dt)
+    gzipped = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+    if gzipped:
+        chunks = _gzip_chunks(chunks)
+
+    # Send the csv to be posted
+    response = HttpResponse(chunks, mimetype='application/csv')
+    if gzipped:
+        response['Content-Encoding'] = 'gzip'
+    return response
 
-    data_pnts = []
+def _csv_chunks(res, start_dt, end_dt):
+    '''
+    Generate the CSV of download_csv in pieces: the column headings,
+    then the lines of CSV_CHUNK_SIZE rows at a time.
+    '''
+    # Write down the column headings
+    yield ',Time,' + ''.join([building[1] + ',' for building in SENSOR_GROUPS])
 
     def _x_handler(x,rtn_obj):
         ''' Start a new line, then return x back as readable time'''
         rtn_obj.append('\n')
         rtn_obj.append(time.strftime("%a %d %b %Y %H:%M:%S",x))
         return x
-        
-    _build_db_results(res,start_dt,end_dt,
-                      data_pnts,
-                      _x_handler,
-                      lambda id,x,y,rtn_obj : rtn_obj.append(str(y))
-                      )
-    # Comma Separated Value files obviously use commas as delimiters
-    template = ","
-    data += template.join(data_pnts)
 
-    # Send the csv to be posted
-    return HttpResponse(data,
-                        mimetype='application/csv')
+    per_incr = RESOLUTION_DELTAS[res]
+    layout = _pivot_layout()
+    first = None
+    for rows in _iter_graph_rows(res, start_dt, end_dt):
+        p = pivot.build_pivot(rows, per_incr, layout, first)
+        if p is None:
+            continue
+        data_pnts = []
+        _apply_callbacks(p, data_pnts, _x_handler,
+                         lambda id,x,y,rtn_obj : rtn_obj.append(str(y)))
+        # Comma Separated Value files obviously use commas as
+        # delimiters (between chunks, too).
+        if first is None:
+            yield ','.join(data_pnts)
+        else:
+            yield ',' + ','.join(data_pnts)
+        first = p.periods[-1] + per_incr
+
+def _iter_graph_rows(res, start_dt, end_dt):
+    '''
+    Generate the rows of _graph_rows in lists of about CSV_CHUNK_SIZE,
+    each ending with the last row of a period.  They are read with a
+    server-side cursor on a connection of their own (see
+    connections.py), so never all held at once; except that if the
+    range includes purged months, which are merged from the archive,
+    _graph_rows is used as is.
+    '''
+    if archive.has_purged(start_dt):
+        rows = _graph_rows(res, start_dt, end_dt)
+        yield rows
+        return
+
+    conn = connections.connect()
+    try:
+        cur = conn.cursor('download_csv')
+        PowerAverage.graph_data_execute(cur, res, start_dt, end_dt)
+        chunk = []
+        while True:
+            rows = cur.fetchmany(settings.CSV_CHUNK_SIZE)
+            for r in rows:
+                # Only end a chunk where a new period starts.
+                if len(chunk) >= settings.CSV_CHUNK_SIZE \
+                        and r[2] != chunk[-1][2]:
+                    yield chunk
+                    chunk = []
+                chunk.append(r)
+            if not rows:
+                break
+        if chunk:
+            yield chunk
+        cur.close()
+    finally:
+        conn.close()
+
+def _gzip_chunks(chunks):
+    '''
+    Gzip a sequence of strings, generating the compressed pieces.
+    '''
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
 
 def _get_detail_data(building, resolution, start_time):
     '''
@@ -443,7 +547,8 @@ def _get_detail_data(building, resolution, start_time):
         _build_db_results(AUTO_RES_CONVERT[resolution],
                           start_dt, start_dt+RESOLUTION_DELTAS[resolution],
                           xy_pairs,
-                          _x_call,_acc_call,_snr_call)
+                          _x_call,_acc_call,_snr_call,
+                          sensor_group_ids=[cur_building[0]])
 
         if len(xy_pairs['total']) > 0:
             returnDictionary['graph_data'].append(xy_pairs)
@@ -467,6 +572,21 @@ def _get_detail_data(building, resolution, start_time):
 
     return returnDictionary
 
+def _get_detail_statistics(sensor_ids, ranges):
+    '''
+    Return {key: {sensor id: (latest, sum, energy)}} for the
+    given sensors and ranges, as selected (in one query) by
+    PowerAverage.range_statistics_execute.
+    '''
+    from django.db import connection, transaction
+
+    cur = connection.cursor()
+    PowerAverage.range_statistics_execute(cur, sensor_ids, ranges)
+    stats = dict([[r[0], {}] for r in ranges])
+    for key, sid, latest, total, kwh in cur.fetchall():
+        stats[key][sid] = (latest, total, kwh)
+    return stats
+
 def _get_detail_table(building, resolution, start_time):
     '''
     Returns two data tables.
@@ -474,104 +594,72 @@ def _get_detail_table(building, resolution, start_time):
         Cycle Name | Avg This Cycle | Integrated Value
     Diagnostic Table:
         Sensor ID | Avg. This Minute | Avg. This Interval | Integrated Value
+    Every value comes from a single query (see
+    _get_detail_statistics):  the averages are the latest of their
+    cycle, as _query_averages gives, and the integrated values (in
+    kilowatt*hr) come from the energy stored with the power averages
+    (see energy.py).
     '''
     # Get which building's data we need from the database
     cur_building = None
     for sg in SENSOR_GROUPS:
         if sg[1].lower() == str(building): # check if identical names
             cur_building = sg
+    sensor_ids = SENSOR_IDS_BY_GROUP[cur_building[0]]
             
     dataDictionary = {'graph_data':[],
                       'building': building.capitalize(),
                       'res': resolution,
                       }
-    
-    dataDictionary['cycleTable'] = {}
-    dataDictionary['diagnosticTable'] = {}
 
-    for sid in SENSOR_IDS_BY_GROUP[cur_building[0]]:
+    # The ranges to query:  the last minute, then for each cycle the
+    # cycle to average over and the one to integrate over.
+    now = datetime.datetime.utcnow()
+    per_incr = RESOLUTION_DELTAS[resolution]
+    ranges = [('now', 'minute', now - RESOLUTION_DELTAS['minute'], now)]
+    for cid in range(len(CYCLE_START_DELTAS[resolution])):
+        end_dt = now - CYCLE_START_DIFFS[resolution][cid] * per_incr
+        ranges.append(('avg%d' % cid, resolution, end_dt - per_incr, end_dt))
+        start_dt = datetime.datetime.utcfromtimestamp(
+            int(start_time) / 1000 -
+            _dt_to_sec(CYCLE_START_DELTAS[resolution][cid]) )
+        # The energy of the cycle, as energy.energy_between gives it.
+        for average_type, cover_start, cover_end in \
+                energy.cover(start_dt, start_dt + per_incr):
+            ranges.append(('integrated%d' % cid, average_type,
+                           cover_start, cover_end))
+    stats = _get_detail_statistics(sensor_ids, ranges)
+
+    def _stat(key, sid, i):
+        ''' Return a statistic (as for stats), 0 if missing '''
+        value = stats[key].get(sid, (None, None, None))[i]
+        if value is None:
+            return 0
+        return value
+
+    dataDictionary['diagnosticTable'] = {}
+    for sid in sensor_ids:
         dataDictionary['diagnosticTable'][str(sid)] = {
-            'now': 0,
-            'interval':0,
-            'integrated':0,
+            'now': _stat('now', sid, 0),
+            'interval': _stat('avg0', sid, 0),
+            'integrated': _stat('integrated0', sid, 2),
             }
     # Python doesn't shuffle order of lists...
     dataDictionary['diagnosticRow'] = ['now','interval','integrated']
 
-    for cycle_id in range(len(CYCLE_START_DELTAS[resolution])):
-        dataDictionary['cycleTable'][str(cycle_id)] = \
-            dict([['avg',0],['integrated',0]])
-
-    # Input all of the "Now" averages for Diagnostic
-    cur_cycles = _get_detail_averages('minute')
-    for sid in SENSOR_IDS_BY_GROUP[cur_building[0]]:
-        dataDictionary['diagnosticTable'][str(sid)]['now'] = \
-            cur_cycles[sid][0]
-
-    # Input all of the "This Interval" for diagostic table.
-    average_cycles = _get_detail_averages(resolution)
-    for sid in SENSOR_IDS_BY_GROUP[cur_building[0]]:
-        dataDictionary['diagnosticTable'][str(sid)]['interval'] = \
-            average_cycles[sid][0]
-
-    dataDictionary['debugFull'] = average_cycles
-    # Input Cycle Table's Values
-    for cycle_id in dataDictionary['cycleTable'].iterkeys():
-        cid = int(cycle_id)
-
-        start_dt = datetime.datetime.utcfromtimestamp(
-            int(start_time) / 1000 -
-            _dt_to_sec(CYCLE_START_DELTAS[resolution][cid]) )
-
-        # Integrate gives information back by building.
-        integValues = _integrate(start_dt,
-                                 start_dt+RESOLUTION_DELTAS[resolution],
-                                 AUTO_RES_CONVERT[resolution],
-                                 False)
-        try:
-            dataDictionary['cycleTable'][cycle_id]['integrated'] = \
-                integValues[cur_building[0]]
-        except:
-            dataDictionary['cycleTable'][cycle_id]['integrated'] = 0
-        # The Average getter gets by sensor group. Thus need to sum.
-        for sid in SENSOR_IDS_BY_GROUP[cur_building[0]]:
-            dataDictionary['cycleTable'][cycle_id]['avg'] += \
-                average_cycles[sid][int(cycle_id)]
-        
+    dataDictionary['cycleTable'] = {}
+    for cid in range(len(CYCLE_START_DELTAS[resolution])):
+        # The building's values are the sums of its sensors'.
+        dataDictionary['cycleTable'][str(cid)] = {
+            'avg': sum([_stat('avg%d' % cid, sid, 0)
+                        for sid in sensor_ids]),
+            'integrated': sum([_stat('integrated%d' % cid, sid, 2)
+                               for sid in sensor_ids]),
+            }
     # Python doesn't shuffle order of lists...
     dataDictionary['cycleRow'] = ['avg',
                                   'integrated']
 
-    CONVERT = {'minute': 'now', resolution:'interval'}
-
-    ####
-    # get averages for the diagnostic table
-    all_averages = {}
-
-    for average_type in ('minute',resolution):
-
-        results = _query_averages(average_type,datetime.datetime.utcnow())
-
-        for sid,value in results.iteritems():
-            if sid in dataDictionary['diagnosticTable']:
-                dataDictionary['diagnosticTable']\
-                                [sid][CONVERT[average_type]] \
-                                = value
-
-    start_dt = datetime.datetime.utcfromtimestamp(
-        int(start_time) / 1000 -
-        _dt_to_sec( CYCLE_START_DELTAS[resolution][0]) )
-    
-    # Get integrated values for diagnostic mode -- by sensor.
-    all_watthr_data = _integrate(start_dt,
-                                 start_dt + \
-                                     RESOLUTION_DELTAS[resolution],
-                                 AUTO_RES_CONVERT[resolution],
-                                 True)
-    for ID in dataDictionary['diagnosticTable'].iterkeys():
-        dataDictionary['diagnosticTable'][ID]['integrated'] = \
-            all_watthr_data[int(ID)]
-    
     return dataDictionary
 
 ##############################
@@ -588,16 +676,17 @@ def getLastStatus():
             loc = str(s[1])
             logmessage = LogMessage.objects.filter(sensor=ind_sensors[0],
                                                    sensor_type="M",
-                                                   log_type="S").order_by("-reading_time")[0]
+                                                   log_type="S").order_by("-last_time")[0]
             topic = str(logmessage.topic)
-            topic_time = logmessage.reading_time
+            topic_time = logmessage.last_time
             returnList += [[ind_sensors[0], loc, topic, topic_time]]
     return returnList
 
 def grabLogs(sens_type, level, id_num):
     '''
     Returns the last ten logs in a list with elements:
-    [time, level, topic, details]
+    [time, level, topic, details, count, last time]
+    (count being how many times the message repeated; see logsink.py)
     with inputs:
     sensor_type = 'M': monitor
                   'F': faker
@@ -610,12 +699,13 @@ def grabLogs(sens_type, level, id_num):
     returnList = []
     logmessage = 1
     if (level == 'A'):
-        logmessage = LogMessage.objects.filter(sensor=id_num, sensor_type=sens_type).order_by("-reading_time")[:10]
+        logmessage = LogMessage.objects.filter(sensor=id_num, sensor_type=sens_type).order_by("-last_time")[:10]
     else:
         logmessage = LogMessage.objects.filter(sensor=id_num, sensor_type=sens_type,
                                                log_type=level).order_by("reading_time")[:10]
     for lm in logmessage:
-        returnList += [[lm.reading_time, str(lm.log_type), str(lm.topic), str(lm.details)]]
+        returnList += [[lm.reading_time, str(lm.log_type), str(lm.topic), str(lm.details),
+                        lm.count, lm.last_time]]
     return returnList
 
 ################
@@ -749,8 +839,74 @@ def _get_sensor_groups():
     return (sensor_groups, sensor_ids, sensor_ids_by_group,\
                 (academic_sensorgroups,residential_sensorgroups))
 
+def _graph_rows(res, start_dt, end_dt, sensor_group_ids=None,
+                sensor_ids=None):
+    '''
+    Return the rows of PowerAverage.graph_data_execute for these
+    arguments, as a list.  Months that were archived and purged from
+    the database (see archive.py) are read from the archive instead.
+    '''
+    from django.db import connection, transaction
+
+    cur = connection.cursor()
+    PowerAverage.graph_data_execute(cur, res, start_dt, end_dt,
+                                    sensor_group_ids, sensor_ids)
+    if not archive.has_purged(start_dt):
+        return cur.fetchall()
+
+    group_of = {}
+    for sg_id, sids in SENSOR_IDS_BY_GROUP.iteritems():
+        for sid in sids:
+            group_of[sid] = sg_id
+    rows = [r for r in archive.graph_rows(res, start_dt, end_dt)
+            if (sensor_group_ids is None
+                or group_of.get(r[1]) in sensor_group_ids)
+            and (sensor_ids is None or r[1] in sensor_ids)]
+    rows += list(cur.fetchall())
+    rows.sort(key=lambda r: (r[2], group_of.get(r[1]), r[1]))
+    return rows
+
+def _pivot_layout(sensor_group_ids=None, sensor_ids=None):
+    '''
+    The column layout of the graph pivots (see pivot.py): each sensor
+    group, in order of id, with its sensors in order of id (only
+    those given, if sensor_group_ids or sensor_ids are).
+    '''
+    layout = []
+    for sg in sorted(SENSOR_GROUPS):
+        if sensor_group_ids is not None and sg[0] not in sensor_group_ids:
+            continue
+        sids = [sid for sid in sorted(SENSOR_IDS_BY_GROUP[sg[0]])
+                if sensor_ids is None or sid in sensor_ids]
+        if sids:
+            layout.append((sg[0], sids))
+    return layout
+
+def _apply_callbacks(p, rtn_obj, x_call, acc_call, snr_call=None):
+    '''
+    Feed a Pivot to the callbacks of _build_db_results, period by
+    period.  As always, snr_call gets the building's total so far
+    (including that sensor), and acc_call the building's total; both
+    are None once any sensor of the building is missing.
+    '''
+    sums = p.partial_sums().tolist()
+    columns = [(sg_id, zip(range(start, end), p.layout[i][1]))
+               for i, (sg_id, start, end) in enumerate(p.group_columns())]
+    for per, row in zip(p.periods, sums):
+        x = x_call(per.timetuple(), rtn_obj)
+        for sg_id, sensor_columns in columns:
+            y = None
+            for j, sid in sensor_columns:
+                y = row[j]
+                if y != y: # NaN: missing
+                    y = None
+                if snr_call:
+                    snr_call(sid,x,y,rtn_obj)
+            acc_call(sg_id,x,y,rtn_obj)
+
 def _build_db_results(res,start_dt,end_dt,
-                      rtn_obj, x_call, acc_call,snr_call=None):
+                      rtn_obj, x_call, acc_call,snr_call=None,
+                      sensor_group_ids=None, sensor_ids=None):
     '''
     Loops through the database from UTC datetime object start_dt to end_dt
     Uses a string of res to determine point resolution.
@@ -758,56 +914,49 @@ def _build_db_results(res,start_dt,end_dt,
     x_call will get current timetuple and the return object
     acc_call puts things into the rtn_obj by building
     snr_call will place things into the rtn_obj by sensor
+    sensor_group_ids and sensor_ids, if given, limit it to those
+    buildings and sensors (in the query, so no others are read).
+    (The data is pivoted into a matrix first; see pivot.py.)
+    '''
+    p = pivot.build_pivot(_graph_rows(res, start_dt, end_dt,
+                                      sensor_group_ids, sensor_ids),
+                          RESOLUTION_DELTAS[res],
+                          _pivot_layout(sensor_group_ids, sensor_ids))
+    if p is None:
+        return None
+    _apply_callbacks(p, rtn_obj, x_call, acc_call, snr_call)
+    return rtn_obj
+
+def _build_group_results(res,start_dt,end_dt,rtn_obj,x_call,acc_call):
+    '''
+    Like _build_db_results, but reads the precomputed sensor group
+    averages, so there is no snr_call.  A building's value is None
+    for any period in which not all of its sensors have a reading.
+    '''
+    p = _group_pivot(res, start_dt, end_dt)
+    if p is None:
+        return None
+    _apply_callbacks(p, rtn_obj, x_call, acc_call)
+    return rtn_obj
+
+def _group_pivot(res, start_dt, end_dt):
+    '''
+    Return a Pivot of the sensor group averages from start_dt to
+    end_dt, with one column per building (None if there are none).
     '''
     from django.db import connection, transaction
 
     cur = connection.cursor()
-    PowerAverage.graph_data_execute(cur, res, start_dt, end_dt)
-
-    r = cur.fetchone()
-
-    if r is None:
-        return None
-    else:
-        per = r[2]
-        per_incr = RESOLUTION_DELTAS[res]
-    
-        # At the end of each outer loop, we increment the
-        # current period by a resolution step.
-        while r is not None:
-            # Call the given function.
-            # Pass the return object in case they want to do something odd
-            x = x_call(per.timetuple(), rtn_obj)
-
-            for sg in sorted(SENSOR_GROUPS):
-                y = 0 # Always starts at 0
-                for sid in sorted(SENSOR_IDS_BY_GROUP[sg[0]]):
-                    # If this sensor has a reading for the current per,
-                    # update y.  There are three ways the sensor might
-                    # not have such a reading:
-                    # 1. r is None, i.e. there are no more readings at
-                    #    all
-                    # 2. r is not None and r[2] > per, i.e. there are 
-                    #    more readings but not for this per
-                    # 3. r is not None and r[2] <= per and r[1] != s[0],
-                    #    i.e. there are more readings for this per,
-                    #    but none for this sensor
-                    if r is not None and r[2] <= per and r[1] == sid:
-                        # Increase y if its there.
-                        # Then get the next data point
-                        if y is not None:
-                            y += float(r[0]) 
-                        r = cur.fetchone()
-                    else:
-                        y = None
-                    if snr_call:
-                        snr_call(sid,x,y,rtn_obj)
-                # Add to object as described
-                acc_call(sg[0],x,y,rtn_obj)
-                
-            per += per_incr
-
-    return rtn_obj
+    SensorGroupAverage.graph_data_execute(cur, res, start_dt, end_dt)
+    # Each building is a single column; incomplete totals are missing.
+    rows = []
+    for r in cur.fetchall():
+        if r[3] == len(SENSOR_IDS_BY_GROUP.get(r[1], ())):
+            rows.append((r[0], r[1], r[2]))
+        else:
+            rows.append((None, r[1], r[2]))
+    return pivot.build_pivot(rows, RESOLUTION_DELTAS[res],
+                             [(sg[0], [sg[0]]) for sg in sorted(SENSOR_GROUPS)])
 
 # These constants are set when call _get_sensor_groups()
 (SENSOR_GROUPS, SENSOR_IDS, SENSOR_IDS_BY_GROUP,\
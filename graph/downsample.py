@@ -0,0 +1,89 @@
+'''
+    Downsampling of graph series, so that a static graph of any range
+    can be drawn from a fine resolution without sending every point.
+
+    lttb() is Largest-Triangle-Three-Buckets (Steinarsson, 2013):  the
+    points between the first and the last are split into buckets, and
+    from each bucket the point kept is the one making the largest
+    triangle with the point kept from the bucket before and the
+    average of the bucket after.  Unlike averaging into coarser
+    periods, this keeps the peaks and troughs that make the shape of
+    the line.  The bucket averages and each bucket's triangle areas
+    are whole-array operations; only the walk from bucket to bucket
+    (each depends on the point kept before it) is a Python loop.
+
+    Requires NumPy.
+'''
+
+import numpy
+
+
+def lttb(x, y, threshold):
+    '''
+    Return the indices of the threshold points of (x, y) (arrays of
+    floats, x increasing, no NaN) that LTTB keeps, in order.  All of
+    them if there are no more than threshold (or threshold < 3).
+    '''
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return numpy.arange(n)
+
+    # Bucket i is edges[i]:edges[i + 1]; the first and last points
+    # are always kept, outside any bucket.
+    every = (n - 2) / float(threshold - 2)
+    edges = (numpy.arange(threshold - 1) * every).astype(int) + 1
+    edges[-1] = n - 1
+
+    # The average point of each bucket, from cumulative sums.
+    cx = numpy.concatenate(([0.0], numpy.cumsum(x)))
+    cy = numpy.concatenate(([0.0], numpy.cumsum(y)))
+    sizes = edges[1:] - edges[:-1]
+    next_x = numpy.append((cx[edges[2:]] - cx[edges[1:-1]]) / sizes[1:], x[-1])
+    next_y = numpy.append((cy[edges[2:]] - cy[edges[1:-1]]) / sizes[1:], y[-1])
+
+    kept = numpy.empty(threshold, dtype=int)
+    kept[0] = a = 0
+    for i in xrange(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # (Twice) the areas of the triangles, for each point in the
+        # bucket.
+        areas = numpy.abs((x[a] - next_x[i]) * (y[lo:hi] - y[a])
+                          - (x[a] - x[lo:hi]) * (next_y[i] - y[a]))
+        a = lo + int(areas.argmax())
+        kept[i + 1] = a
+    kept[-1] = n - 1
+    return kept
+
+
+def downsample(x, y, threshold):
+    '''
+    Reduce a series to about threshold points with lttb().  y may have
+    NaNs (missing readings):  those are left out of the choice, and
+    wherever any were between two points kept, a None is put between
+    them, so the graph still shows the gap.  Return a list of [x, y]
+    pairs.
+    '''
+    xs = numpy.asarray(x).tolist()
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+    ys = y.tolist()
+    missing = numpy.isnan(y)
+    valid = numpy.nonzero(~missing)[0]
+    if not len(valid):
+        return []
+    kept = valid[lttb(x[valid], y[valid], threshold)]
+
+    # The number of missing points up to each point, so whether any
+    # are between two kept ones.
+    missing_before = numpy.cumsum(missing)
+    gaps = (missing_before[kept[1:]] - missing_before[kept[:-1]]) > 0
+    missing_at = numpy.nonzero(missing)[0]
+
+    pairs = []
+    for j, i in enumerate(kept.tolist()):
+        pairs.append([xs[i], ys[i]])
+        if j < len(gaps) and gaps[j]:
+            # The gap starts at the first missing point after i.
+            gap = missing_at[numpy.searchsorted(missing_at, i)]
+            pairs.append([xs[int(gap)], None])
+    return pairs
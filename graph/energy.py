@@ -0,0 +1,145 @@
+'''
+    Energy (watt-hours) and average power over any range of time.
+
+    Each PowerAverage stores the energy of its period, watt_hours:
+    the sum of its readings' watts, each reading counting for
+    READING_INTERVAL seconds (so a period with missing readings counts
+    only the time that was measured).  Each sensor also has a running
+    total of the energy and readings of its hour averages at every
+    hour boundary (EnergyPrefix), so the whole hours of a range are
+    the difference of two running totals, however long the range.
+    The part-hours at its edges are sums of whole finer periods:
+    cover() splits them into the coarsest that fit (ten minutes, then
+    minutes, then ten seconds).  Both are read in one query.
+
+    A sensor's running total for an hour is only added once the hour
+    closes, i.e. when the monitor gets the first reading of the next
+    hour; until then ranges ending after it leave it out.  The edges
+    are only as precise as the finest averages still kept (see
+    RETENTION_POLICY), and months that were archived and purged (see
+    archive.py) only count through the running totals.
+'''
+
+import calendar
+from django.db import connection
+from django.conf import settings
+from energyweb.graph.models import Sensor, SensorGroup, PowerAverage, \
+                                   EnergyPrefix
+
+
+# The average types finer than the running totals' hours, for the
+# edges of a range.
+EDGE_TYPES = ('minute*10', 'minute', 'second*10')
+
+
+def _bucket_end(average_type, trunc_dt):
+    '''
+    Return the end of the period of the given type starting at
+    trunc_dt.
+    '''
+    if average_type == 'month':
+        days = calendar.monthrange(trunc_dt.year, trunc_dt.month)[1]
+        return trunc_dt.replace(day=days) \
+            + PowerAverage.AVERAGE_TYPE_TIMEDELTAS['day']
+    return trunc_dt + PowerAverage.AVERAGE_TYPE_TIMEDELTAS[average_type]
+
+
+def cover(start_dt, end_dt, average_types=PowerAverage.AVERAGE_TYPES):
+    '''
+    Split the range from start_dt (inclusive) to end_dt (exclusive)
+    into whole periods of the given average types (coarsest first).
+    Return a list of (average type, start, end), each range being
+    whole periods of that type, in order.  The last (finest) type
+    takes whatever is left, by the periods starting in it.
+    '''
+    if start_dt >= end_dt:
+        return []
+    average_type = average_types[0]
+    if len(average_types) == 1:
+        return [(average_type, start_dt, end_dt)]
+
+    first = PowerAverage.date_trunc(average_type, start_dt)
+    if first < start_dt:
+        first = _bucket_end(average_type, first)
+    last = PowerAverage.date_trunc(average_type, end_dt)
+    if first >= last:
+        # No whole period of this type fits.
+        return cover(start_dt, end_dt, average_types[1:])
+    return (cover(start_dt, first, average_types[1:])
+            + [(average_type, first, last)]
+            + cover(last, end_dt, average_types[1:]))
+
+
+def _hour_after(dt):
+    '''
+    Return the first hour boundary at or after dt.
+    '''
+    hour = PowerAverage.date_trunc('hour', dt)
+    if hour < dt:
+        hour += PowerAverage.AVERAGE_TYPE_TIMEDELTAS['hour']
+    return hour
+
+
+def sums_by_sensor(sensor_ids, start_dt, end_dt):
+    '''
+    Return (watt-hours, number of readings) for each of the given
+    sensors from start_dt to end_dt, as a dictionary with sensor ID as
+    keys.
+    '''
+    totals = dict([[sid, (0.0, 0)] for sid in sensor_ids])
+    if start_dt >= end_dt or not totals:
+        return totals
+    lower_dt = _hour_after(start_dt)
+    upper_dt = PowerAverage.date_trunc('hour', end_dt)
+    if lower_dt < upper_dt:
+        ranges = (cover(start_dt, lower_dt, EDGE_TYPES)
+                  + cover(upper_dt, end_dt, EDGE_TYPES))
+    else:
+        # Not even a whole hour.
+        ranges = cover(start_dt, end_dt)
+        lower_dt = upper_dt = None
+    cur = connection.cursor()
+    EnergyPrefix.sums_execute(cur, totals.keys(), ranges, lower_dt, upper_dt)
+    for sid, watt_hours, num_points in cur.fetchall():
+        totals[sid] = (watt_hours, num_points)
+    return totals
+
+
+def energy_by_sensor(sensor_ids, start_dt, end_dt):
+    '''
+    Return the watt-hours used by each of the given sensors from
+    start_dt to end_dt, as a dictionary with sensor ID as keys.
+    '''
+    return dict([[sid, watt_hours] for sid, (watt_hours, num_points)
+                 in sums_by_sensor(sensor_ids, start_dt, end_dt).iteritems()])
+
+
+def average_by_sensor(sensor_ids, start_dt, end_dt):
+    '''
+    Return the average power (kilowatts) of each of the given sensors
+    from start_dt to end_dt, over its readings, as a dictionary with
+    sensor ID as keys; None for sensors with no readings.
+    '''
+    averages = {}
+    for sid, (watt_hours, num_points) in \
+            sums_by_sensor(sensor_ids, start_dt, end_dt).iteritems():
+        if num_points:
+            # Each reading counts for READING_INTERVAL seconds.
+            averages[sid] = (watt_hours * 3600.0 / settings.READING_INTERVAL
+                             / num_points / 1000)
+        else:
+            averages[sid] = None
+    return averages
+
+
+def energy_between(sensor_or_group, start_dt, end_dt):
+    '''
+    Return the watt-hours used by a Sensor or a SensorGroup (all of
+    its sensors) from start_dt to end_dt.
+    '''
+    if isinstance(sensor_or_group, SensorGroup):
+        sensor_ids = [s.pk for s in
+                      Sensor.objects.filter(sensor_group=sensor_or_group)]
+    else:
+        sensor_ids = [sensor_or_group.pk]
+    return sum(energy_by_sensor(sensor_ids, start_dt, end_dt).values())
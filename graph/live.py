@@ -0,0 +1,208 @@
+'''
+    Pushes new graph points and table averages to browsers over
+    Server-Sent Events, instead of every browser polling for them.
+
+    Whenever the monitors' writer commits averages the live pages show
+    (responsecache.INVALIDATING_TYPES), it sends a NOTIFY on CHANNEL
+    (see notify()).  In each web server process, one LiveBroadcaster
+    thread LISTENs for it; on each notification it queries the new
+    10-second building points and the table averages once, and
+    publishes them as events.  Every open /live/ response (stream())
+    then just sends each client the events it has not seen, so the
+    cost of an update no longer grows with the number of clients.
+
+    Events (each data is JSON):
+        points:   {'sg_xy_pairs': {group id: [[ms, kW], ...]},
+                   'last_record': ms}, the points after the last ones
+                   published.
+        averages: {'min_averages': ..., 'week_averages': ...,
+                   'month_averages': ...}, as statistics_table_data.
+        tick:     {'time': ms}, sent with each update, for pages that
+                   only need to know when to refresh.
+
+    The payload is not sent with the NOTIFY itself (PostgreSQL 8.4
+    cannot), so the listener always re-queries; notifications that
+    arrive while it is busy are handled together.
+'''
+
+import calendar, datetime, logging, select, threading, time
+import simplejson
+from django.conf import settings
+from energyweb.graph.control import connect_listener, collect_notifies
+
+
+CHANNEL = 'energyweb_live'
+
+# How many events each process keeps for clients that reconnect
+# (with Last-Event-ID) or fall behind.
+BACKLOG = 60
+
+# How long the listener waits on its connection before checking that
+# it is still alive, in seconds.
+LISTEN_TIMEOUT = 60
+
+
+def notify(cur):
+    '''
+    Tell the listening web servers that there is new data.  Call this
+    inside the transaction that writes it:  the notification is only
+    delivered if and when the transaction commits.
+    '''
+    cur.execute('NOTIFY ' + CHANNEL + ';')
+
+
+def _now_ms():
+    return int(calendar.timegm(datetime.datetime.utcnow().timetuple())) * 1000
+
+
+class LiveBroadcaster(threading.Thread):
+    '''
+    Listens for notifications and publishes the resulting events.
+    Use get_broadcaster() rather than creating one.
+
+    events: [(id, name, JSON data), ...], oldest first; at most
+        BACKLOG of them.
+    '''
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='LiveBroadcaster')
+        self.setDaemon(True)
+        self.condition = threading.Condition()
+        self.events = []
+        self.next_id = 1
+        # The time (in ms) of the last points published.
+        self.last_record = None
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except Exception, e:
+                logging.error('Live updates: %s; reconnecting in %d s.'
+                              % (e, settings.ERROR_PAUSE))
+                time.sleep(settings.ERROR_PAUSE)
+
+    def listen(self):
+        conn = connect_listener(CHANNEL)
+        try:
+            while True:
+                if select.select([conn], [], [], LISTEN_TIMEOUT)[0]:
+                    if collect_notifies(conn):
+                        self.update()
+                else:
+                    # (Fails, and so reconnects, if the connection
+                    # has been lost.)
+                    conn.cursor().execute('SELECT 1;')
+        finally:
+            conn.close()
+
+    def update(self):
+        '''
+        Query the new data and publish it.
+        '''
+        # Imported here so that importing this module (e.g. from the
+        # writer) does not load the website's data layer.
+        from django.db import connection
+        from energyweb.graph import data
+        try:
+            if self.last_record is None:
+                start = time.time() - 60
+            else:
+                start = self.last_record / 1000
+            dump = data._make_data_dump(start, None, 'second*10')
+            averages = data._get_averages()
+        finally:
+            # This thread's Django connection would otherwise stay
+            # open, idle in transaction.
+            connection.close()
+
+        events = []
+        if not dump['no_results']:
+            points = {}
+            for group_id, pairs in dump['sg_xy_pairs'].iteritems():
+                points[group_id] = [p for p in pairs
+                                    if self.last_record is None
+                                    or p[0] > self.last_record]
+            self.last_record = max(self.last_record, dump['last_record'])
+            events.append(('points', {'sg_xy_pairs': points,
+                                      'last_record': self.last_record}))
+        events.append(('averages',
+                       {'min_averages': averages['minute'],
+                        'week_averages': averages['week'],
+                        'month_averages': averages['month']}))
+        events.append(('tick', {'time': _now_ms()}))
+        for name, d in events:
+            self.publish(name, simplejson.dumps(d))
+
+    def publish(self, name, data):
+        self.condition.acquire()
+        try:
+            self.events.append((self.next_id, name, data))
+            self.next_id += 1
+            del self.events[:-BACKLOG]
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def events_after(self, last_id, timeout):
+        '''
+        Return the events with ids after last_id, waiting up to
+        timeout seconds for one if there are none yet.
+        '''
+        self.condition.acquire()
+        try:
+            if not self.events or self.events[-1][0] <= last_id:
+                self.condition.wait(timeout)
+            return [e for e in self.events if e[0] > last_id]
+        finally:
+            self.condition.release()
+
+    def latest_id(self):
+        self.condition.acquire()
+        try:
+            return self.next_id - 1
+        finally:
+            self.condition.release()
+
+
+_broadcaster = None
+_broadcaster_lock = threading.Lock()
+
+
+def get_broadcaster():
+    '''
+    Return this process's LiveBroadcaster, starting it if need be.
+    '''
+    global _broadcaster
+    _broadcaster_lock.acquire()
+    try:
+        if _broadcaster is None:
+            _broadcaster = LiveBroadcaster()
+            _broadcaster.start()
+        return _broadcaster
+    finally:
+        _broadcaster_lock.release()
+
+
+def stream(last_id=None):
+    '''
+    Generate the text of an event stream:  each event published after
+    last_id (by default, from now on), with a comment every
+    LIVE_HEARTBEAT seconds so that proxies keep the connection open.
+    Ends after LIVE_MAX_SECONDS; the browser then reconnects
+    LIVE_RETRY seconds later, passing the last id it saw.
+    '''
+    broadcaster = get_broadcaster()
+    if last_id is None or last_id > broadcaster.latest_id():
+        # (An id from another process, or from before a restart.)
+        last_id = broadcaster.latest_id()
+    end = time.time() + settings.LIVE_MAX_SECONDS
+    yield 'retry: %d\n\n' % (settings.LIVE_RETRY * 1000)
+    while time.time() < end:
+        events = broadcaster.events_after(last_id, settings.LIVE_HEARTBEAT)
+        if not events:
+            yield ': keepalive\n\n'
+            continue
+        for event_id, name, data in events:
+            yield 'id: %d\nevent: %s\ndata: %s\n\n' % (event_id, name, data)
+            last_id = event_id
@@ -0,0 +1,232 @@
+'''
+    Buffered writer of LogMessages, for the monitors and fakers.
+
+    Rather than saving each LogMessage where it happens (in socket
+    error paths and signal handlers, once per reconnect attempt), they
+    call log(), which only buffers the message.  A background thread
+    writes the buffer every LOG_FLUSH_INTERVAL seconds, in one
+    transaction, and coalesces repeats:
+
+    - identical messages buffered together become one, with a count;
+    - a message that repeats the last one written for its sensor
+      within LOG_RATE_PERIOD seconds updates that row (count,
+      last_time, details) instead of adding one;
+    - at most LOG_RATE_LIMIT rows are added per sensor and topic per
+      LOG_RATE_PERIOD; further messages are counted into the latest.
+
+    A LogMessage's reading_time is when it was first seen, last_time
+    when it was last seen, and count how many times.  Call close()
+    before exiting so the last messages are written.
+'''
+
+import datetime, logging, threading
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from energyweb.graph.models import LogMessage
+
+
+class LogSink(threading.Thread):
+    '''
+    Buffers LogMessages and writes them from its own thread (and its
+    own database connection, since Django's are per thread).  Use
+    get_sink() rather than creating one.
+    '''
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='LogSink')
+        self.setDaemon(True)
+        self.condition = threading.Condition()
+        self.stopping = False
+        # Buffered messages, in order:  each is a dictionary of
+        # LogMessage fields plus 'count'.  Indexed by message key.
+        self.pending = []
+        self.pending_by_key = {}
+        # (sensor id, sensor type) -> the last row written:
+        # {'id', 'log_type', 'topic', 'last_time'}.
+        self.last_rows = {}
+        # (sensor id, sensor type, topic) -> (times of the rows
+        # written within LOG_RATE_PERIOD, id of the latest).
+        self.topic_rows = {}
+
+    def log(self, sensor, sensor_type, log_type, topic, details, when=None):
+        '''
+        Buffer a LogMessage (see models.py for the fields).
+        '''
+        if when is None:
+            when = datetime.datetime.now()
+        key = (sensor.pk, sensor_type, log_type, topic, details)
+        self.condition.acquire()
+        try:
+            entry = self.pending_by_key.get(key)
+            if entry is None:
+                entry = {'sensor_id': sensor.pk, 'sensor_type': sensor_type,
+                         'log_type': log_type, 'topic': topic,
+                         'details': details, 'reading_time': when,
+                         'last_time': when, 'count': 1}
+                self.pending.append(entry)
+                self.pending_by_key[key] = entry
+            else:
+                entry['count'] += 1
+                entry['last_time'] = when
+        finally:
+            self.condition.release()
+
+    def run(self):
+        while True:
+            self.condition.acquire()
+            try:
+                if not self.stopping:
+                    self.condition.wait(settings.LOG_FLUSH_INTERVAL)
+                stopping = self.stopping
+            finally:
+                self.condition.release()
+            self.flush()
+            if stopping:
+                break
+
+    def close(self):
+        '''
+        Write whatever is buffered and stop the thread.
+        '''
+        self.condition.acquire()
+        try:
+            self.stopping = True
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+        if self.isAlive():
+            self.join(settings.LOG_FLUSH_INTERVAL * 2)
+        else:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write the buffered messages in one transaction.  If that
+        fails, keep them for the next attempt.
+        '''
+        self.condition.acquire()
+        try:
+            entries = self.pending
+            self.pending = []
+            self.pending_by_key = {}
+        finally:
+            self.condition.release()
+        if not entries:
+            return
+
+        last_rows = self.last_rows.copy()
+        topic_rows = self.topic_rows.copy()
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            try:
+                for entry in entries:
+                    self._write(entry, last_rows, topic_rows)
+                transaction.commit()
+            except Exception, detail:
+                # Whatever went wrong, the entries must not be lost,
+                # nor the thread die.
+                try:
+                    transaction.rollback()
+                except Exception:
+                    pass
+                logging.error('Writing %d log messages failed: %s'
+                              % (len(entries), detail))
+                self._requeue(entries)
+                return
+        finally:
+            transaction.leave_transaction_management()
+        self.last_rows = last_rows
+        self.topic_rows = topic_rows
+
+    def _requeue(self, entries):
+        '''
+        Put entries back at the front of the buffer, for the next
+        flush.
+        '''
+        self.condition.acquire()
+        try:
+            for entry in reversed(entries):
+                self.pending.insert(0, entry)
+            for entry in self.pending:
+                self.pending_by_key[(entry['sensor_id'],
+                                     entry['sensor_type'],
+                                     entry['log_type'], entry['topic'],
+                                     entry['details'])] = entry
+        finally:
+            self.condition.release()
+
+    def _write(self, entry, last_rows, topic_rows):
+        period = datetime.timedelta(seconds=settings.LOG_RATE_PERIOD)
+        sensor_key = (entry['sensor_id'], entry['sensor_type'])
+        topic_key = sensor_key + (entry['topic'],)
+        last = last_rows.get(sensor_key)
+        times, latest_id = topic_rows.get(topic_key, ([], None))
+        times = [t for t in times if entry['reading_time'] - t < period]
+
+        if last is not None and last['log_type'] == entry['log_type'] \
+                and last['topic'] == entry['topic'] \
+                and entry['reading_time'] - last['last_time'] < period:
+            # A repeat of the last message for this sensor.
+            self._update(last['id'], entry, True)
+            last_rows[sensor_key] = dict(last, last_time=entry['last_time'])
+        elif latest_id is not None and len(times) >= settings.LOG_RATE_LIMIT:
+            # Too many for this topic; count it into the latest.
+            self._update(latest_id, entry, False)
+        else:
+            row = LogMessage.objects.create(**entry)
+            times.append(entry['reading_time'])
+            latest_id = row.pk
+            last_rows[sensor_key] = {'id': row.pk,
+                                     'log_type': entry['log_type'],
+                                     'topic': entry['topic'],
+                                     'last_time': entry['last_time']}
+        topic_rows[topic_key] = (times, latest_id)
+
+    def _update(self, row_id, entry, replace_details):
+        updates = {'count': F('count') + entry['count'],
+                   'last_time': entry['last_time']}
+        if replace_details:
+            updates['details'] = entry['details']
+        LogMessage.objects.filter(pk=row_id).update(**updates)
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_sink():
+    '''
+    Return this process's LogSink, starting it if need be.
+    '''
+    global _sink
+    _sink_lock.acquire()
+    try:
+        if _sink is None:
+            _sink = LogSink()
+            _sink.start()
+        return _sink
+    finally:
+        _sink_lock.release()
+
+
+def log(sensor, sensor_type, log_type, topic, details):
+    '''
+    Buffer a LogMessage with this process's LogSink.
+    '''
+    get_sink().log(sensor, sensor_type, log_type, topic, details)
+
+
+def close():
+    '''
+    Write any buffered LogMessages and stop this process's LogSink.
+    '''
+    global _sink
+    _sink_lock.acquire()
+    try:
+        if _sink is not None:
+            _sink.close()
+            _sink = None
+    finally:
+        _sink_lock.release()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+
+'''
+Write the sensor readings and power averages of closed months to
+columnar archive files (see archive.py), one per sensor and month,
+and record them in the archive manifest.  Months already archived
+are skipped.  With --purge, the archived rows are then deleted from
+the database (in batches of RETENTION_BATCH_SIZE), after checking
+that the file reads back with the right number of rows; the graphs
+read purged months from the archive instead.
+
+A month is closed once every average that starts in it has ended,
+i.e. a week after the month ends.
+'''
+
+
+import datetime
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import connection, transaction
+from energyweb.graph.models import Sensor
+from energyweb.graph import archive
+from energyweb.graph.partitions import month_start, add_months
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Archive the readings and averages of closed months to files.'
+    option_list = BaseCommand.option_list + (
+        make_option('--before', default=None,
+                    help='Only archive months before this one (YYYY-MM).'),
+        make_option('--sensor', type='int', default=None,
+                    help='Only archive this sensor.'),
+        make_option('--purge', action='store_true', default=False,
+                    help='Delete the archived rows from the database.'),
+    )
+
+    @transaction.commit_manually
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError('Invalid number of arguments: %d.' % len(args))
+        # The first month that is not closed yet.
+        end = month_start(datetime.datetime.now() - datetime.timedelta(7))
+        if options['before'] is not None:
+            try:
+                before = datetime.datetime.strptime(options['before'],
+                                                    '%Y-%m')
+            except ValueError:
+                raise CommandError('Invalid month: \'%s\'.'
+                                   % options['before'])
+            end = min(end, before)
+
+        sensors = Sensor.objects.order_by('pk')
+        if options['sensor'] is not None:
+            sensors = sensors.filter(pk=options['sensor'])
+        manifest = archive.load_manifest()
+        try:
+            for sensor in sensors:
+                months = manifest.setdefault(str(sensor.pk), {})
+                for month in self.months(sensor, end):
+                    label = archive.month_label(month)
+                    if label not in months:
+                        months[label] = self.archive(sensor, month)
+                        archive.save_manifest(manifest)
+                        print 'Sensor %d, %s: %d readings, %d averages, ' \
+                              '%d KB.' % (sensor.pk, label,
+                                          months[label]['readings'],
+                                          months[label]['averages'],
+                                          months[label]['bytes'] >> 10)
+                    if options['purge'] and not months[label]['purged']:
+                        self.purge(sensor, month, months[label])
+                        months[label]['purged'] = True
+                        archive.save_manifest(manifest)
+                        print 'Sensor %d, %s: purged.' % (sensor.pk, label)
+        except:
+            transaction.rollback()
+            raise
+        transaction.commit()
+
+    def months(self, sensor, end):
+        '''
+        Return the months before datetime end for which sensor has
+        readings or averages in the database.
+        '''
+        cur = connection.cursor()
+        cur.execute('''SELECT MIN(reading_time) FROM graph_sensorreading
+                       WHERE sensor_id = %s;''', (sensor.pk,))
+        first = cur.fetchone()[0]
+        cur.execute('''SELECT MIN(trunc_reading_time) FROM graph_poweraverage
+                       WHERE sensor_id = %s;''', (sensor.pk,))
+        first_average = cur.fetchone()[0]
+        if first is None or (first_average is not None
+                             and first_average < first):
+            first = first_average
+        if first is None:
+            return []
+        months = []
+        month = month_start(first)
+        while month < end:
+            months.append(month)
+            month = add_months(month, 1)
+        return months
+
+    def archive(self, sensor, month):
+        '''
+        Write the archive file of sensor for month, returning its
+        manifest entry.
+        '''
+        start = month
+        end = add_months(month, 1)
+        writer = archive.ArchiveWriter(sensor.pk, month)
+
+        # A named (server-side) cursor, so that a month of readings
+        # is never all in memory at once.
+        connection.cursor()
+        cur = connection.connection.cursor('archive_readings')
+        cur.execute('SELECT ' + ', '.join([c[0] for c in
+                                           archive.READING_COLUMNS])
+                    + ''' FROM graph_sensorreading
+                          WHERE sensor_id = %s
+                            AND reading_time >= %s AND reading_time < %s
+                          ORDER BY reading_time;''', (sensor.pk, start, end))
+        while True:
+            rows = cur.fetchmany(settings.ARCHIVE_CHUNK_SIZE)
+            if not rows:
+                break
+            writer.add_readings(rows)
+        cur.close()
+
+        cur = connection.cursor()
+        cur.execute('SELECT ' + ', '.join([c[0] for c in
+                                           archive.AVERAGE_COLUMNS])
+                    + ''' FROM graph_poweraverage
+                          WHERE sensor_id = %s
+                            AND trunc_reading_time >= %s
+                            AND trunc_reading_time < %s
+                          ORDER BY average_type, trunc_reading_time;''',
+                    (sensor.pk, start, end))
+        writer.add_averages(cur.fetchall())
+        size = writer.close()
+        transaction.commit()
+        return {'readings': writer.rows['readings'],
+                'averages': writer.rows['averages'],
+                'bytes': size,
+                'purged': False}
+
+    def purge(self, sensor, month, entry):
+        '''
+        Delete the archived rows of sensor for month from the
+        database, once the archive file has been checked.
+        '''
+        header = archive.read_archive(archive.archive_path(sensor.pk, month),
+                                      ())[0]
+        if header['tables']['readings']['rows'] != entry['readings'] \
+                or header['tables']['averages']['rows'] != entry['averages']:
+            raise CommandError('Archive of sensor %d for %s does not match '
+                               'the manifest; not purging.'
+                               % (sensor.pk, archive.month_label(month)))
+        start = month
+        end = add_months(month, 1)
+        batch_size = settings.RETENTION_BATCH_SIZE
+        cur = connection.cursor()
+        while True:
+            cur.execute('''SELECT id FROM graph_sensorreading
+                           WHERE sensor_id = %s
+                             AND reading_time >= %s AND reading_time < %s
+                           LIMIT %s;''', (sensor.pk, start, end, batch_size))
+            ids = tuple([r[0] for r in cur.fetchall()])
+            if not ids:
+                break
+            cur.execute('''DELETE FROM graph_srprofile
+                           WHERE sensor_reading_id IN %s;''', (ids,))
+            cur.execute('''DELETE FROM graph_sensorreading
+                           WHERE reading_time >= %s AND reading_time < %s
+                             AND id IN %s;''', (start, end, ids))
+            transaction.commit()
+        while True:
+            cur.execute('''DELETE FROM graph_poweraverage
+                           WHERE id IN
+                             (SELECT id FROM graph_poweraverage
+                              WHERE sensor_id = %s
+                                AND trunc_reading_time >= %s
+                                AND trunc_reading_time < %s
+                              LIMIT %s);''',
+                        (sensor.pk, start, end, batch_size))
+            n = cur.rowcount
+            transaction.commit()
+            if n < batch_size:
+                break
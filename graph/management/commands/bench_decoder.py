@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+
+'''
+Time the ways of decoding Rhizome frames (see rhizome.py) against one
+another, using the frames in the energyfaker profiles:  the original
+ord()-based decoding, rhizome.decode (one frame at a time), and
+rhizome.decode_many (all frames at once, if NumPy is installed).
+Prints microseconds per frame and checks that all three agree.
+'''
+
+
+import timeit
+from binascii import unhexlify
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from energyweb.graph.fake_rhizome_profiles import FAKE_RHIZOME_PROFILES
+from energyweb.graph import rhizome
+
+
+def legacy_decode(data, factor):
+    '''
+    The ord()-based decoding energymon used before rhizome.py, kept
+    for comparison.
+    '''
+    d = {}
+    d['rindex'] = ord(data[4])
+    # Lots of little uints
+    d['awatthr'] = factor * ((ord(data[5]) << 8) | ord(data[6]))
+    d['bwatthr'] = factor * ((ord(data[7]) << 8) | ord(data[8]))
+    d['cwatthr'] = factor * ((ord(data[9]) << 8) | ord(data[10]))
+    d['avarhr'] = factor * ((ord(data[11]) << 8) | ord(data[12]))
+    d['bvarhr'] = factor * ((ord(data[13]) << 8) | ord(data[14]))
+    d['cvarhr'] = factor * ((ord(data[15]) << 8) | ord(data[16]))
+    d['avahr'] = factor * ((ord(data[17]) << 8) | ord(data[18]))
+    d['bvahr'] = factor * ((ord(data[19]) << 8) | ord(data[20]))
+    d['cvahr'] = factor * ((ord(data[21]) << 8) | ord(data[22]))
+    d['airms'] = factor * ((ord(data[23]) << 16)
+                           | (ord(data[24]) << 8)
+                           | ord(data[25]))
+    d['birms'] = factor * ((ord(data[26]) << 16)
+                           | (ord(data[27]) << 8)
+                           | ord(data[28]))
+    d['cirms'] = factor * ((ord(data[29]) << 16)
+                           | (ord(data[30]) << 8)
+                           | ord(data[31]))
+    d['avrms'] = ((ord(data[32]) << 16) | (ord(data[33]) << 8)
+                                   | ord(data[34]))
+    d['bvrms'] = ((ord(data[35]) << 16) | (ord(data[36]) << 8)
+                                   | ord(data[37]))
+    d['cvrms'] = ((ord(data[38]) << 16) | (ord(data[39]) << 8)
+                                   | ord(data[40]))
+    d['freq'] = ((ord(data[41]) << 8) | ord(data[42])) >> 4
+    # for tempc:  at d['Amb'] = 25C, register = DF = Offset
+    d['tempc'] = 25 + (ord(data[43]) - int('df', 16)) * 3
+    return d
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Benchmark the Rhizome frame decoders.'
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', type='int', default=5,
+                    help='Number of timing runs (the best is reported).'),
+    )
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError('Invalid number of arguments: %d.' % len(args))
+        factor = 2.5
+        frames = [unhexlify(s) for profile in FAKE_RHIZOME_PROFILES.values()
+                  for s in profile]
+        data = ''.join(frames)
+        n = len(frames)
+
+        for frame in frames:
+            if legacy_decode(frame, factor) != \
+                   rhizome.decode(frame, factor)._asdict():
+                raise CommandError('rhizome.decode disagrees with the '
+                                   'original decoding.')
+
+        def _legacy():
+            for frame in frames:
+                legacy_decode(frame, factor)
+
+        def _struct():
+            for i in xrange(0, len(data), rhizome.FRAME_LENGTH):
+                rhizome.decode(data, factor, i)
+
+        timings = [('ord() (original)', _legacy),
+                   ('struct', _struct)]
+        if rhizome.numpy is not None:
+            arrays = rhizome.decode_many(data, factor)
+            for i in xrange(n):
+                reading = rhizome.decode(frames[i], factor)
+                for field in rhizome.READING_FIELDS:
+                    if arrays[field][i] != getattr(reading, field):
+                        raise CommandError('rhizome.decode_many disagrees '
+                                           'with rhizome.decode.')
+            timings.append(('numpy (all at once)',
+                            lambda: rhizome.decode_many(data, factor)))
+        else:
+            print 'NumPy is not installed; skipping decode_many.'
+
+        print 'Decoding %d frames:' % n
+        for name, f in timings:
+            best = min(timeit.repeat(f, number=1, repeat=options['repeat']))
+            print '    %-20s %8.3f us/frame' % (name, best * 1e6 / n)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+
+'''
+Compare the detail table statistics (data._get_detail_table, which
+uses a single query) against the way they were computed before (a
+query per cycle and then some), for every building and resolution:
+prints the queries each makes per request and milliseconds per
+request, and checks that the averages agree.  (The integrated values
+are not compared:  they now come from the energy stored with the power
+averages, which only counts the time covered by readings, rather than
+a Riemann sum; see energy.py.)
+'''
+
+
+import datetime, time
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries
+from energyweb.graph import data
+
+
+# The hours in a period of each resolution used for integrating.
+INTEGRATE_HOURS = {
+    'minute*10':1/6.0,#6 of these per hour
+    'hour':1,
+    'day':24,}
+
+def legacy_integrate(start_dt,end_dt,res,splitSensors=True):
+    '''
+    The detail table's integration as it was before the power
+    averages stored their energy:  a Riemann sum of the averages of
+    resolution res, in kilowatt*hr, by sensor (or by building, if not
+    splitSensors).
+    '''
+    if splitSensors:
+        watt_totals = dict([ [sid,0] for sid in data.SENSOR_IDS])
+        # These functions ensure we store by sensor, not by building
+        def _acc_call(sg,x,y,rtn_obj):
+            pass
+        def _snr_call(sid,x,y,rtn_obj):
+            try:
+                rtn_obj[sid] += y
+            except:
+                rtn_obj[sid] += 0
+    else:
+        watt_totals = dict([ [sg[0], 0] for sg in data.SENSOR_GROUPS])
+        # These functions store by building, not by sensor.
+        def _acc_call(sg,x,y,rtn_obj):
+            try:
+                rtn_obj[sg] += y
+            except:
+                pass
+        def _snr_call(sid,x,y,rtn_obj):
+            pass
+
+    data._build_db_results(res,start_dt,end_dt,
+                           watt_totals,
+                           lambda a,b : None, # Don't care about having a timestamp
+                           _acc_call,
+                           _snr_call)
+    if not watt_totals:
+        return None
+
+    # Corrections will change it such that we are in kw*hr
+    # no matter what integrating interval.
+    for reading in watt_totals.iterkeys():
+        watt_totals[reading] = watt_totals[reading]*INTEGRATE_HOURS[res]
+
+    return watt_totals
+
+def legacy_detail_averages(res):
+    '''
+    The averages of every cycle of resolution res, by sensor, as
+    legacy_detail_table gets them:  a query per cycle.
+    '''
+    all_averages = dict([[sid,{}] for sid in data.SENSOR_IDS])
+    # Use start_offsets to mark each cycle
+    for start_offset in range(len(data.CYCLE_START_DIFFS[res])):
+        cycle_dt = (datetime.datetime.utcnow()
+                    - data.CYCLE_START_DIFFS[res][start_offset]
+                    * data.RESOLUTION_DELTAS[res])
+        results = data._query_averages(res, cycle_dt)
+        for sid,value in results.iteritems():
+            all_averages[sid][start_offset] = value
+
+    return all_averages
+
+def legacy_detail_table(building, resolution, start_time):
+    '''
+    data._get_detail_table as it was before it used a single query,
+    kept for comparison.
+    '''
+    # Get which building's data we need from the database
+    cur_building = None
+    for sg in data.SENSOR_GROUPS:
+        if sg[1].lower() == str(building): # check if identical names
+            cur_building = sg
+            
+    dataDictionary = {'graph_data':[],
+                      'building': building.capitalize(),
+                      'res': resolution,
+                      }
+    
+    dataDictionary['cycleTable'] = {}
+    dataDictionary['diagnosticTable'] = {}
+
+    for sid in data.SENSOR_IDS_BY_GROUP[cur_building[0]]:
+        dataDictionary['diagnosticTable'][str(sid)] = {
+            'now': 0,
+            'interval':0,
+            'integrated':0,
+            }
+    # Python doesn't shuffle order of lists...
+    dataDictionary['diagnosticRow'] = ['now','interval','integrated']
+
+    for cycle_id in range(len(data.CYCLE_START_DELTAS[resolution])):
+        dataDictionary['cycleTable'][str(cycle_id)] = \
+            dict([['avg',0],['integrated',0]])
+
+    # Input all of the "Now" averages for Diagnostic
+    cur_cycles = legacy_detail_averages('minute')
+    for sid in data.SENSOR_IDS_BY_GROUP[cur_building[0]]:
+        dataDictionary['diagnosticTable'][str(sid)]['now'] = \
+            cur_cycles[sid][0]
+
+    # Input all of the "This Interval" for diagostic table.
+    average_cycles = legacy_detail_averages(resolution)
+    for sid in data.SENSOR_IDS_BY_GROUP[cur_building[0]]:
+        dataDictionary['diagnosticTable'][str(sid)]['interval'] = \
+            average_cycles[sid][0]
+
+    dataDictionary['debugFull'] = average_cycles
+    # Input Cycle Table's Values
+    for cycle_id in dataDictionary['cycleTable'].iterkeys():
+        cid = int(cycle_id)
+
+        start_dt = datetime.datetime.utcfromtimestamp(
+            int(start_time) / 1000 -
+            data._dt_to_sec(data.CYCLE_START_DELTAS[resolution][cid]) )
+
+        # Integrate gives information back by building.
+        integValues = legacy_integrate(start_dt,
+                                       start_dt+data.RESOLUTION_DELTAS[resolution],
+                                       data.AUTO_RES_CONVERT[resolution],
+                                       False)
+        try:
+            dataDictionary['cycleTable'][cycle_id]['integrated'] = \
+                integValues[cur_building[0]]
+        except:
+            dataDictionary['cycleTable'][cycle_id]['integrated'] = 0
+        # The Average getter gets by sensor group. Thus need to sum.
+        for sid in data.SENSOR_IDS_BY_GROUP[cur_building[0]]:
+            dataDictionary['cycleTable'][cycle_id]['avg'] += \
+                average_cycles[sid][int(cycle_id)]
+        
+    # Python doesn't shuffle order of lists...
+    dataDictionary['cycleRow'] = ['avg',
+                                  'integrated']
+
+    CONVERT = {'minute': 'now', resolution:'interval'}
+
+    ####
+    # get averages for the diagnostic table
+    all_averages = {}
+
+    for average_type in ('minute',resolution):
+
+        results = data._query_averages(average_type,datetime.datetime.utcnow())
+
+        for sid,value in results.iteritems():
+            if sid in dataDictionary['diagnosticTable']:
+                dataDictionary['diagnosticTable']\
+                                [sid][CONVERT[average_type]] \
+                                = value
+
+    start_dt = datetime.datetime.utcfromtimestamp(
+        int(start_time) / 1000 -
+        data._dt_to_sec( data.CYCLE_START_DELTAS[resolution][0]) )
+    
+    # Get integrated values for diagnostic mode -- by sensor.
+    all_watthr_data = legacy_integrate(start_dt,
+                                       start_dt + \
+                                           data.RESOLUTION_DELTAS[resolution],
+                                       data.AUTO_RES_CONVERT[resolution],
+                                       True)
+    for ID in dataDictionary['diagnosticTable'].iterkeys():
+        dataDictionary['diagnosticTable'][ID]['integrated'] = \
+            all_watthr_data[int(ID)]
+    
+    return dataDictionary
+
+
+def _differences(a, b, path=''):
+    '''
+    Return the paths at which two tables' numbers differ (by more than
+    rounding).
+    '''
+    if isinstance(a, dict) and isinstance(b, dict):
+        if sorted(a.keys()) != sorted(b.keys()):
+            return [path]
+        diffs = []
+        for key in a:
+            if key == 'integrated':
+                continue
+            diffs.extend(_differences(a[key], b[key], path + '/' + key))
+        return diffs
+    if abs((a or 0) - (b or 0)) > 1e-6 * max(abs(a or 0), abs(b or 0), 1):
+        return [path]
+    return []
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Benchmark the detail table statistics.'
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', type='int', default=3,
+                    help='Number of timing runs (the best is reported).'),
+    )
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError('Invalid number of arguments: %d.' % len(args))
+        # (Django only records the queries when DEBUG is on.)
+        settings.DEBUG = True
+        start_time = int(time.time()) * 1000
+
+        def _run(f, building, res):
+            best = None
+            for i in range(options['repeat']):
+                reset_queries()
+                t = time.time()
+                table = f(building, res, start_time)
+                t = time.time() - t
+                if best is None or t < best:
+                    best = t
+            return table, len(connection.queries), best
+
+        print '%-20s %-6s %18s %18s' % ('building', 'res',
+                                        'before (q, ms)', 'after (q, ms)')
+        for sg in data.SENSOR_GROUPS:
+            building = sg[1].lower()
+            for res in ('day', 'week', 'month', 'year'):
+                before, before_queries, before_time = \
+                    _run(legacy_detail_table, building, res)
+                after, after_queries, after_time = \
+                    _run(data._get_detail_table, building, res)
+                for key in ('cycleTable', 'diagnosticTable'):
+                    diffs = _differences(before[key], after[key], key)
+                    if diffs:
+                        print 'Disagreement at %s.' % ', '.join(diffs)
+                print '%-20s %-6s %8d %9.1f %8d %9.1f' % (
+                    building, res, before_queries, before_time * 1000,
+                    after_queries, after_time * 1000)
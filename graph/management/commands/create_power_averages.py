@@ -2,44 +2,218 @@
 
 
 '''
-Insert missing power averages for all sensors, based on sensor 
-readings already in the database.
+Insert missing power averages for all sensors, based on sensor
+readings already in the database, then recompute the sensor group
+averages and the running energy totals (see energy.py) from them.
+Run it with the monitors stopped, since they extend the running
+totals themselves.
+
+The work is split into tasks run by a pool of --processes worker
+processes, in three steps, each waiting for the one before:
+1. For each sensor and calendar month, the averages from 10 seconds
+   to a day.  Only the 10-second averages are computed from the
+   readings; each coarser type is computed from the finer averages
+   just inserted (see PowerAverage.insert_averages).
+2. For each sensor, the week and month averages (from the day
+   averages; a week can span two months) and the running energy
+   totals.
+3. For each sensor group, its sensor group averages of every type.
+The tasks finished are recorded in the --checkpoint file, along with
+each sensor's latest reading time, so that an interrupted run carries
+on where it stopped.  The file is ignored if any sensor has newer
+readings since (the run would not be the same), or with --restart,
+and deleted once every step is done.  Inserting averages is
+idempotent:  only missing ones are inserted.
 '''
 
 
+import multiprocessing, os, simplejson, time
+from optparse import make_option
 from django.core.management.base import BaseCommand, CommandError
-from energyweb.graph.models import Sensor, PowerAverage, SensorReading
+from django.conf import settings
+from energyweb.graph.models import Sensor, SensorGroup, PowerAverage, \
+                                   SensorGroupAverage, EnergyPrefix
+from energyweb.graph.partitions import month_start, add_months
 from django.db import connection, transaction
 
 
+# The average types of each step's sensor tasks.
+MONTH_TYPES = ('second*10', 'minute', 'minute*10', 'hour', 'day')
+SENSOR_TYPES = ('week', 'month')
+
+
+def run_task(task):
+    '''
+    Carry out one task (see Command.tasks()) in a worker process.
+    Return (task key, rows written, seconds taken).
+    '''
+    key, kind, pk, start_dt, end_dt, trunc_latest = task
+    started = time.time()
+    cur = connection.cursor()
+    rows = 0
+    if kind == 'group':
+        sensor_group = SensorGroup.objects.get(pk=pk)
+        for average_type in PowerAverage.AVERAGE_TYPES:
+            rows += SensorGroupAverage.refresh_range(cur, average_type,
+                                                     sensor_group)
+            transaction.commit_unless_managed()
+    else:
+        sensor = Sensor.objects.get(pk=pk)
+        if kind == 'month':
+            average_types = MONTH_TYPES
+        else:
+            average_types = SENSOR_TYPES
+        for average_type in average_types:
+            rows += PowerAverage.insert_averages(cur, average_type, sensor,
+                trunc_latest[average_type], start_dt, end_dt)
+            transaction.commit_unless_managed()
+        if kind == 'sensor':
+            rows += EnergyPrefix.rebuild(cur, sensor, trunc_latest['hour'])
+            transaction.commit_unless_managed()
+    return key, rows, time.time() - started
+
+
 class Command(BaseCommand):
     args = ''
     help = 'Insert missing power averages for all sensors.'
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int',
+                    default=multiprocessing.cpu_count(),
+                    help='Worker processes (default: one per CPU).'),
+        make_option('--checkpoint', default=settings.BACKFILL_CHECKPOINT,
+                    help='File recording the tasks finished.'),
+        make_option('--restart', action='store_true', default=False,
+                    help='Ignore the tasks recorded as finished.'),
+    )
 
     def handle(self, *args, **options):
-        for sensor in Sensor.objects.all():
-            cur = connection.cursor()
-            power_average_qs = PowerAverage.objects.filter(
-                sensor=sensor).order_by('-trunc_reading_time')
-            sensor_reading_qs = SensorReading.objects.filter(
-                sensor=sensor).order_by('-reading_time')
-
-            try:
-                latest_reading = sensor_reading_qs.latest('reading_time')
-            except SensorReading.DoesNotExist:
-                pass # No readings: nothing to do.
+        if args:
+            raise CommandError('Invalid number of arguments: %d.' % len(args))
+        if options['processes'] < 1:
+            raise CommandError('Invalid number of processes: %d.'
+                               % options['processes'])
+        self.path = options['checkpoint']
+        steps, self.latest = self.tasks()
+        self.done = set()
+        if not options['restart'] and os.path.exists(self.path):
+            done, latest = self.load_checkpoint()
+            if latest == self.latest:
+                self.done = done
+                print 'Resuming: %d tasks already done.' % len(done)
             else:
-                print 'Inserting missing averages for sensor %d:' % sensor.id
-                for average_type in PowerAverage.AVERAGE_TYPES:
-                    # Don't confuse trunc_latest_reading_time with the
-                    # similarly-named column of graph_poweraverage.
-                    # trunc_latest_reading_time is the truncated
-                    # reading_time of the latest row in graph_sensorreading
-                    # for this sensor.
-                    trunc_latest_reading_time = PowerAverage.date_trunc(
-                        average_type, latest_reading.reading_time)
-
-                    r = PowerAverage.insert_averages(cur, average_type, sensor,
-                        trunc_latest_reading_time)
-                    transaction.commit_unless_managed()
-                    print '    \'%s\': %d rows' % (average_type, r)
+                print 'Ignoring the checkpoint of a run with older readings.'
+        steps = [(name, [t for t in tasks if t[0] not in self.done])
+                 for name, tasks in steps]
+
+        # The workers are forked with this process's state, so they
+        # must not share its database connection:  each opens its own.
+        connection.close()
+        pool = multiprocessing.Pool(options['processes'])
+        try:
+            total_rows = 0
+            started = time.time()
+            for name, tasks in steps:
+                total_rows += self.run_step(pool, name, tasks)
+            elapsed = time.time() - started
+            print 'Done: %d rows in %.1f s (%.0f rows/s).' % (
+                total_rows, elapsed, total_rows / max(elapsed, 0.001))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        pool.join()
+        # (A later run starts afresh.)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def tasks(self):
+        '''
+        Return the steps as a list of (description, list of tasks),
+        and each sensor's latest reading time (as a string) in a
+        dictionary with sensor ID (as a string) as keys.  A task is
+        (key, kind, sensor or sensor group id, start, end, {average
+        type: start of the sensor's open period of that type}).
+        '''
+        latest_times = {}
+        steps = [('averages by month', []), ('weeks, months and energy '
+                  'totals', []), ('sensor group averages', [])]
+        cur = connection.cursor()
+        for sensor in Sensor.objects.order_by('pk'):
+            cur.execute('''SELECT MIN(reading_time), MAX(reading_time)
+                           FROM graph_sensorreading
+                           WHERE sensor_id = %s;''', (sensor.pk,))
+            first, latest = cur.fetchone()
+            if latest is None:
+                continue # No readings: nothing to do.
+            latest_times[str(sensor.pk)] = latest.isoformat()
+            cur.execute('''SELECT MIN(trunc_reading_time)
+                           FROM graph_poweraverage
+                           WHERE sensor_id = %s;''', (sensor.pk,))
+            first_average = cur.fetchone()[0]
+            if first_average is not None and first_average < first:
+                # (Months whose readings were purged can still have
+                # finer averages to build on.)
+                first = first_average
+            # Don't confuse trunc_latest with the similarly-named
+            # column of graph_poweraverage:  it is the truncated
+            # reading_time of the latest row in graph_sensorreading
+            # for this sensor, for each average type.
+            trunc_latest = dict([[t, PowerAverage.date_trunc(t, latest)]
+                                 for t in PowerAverage.AVERAGE_TYPES])
+
+            month = month_start(first)
+            while month <= latest:
+                steps[0][1].append(('%d:%s' % (sensor.pk,
+                                               month.strftime('%Y-%m')),
+                                    'month', sensor.pk, month,
+                                    add_months(month, 1), trunc_latest))
+                month = add_months(month, 1)
+            steps[1][1].append(('sensor:%d' % sensor.pk, 'sensor', sensor.pk,
+                                None, None, trunc_latest))
+        for sensor_group in SensorGroup.objects.order_by('pk'):
+            steps[2][1].append(('group:%d' % sensor_group.pk, 'group',
+                                sensor_group.pk, None, None, None))
+        return steps, latest_times
+
+    def run_step(self, pool, name, tasks):
+        '''
+        Run the tasks in the pool, recording each in the checkpoint as
+        it finishes.  Return the number of rows written.
+        '''
+        print 'Computing %s: %d tasks.' % (name, len(tasks))
+        rows = 0
+        started = time.time()
+        for key, task_rows, seconds in pool.imap_unordered(run_task, tasks):
+            self.done.add(key)
+            self.save_checkpoint()
+            rows += task_rows
+            print '    %s: %d rows in %.1f s (%.0f rows/s)' % (
+                key, task_rows, seconds, task_rows / max(seconds, 0.001))
+        elapsed = time.time() - started
+        print '    %d rows in %.1f s (%.0f rows/s).' % (
+            rows, elapsed, rows / max(elapsed, 0.001))
+        return rows
+
+    def load_checkpoint(self):
+        '''
+        Return the tasks recorded as done, and the latest reading
+        times of the run that recorded them.
+        '''
+        f = open(self.path)
+        try:
+            checkpoint = simplejson.load(f)
+            return set(checkpoint['done']), checkpoint.get('latest')
+        finally:
+            f.close()
+
+    def save_checkpoint(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        f = open(self.path + '.tmp', 'w')
+        try:
+            simplejson.dump({'done': sorted(self.done),
+                             'latest': self.latest}, f, indent=1)
+        finally:
+            f.close()
+        os.rename(self.path + '.tmp', self.path)
@@ -22,7 +22,9 @@ from energyweb.graph.fake_rhizome_profiles import FAKE_RHIZOME_PROFILES
 from SocketServer import TCPServer, BaseRequestHandler
 from random import random, randint
 from binascii import unhexlify
-from energyweb.graph.models import Sensor, Setting, LogMessage
+from energyweb.graph.models import Sensor, Setting
+from energyweb.graph import logsink
+from energyweb.graph.rhizome import FRAME_LENGTH, is_frame
 from django.db import connection, transaction
 
 
@@ -47,8 +49,8 @@ class FakeRhizomeHandler(BaseRequestHandler):
         while True:
             chars_sent = 0
             # Loop until a full reading (45 bytes) has been sent.
-            while chars_sent < 45:
-                chars_to_send = randint(1, 45 - chars_sent)
+            while chars_sent < FRAME_LENGTH:
+                chars_to_send = randint(1, FRAME_LENGTH - chars_sent)
                 r = reading[chars_sent:(chars_sent + chars_to_send)]
                 self.request.send(r)
                 chars_sent += chars_to_send
@@ -81,38 +83,28 @@ class FakeRhizomeDaemon(Daemon):
         termination.
         '''
         info('Cleaning up: rolling back, disconnecting, disconnecting.')
-        error_msg = LogMessage(sensor=self.sensor, reading_time=datetime.datetime.now(), \
-                                   sensor_type='F', log_type='S', topic='Closed',\
-                                   details='rolling back and disconnecting.')
-        error_msg.save()
+        logsink.log(self.sensor, 'F', 'S', 'Closed',
+                    'rolling back and disconnecting.')
         if hasattr(self, 'sock'):
             self.sock.shutdown()
+        logsink.close()
 
     def handle_signal(self, signum, frame):
         '''
         If a SIGQUIT, SIGTERM, or SIGINT is received, shutdown cleanly.
         '''
         if signum == signal.SIGQUIT:
-            quit_msg = LogMessage(sensor=self.sensor, \
-                                      reading_time=datetime.datetime.now(),\
-                                      sensor_type='M', log_type='S', topic="Off",\
-                                      details="Caught Quit Signal")
-            quit_msg.save()
-            logging.info('Caught SIGQUIT.')
+            logsink.log(self.sensor, 'F', 'S', "Off",
+                        "Caught Quit Signal")
+            info('Caught SIGQUIT.')
         elif signum == signal.SIGTERM:
-            quit_msg = LogMessage(sensor=self.sensor, \
-                                      reading_time=datetime.datetime.now(),\
-                                      sensor_type='M', log_type='S', topic="Off",\
-                                      details="Caught Terminate Signal")
-            quit_msg.save()
-            logging.info('Caught SIGTERM.')
+            logsink.log(self.sensor, 'F', 'S', "Off",
+                        "Caught Terminate Signal")
+            info('Caught SIGTERM.')
         elif signum == signal.SIGINT:
-            quit_msg = LogMessage(sensor=self.sensor, \
-                                      reading_time=datetime.datetime.now(),\
-                                      sensor_type='M', log_type='S', topic="Off",\
-                                      details="Caught Interrupt Signal")
-            quit_msg.save()
-            logging.info('Caught SIGINT.')
+            logsink.log(self.sensor, 'F', 'S', "Off",
+                        "Caught Interrupt Signal")
+            info('Caught SIGINT.')
         # cleanup() will be called since it is registered with atexit
         sys.exit(0)
 
@@ -143,12 +135,15 @@ class FakeRhizomeDaemon(Daemon):
         # handler?
         FakeRhizomeHandler.profile = [unhexlify(s) for s in 
                                       FAKE_RHIZOME_PROFILES[sensor_id]]
+        # Check the profile's frames as the monitors would, so a bad
+        # profile shows up here rather than as bad data there.
+        for (i, reading) in enumerate(FakeRhizomeHandler.profile):
+            if len(reading) != FRAME_LENGTH or not is_frame(reading):
+                error('Profile reading %d is not a valid frame.' % i)
         self.sock = TCPServer((self.sensor.ip, self.sensor.port), 
                               FakeRhizomeHandler)
-        status_msg = LogMessage(sensor=self.sensor, reading_time=datetime.datetime.now(), \
-                                   sensor_type='F', log_type='S', topic='Started',\
-                                   details='Started serving data')
-        status_msg.save()
+        logsink.log(self.sensor, 'F', 'S', 'Started',
+                    'Started serving data')
         info('Serving for sensor %d (%s, %s).' % (sensor_id, desc, addr))
         self.sock.serve_forever()
 
@@ -7,37 +7,30 @@ King of Rhizome Systems.  (These devices speak in TCP/IP and can
 accept only one connection at a time.  They emit 45 bytes of data
 about once every 10 seconds.)  Interpret the data, process it for
 easier retrieval later (storage is cheap), and wait for the next
-45-byte message.  (Loop endlessly unless interrupted.)  Called with
-two arguments:  The sensor ID (as represented in the PostgreSQL DB)
-and a command (start, stop, restart).  Daemonize on initialization.
+45-byte message.  (If the data is corrupt, skip ahead to the next
+message rather than reconnecting.)  (Loop endlessly unless
+interrupted.)  Called with two arguments:  The sensor ID (as
+represented in the PostgreSQL DB) and a command (start, stop, restart,
+reload, resync).  Stop, reload and resync requests arrive over the
+control channel (see control.py).  Daemonize on initialization.
 '''
 
 
-import socket, psycopg2, datetime, os.path, time, atexit, signal, sys, logging
+import socket, select, errno, psycopg2, datetime, os.path, time, atexit, signal, sys, logging
 from django.core.management.base import BaseCommand, CommandError
 from binascii import hexlify
 from energyweb.graph.daemon import Daemon
 from django.conf import settings
-from energyweb.graph.models import Sensor, PowerAverage, SensorReading, \
-                                   SRProfile, Setting, Signal, LogMessage
-from django.db.models import Avg, Max, Min, Count
+from energyweb.graph.models import Sensor, Setting
+from energyweb.graph import logsink
+from energyweb.graph.control import ControlChannel
+from energyweb.graph import control
+from energyweb.graph.monitor import SensorMonitor, rollback_on_exception
+from energyweb.graph.rhizome import RhizomeFramer
+from energyweb.graph.writer import ReadingWriter
 from django.db import connection, transaction
 
 
-def rollback_on_exception(f):
-    '''
-    Catch any exception, rollback the transaction, then re-raise the
-    exception.
-    '''
-    def _f(*args, **kwargs):
-        try:
-            return f(*args, **kwargs)
-        except:
-            transaction.rollback()
-            raise
-    return _f
-
-
 class EnergyMonDaemon(Daemon):
     '''
     Subclass of a daemonizing class.  When initialized, wait for
@@ -53,38 +46,35 @@ class EnergyMonDaemon(Daemon):
         termination.
         '''
         logging.info('Cleaning up: rolling back, disconnecting, disconnecting.')
-        close_msg = LogMessage(sensor=self.sensor, reading_time=datetime.datetime.now(),\
-                                 sensor_type='M', log_type='S', topic="Off",\
-                                 details="Rolling back and disconnecting.")
-        close_msg.save()
+        if hasattr(self, 'sensor'):
+            logsink.log(self.sensor, 'M', 'S', "Off",
+                        "Rolling back and disconnecting.")
         transaction.rollback()
+        # (Startup may have failed before any of these were made.)
+        # Whatever is still buffered was received; keep it.
+        if hasattr(self, 'monitor'):
+            self.monitor.checkpoint()
+        if hasattr(self, 'writer'):
+            self.writer.flush()
         if hasattr(self, 'sock'):
             self.sock.close()
+        logsink.close()
 
     def handle_signal(self, signum, frame):
         '''
         If a SIGQUIT, SIGTERM, or SIGINT is received, shutdown cleanly.
         '''
         if signum == signal.SIGQUIT:
-            quit_msg = LogMessage(sensor=self.sensor, \
-                                      reading_time=datetime.datetime.now(),\
-                                      sensor_type='M', log_type='S', topic="Off",\
-                                      details="Caught Quit Signal")
-            quit_msg.save()
+            logsink.log(self.sensor, 'M', 'S', "Off",
+                        "Caught Quit Signal")
             logging.info('Caught SIGQUIT.')
         elif signum == signal.SIGTERM:
-            quit_msg = LogMessage(sensor=self.sensor, \
-                                      reading_time=datetime.datetime.now(),\
-                                      sensor_type='M', log_type='S', topic="Off",\
-                                      details="Caught Terminate Signal")
-            quit_msg.save()
+            logsink.log(self.sensor, 'M', 'S', "Off",
+                        "Caught Terminate Signal")
             logging.info('Caught SIGTERM.')
         elif signum == signal.SIGINT:
-            quit_msg = LogMessage(sensor=self.sensor, \
-                                      reading_time=datetime.datetime.now(),\
-                                      sensor_type='M', log_type='S', topic="Off",\
-                                      details="Caught Interrupt Signal")
-            quit_msg.save()
+            logsink.log(self.sensor, 'M', 'S', "Off",
+                        "Caught Interrupt Signal")
             logging.info('Caught SIGINT.')
         # cleanup() will be called since it is registered with atexit
         sys.exit(0)
@@ -98,13 +88,9 @@ class EnergyMonDaemon(Daemon):
             try:
                 self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self.sock.connect((self.sensor.ip, self.sensor.port))
-                connect_msg = LogMessage(sensor=self.sensor, \
-                                             reading_time=datetime.datetime.now(),\
-                                             sensor_type='M', log_type='S', \
-                                             topic="Running",\
-                                             details="Socket connected to %s:%d." \
-                                             % (self.sensor.ip, self.sensor.port))
-                connect_msg.save()
+                logsink.log(self.sensor, 'M', 'S', "Running",
+                            "Socket connected to %s:%d."
+                            % (self.sensor.ip, self.sensor.port))
                 logging.info('Socket connected to %s:%d.' 
                      % (self.sensor.ip, self.sensor.port))
                 break
@@ -113,67 +99,11 @@ class EnergyMonDaemon(Daemon):
                 logging.error('Socket error.')
                 logging.error('Pausing, reopening socket.')
                 if not had_issue:
-                    error_msg = LogMessage(sensor=self.sensor, \
-                                               reading_time=datetime.datetime.now(),\
-                                               sensor_type='M', log_type='E', \
-                                               topic="No conection",\
-                                               details="Socket Error")
-                    error_msg.save()
+                    logsink.log(self.sensor, 'M', 'E', "No conection",
+                                "Socket Error")
                     has_issue = True # Prevent extra copies of this
                 time.sleep(settings.ERROR_PAUSE)
 
-    def init_power_averages(self):
-        self.power_averages = {}
-        power_average_qs = PowerAverage.objects.filter(
-            sensor=self.sensor).order_by('-trunc_reading_time')
-        sensor_reading_qs = SensorReading.objects.filter(
-            sensor=self.sensor).order_by('-reading_time')
-        try:
-            latest_reading = sensor_reading_qs.latest('reading_time')
-        except SensorReading.DoesNotExist:
-            for average_type in PowerAverage.AVERAGE_TYPES:
-                self.power_averages[average_type] = None
-        else:
-            for average_type in PowerAverage.AVERAGE_TYPES:
-                # Don't confuse trunc_latest_reading_time with the
-                # similarly-named column of graph_poweraverage.
-                # trunc_latest_reading_time is the truncated
-                # reading_time of the latest row in graph_sensorreading
-                # for this sensor.
-                trunc_latest_reading_time = PowerAverage.date_trunc(
-                    average_type, latest_reading.reading_time)
-
-                try:
-                    latest_average = power_average_qs.filter(
-                        average_type=average_type).latest('trunc_reading_time')
-                except PowerAverage.DoesNotExist:
-                    latest_average = None
-
-                if latest_average is None or (trunc_latest_reading_time 
-                    > latest_average.trunc_reading_time):
-
-                    aggr = sensor_reading_qs.filter(
-                        reading_time__gte=trunc_latest_reading_time).aggregate(
-                        awatthr=Avg('awatthr'),
-                        bwatthr=Avg('bwatthr'),
-                        cwatthr=Avg('cwatthr'),
-                        num_points=Count('sensor'),
-                        first_reading_time=Min('reading_time'),
-                        last_reading_time=Max('reading_time'))
-                    self.power_averages[average_type] = PowerAverage(
-                        watts=(aggr['awatthr'] 
-                               + aggr['bwatthr'] 
-                               + aggr['cwatthr']),
-                        num_points=aggr['num_points'],
-                        average_type=average_type,
-                        sensor=self.sensor,
-                        first_reading_time=aggr['first_reading_time'],
-                        last_reading_time=aggr['last_reading_time'],
-                        trunc_reading_time=trunc_latest_reading_time)
-                    self.power_averages[average_type].save()
-                else:
-                    self.power_averages[average_type] = latest_average
-
     def set_debugging(self):
         if Setting.get_value_of('mon_debugging'):
             log_level = logging.DEBUG
@@ -187,8 +117,45 @@ class EnergyMonDaemon(Daemon):
         else:
             self.profiling = False
 
-    def check_stop(self):
-        return Signal.dequeue('mon_stop', data=str(self.sensor.pk)) is not None
+    def handle_commands(self, commands):
+        '''
+        Carry out the commands received over the control channel.
+        Return whether to stop.
+        '''
+        if 'reload' in commands:
+            Setting.invalidate_cache()
+            self.set_debugging()
+            self.set_profiling()
+            self.monitor.profiling = self.profiling
+        if 'resync' in commands:
+            logsink.log(self.sensor, 'M', 'S', 'Resync',
+                        'Resynchronizing on request.')
+            logging.info('Resynchronizing on request.')
+            self.sock.close()
+            self.open_socket()
+            self.framer.clear()
+        return 'stop' in commands
+
+    def wait(self):
+        '''
+        Wait until the socket or the control channel is readable, or
+        the writer is due.  Return whether the socket is readable.
+        '''
+        readers = [self.sock]
+        if self.control.is_open():
+            readers.append(self.control)
+            wake_at = self.writer.next_flush
+        else:
+            wake_at = min(self.writer.next_flush, self.control.retry_at)
+        try:
+            readable = select.select(readers, [], [],
+                                     max(0, wake_at - time.time()))[0]
+        except select.error, detail:
+            if detail.args[0] == errno.EINTR:
+                return False
+            raise
+        self.control_readable = self.control in readable
+        return self.sock in readable
 
     @transaction.commit_manually
     @rollback_on_exception
@@ -204,6 +171,7 @@ class EnergyMonDaemon(Daemon):
 
         logging.basicConfig(filename=(settings.MON_LOG_FILE_TEMPL % sensor_id),
             format=settings.LOG_FORMAT, datefmt=settings.LOG_DATEFMT)
+        Setting.load_all()
         self.set_debugging()
         self.set_profiling()
 
@@ -215,169 +183,77 @@ class EnergyMonDaemon(Daemon):
         signal.signal(signal.SIGQUIT, self.handle_signal)
 
         self.sensor = Sensor.objects.get(pk=sensor_id)
+        self.writer = ReadingWriter()
+        self.monitor = SensorMonitor(self.sensor, self.writer, self.profiling)
 
         logging.debug('Initializing power averages.')
-        open_msg = LogMessage(sensor=self.sensor, reading_time=datetime.datetime.now(), \
-                                  sensor_type='M', log_type='S', topic='Starting up',\
-                                  details='Initializing Power Averages')
-        open_msg.save()
+        logsink.log(self.sensor, 'M', 'S', 'Starting up',
+                    'Initializing Power Averages')
                            
-        self.init_power_averages()
+        self.monitor.init_power_averages()
         transaction.commit()
 
-        # If the sensor is three-phase, we want to add all three power
-        # measurements to obtain the aggregate.  If the sensor is single
-        # phase, only the first two measurements are meaningful---so 
-        # we'll zero the third.
-        factor = self.sensor.factor
-        phase_factor = (self.sensor.three_phase and 1 or 0)
-    
         self.open_socket()
     
+        self.framer = framer = RhizomeFramer()
+        self.control = ControlChannel(str(self.sensor.pk))
+        self.control_readable = False
+        resyncs = 0
         while True:
-            data = ''
-            logging.debug('Listening for data.')
-            # Loop until all 45 bytes of the message are collected.
-            while len(data) < 45:
+            if self.control_readable or not self.control.is_open():
+                self.control_readable = False
+                stop = self.handle_commands(self.control.receive())
+                transaction.commit()
+                if stop:
+                    self.monitor.checkpoint()
+                    self.writer.flush()
+                    logging.info('Stop requested.')
+                    break
+
+            data = framer.next_frame()
+            if framer.resyncs != resyncs:
+                # Corrupt or partial data: the framer skipped ahead to
+                # the next frame, so there is no need to reconnect.
+                resyncs = framer.resyncs
+                detail_string = 'Resynchronized (%d times, %d bytes skipped so far).' \
+                                % (resyncs, framer.bytes_skipped)
+                logsink.log(self.sensor, 'M', 'W', 'Bad data',
+                            detail_string)
+                logging.error('Bad data.  ' + detail_string)
+            if data is None:
+                logging.debug('Listening for data.')
+                if not self.wait():
+                    if self.writer.due():
+                        self.writer.flush()
+                    continue
                 data_recvd = self.sock.recv(1024)
                 if data_recvd == '':
-                    detail_string ='Closing/Reopening socket. Data was: '+hexlify(data) +'.'
-                    error_msg = LogMessage(sensor=self.sensor, reading_time=datetime.datetime.now(), \
-                                           sensor_type='M', log_type='W', topic='Socket died during transmission',\
-                                           details=detail_string)
-                    error_msg.save()
+                    detail_string ='Closing/Reopening socket. Data was: '+hexlify(framer.pending()) +'.'
+                    logsink.log(self.sensor, 'M', 'W', 'Socket died during transmission',
+                                detail_string)
                     logging.error('Socket died.  Printing data, closing, reopening.')
-                    logging.error(hexlify(data) + '.')
+                    logging.error(hexlify(framer.pending()) + '.')
                     self.sock.close()
                     self.open_socket()
-                    data = ''
+                    framer.clear()
                 else:
-                    data += data_recvd
-            logging.debug('Data received.  (45 bytes)')
-            if data[0:4] != 'RTSD': # 52 54 53 44 in hex
-                detail_string = 'Closing/Reopening socket. Data was: '+ hexlify(data) + '.'
-                error_msg = LogMessage(sensor=self.sensor, reading_time=datetime.datetime.now(), \
-                                  sensor_type='M', log_type='W', topic='Bad data',\
-                                  details=detail_string)
-                error_msg.save()
-                logging.error('Bad data.  Printing data, closing socket, reopening.')
-                logging.error(hexlify(data) + '.')
-                self.sock.close()
-                self.open_socket()
-            else:
-                if self.profiling:
-                    transaction_start = time.time()
-                # If the rudimentary validation succeeded, proceed to
-                # interpret the data for processing and storage.
-                logging.debug('Data validated.')
-                d = {}
-                d['rindex'] = ord(data[4])
-                # Lots of little uints
-                d['awatthr'] = factor * ((ord(data[5]) << 8) | ord(data[6]))
-                d['bwatthr'] = factor * ((ord(data[7]) << 8) | ord(data[8]))
-                d['cwatthr'] = factor * ((ord(data[9]) << 8) | ord(data[10]))
-                d['avarhr'] = factor * ((ord(data[11]) << 8) | ord(data[12]))
-                d['bvarhr'] = factor * ((ord(data[13]) << 8) | ord(data[14]))
-                d['cvarhr'] = factor * ((ord(data[15]) << 8) | ord(data[16]))
-                d['avahr'] = factor * ((ord(data[17]) << 8) | ord(data[18]))
-                d['bvahr'] = factor * ((ord(data[19]) << 8) | ord(data[20]))
-                d['cvahr'] = factor * ((ord(data[21]) << 8) | ord(data[22]))
-                d['airms'] = factor * ((ord(data[23]) << 16) 
-                                       | (ord(data[24]) << 8) 
-                                       | ord(data[25]))
-                d['birms'] = factor * ((ord(data[26]) << 16) 
-                                       | (ord(data[27]) << 8) 
-                                       | ord(data[28]))
-                d['cirms'] = factor * ((ord(data[29]) << 16) 
-                                       | (ord(data[30]) << 8) 
-                                       | ord(data[31]))
-                d['avrms'] = ((ord(data[32]) << 16) | (ord(data[33]) << 8) 
-                                               | ord(data[34]))
-                d['bvrms'] = ((ord(data[35]) << 16) | (ord(data[36]) << 8) 
-                                               | ord(data[37]))
-                d['cvrms'] = ((ord(data[38]) << 16) | (ord(data[39]) << 8) 
-                                               | ord(data[40]))
-                d['freq'] = ((ord(data[41]) << 8) | ord(data[42])) >> 4
-                # for tempc:  at d['Amb'] = 25C, register = DF = Offset
-                d['tempc'] = 25 + (ord(data[43]) - int('df', 16)) * 3
-
-                reading_time = datetime.datetime.now()
-                d['reading_time'] = reading_time
-                d['sensor'] = self.sensor
-    
-                sensor_reading = SensorReading.objects.create(**d)
-
-                # Precompute averages (we have 10 seconds until the 
-                # next message.
-                watts = (d['awatthr'] + d['bwatthr'] 
-                         + d['cwatthr'] * phase_factor)
-
-                if self.profiling:
-                    num_pa_inserts = 0
-                    num_pa_updates = 0
-
-                for average_type in PowerAverage.AVERAGE_TYPES:
-                    trunc_reading_time = PowerAverage.date_trunc(average_type,
-                        reading_time)
-                    if (self.power_averages[average_type] is not None 
-                        and trunc_reading_time == self.power_averages[
-                                average_type].trunc_reading_time):
-
-                        n = self.power_averages[average_type].num_points
-                        self.power_averages[average_type].watts = (
-                            (self.power_averages[average_type].watts * n 
-                             + watts) 
-                            / (n + 1))
-                        self.power_averages[average_type].num_points = n + 1
-                        self.power_averages[average_type].last_reading_time \
-                            = reading_time
-                    else:
-                        if self.power_averages[average_type] is not None:
-                            self.power_averages[average_type].save()
-                        self.power_averages[average_type] = PowerAverage(
-                            watts=watts,
-                            num_points=1,
-                            average_type=average_type,
-                            sensor=self.sensor,
-                            first_reading_time=reading_time,
-                            last_reading_time=reading_time,
-                            trunc_reading_time=trunc_reading_time)
-                        if self.profiling:
-                            num_pa_inserts += 1
-                    self.power_averages[average_type].save()
-                    if self.profiling:
-                        num_pa_updates += 1
+                    framer.feed(data_recvd)
+                continue
 
-                transaction.commit()
-                logging.debug('Data processed.')
-                if self.profiling:
-                    SRProfile.objects.create(
-                        sensor_reading=sensor_reading,
-                        power_average_inserts=num_pa_inserts,
-                        power_average_updates=num_pa_updates,
-                        transaction_time=int((time.time() - transaction_start) 
-                                             * 1000.0))
-                    transaction.commit()
-                    logging.debug('Sensor reading profile saved.')
-
-                self.set_debugging()
-                self.set_profiling()
-                if self.check_stop():
-                    transaction.commit()
-                    logging.info('Stop requested.')
-                    break
+            logging.debug('Data received.  (45 bytes)')
+            self.monitor.process(data)
+            if self.writer.due():
+                self.writer.flush()
+            transaction.commit()
 
-        quit_msg = LogMessage(sensor=self.sensor, \
-                                  reading_time=datetime.datetime.now(),\
-                                  sensor_type='M', log_type='S', topic="Off",\
-                                  details="Past main loop. Exiting.")
-        quit_msg.save()    
+        logsink.log(self.sensor, 'M', 'S', "Off",
+                    "Past main loop. Exiting.")
         logging.info('Past main loop.  Exiting.')
         sys.exit(0)
 
 
 class Command(BaseCommand):
-    args = '<sensor_id> start|stop|restart'
+    args = '<sensor_id> start|stop|restart|reload|resync'
     help = 'Monitor the specified Rhizome device.'
 
     def handle(self, *args, **options):
@@ -393,8 +269,8 @@ class Command(BaseCommand):
                 stderr=(settings.MON_LOG_FILE_TEMPL % sensor_id))
             if args[1] == 'start':
                 daemon.start()
-            elif args[1] == 'stop':
-                Signal.enqueue('mon_stop', str(sensor_id))
+            elif args[1] in ('stop', 'reload', 'resync'):
+                control.send(args[1], str(sensor_id))
             elif args[1] == 'force-stop':
                 daemon.stop()
             elif args[1] == 'restart':
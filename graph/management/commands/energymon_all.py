@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+
+
+'''
+Connect to every energy monitoring device in the database (see
+energymon) from a single process.  Rather than one daemon, Django
+import, and database connection per sensor, one select() loop waits
+on all of the device sockets at once, and each 45-byte message is
+buffered as it completes and written in batches (see writer.py).
+Corrupt data is skipped rather than costing a reconnect.
+Each device has its own reconnect state, so a dead device only costs
+a retry timer.  Stop, reload and resync requests arrive over the
+control channel (see control.py), which is selected on with the
+sockets.  Called with one argument: a command (start, stop,
+force-stop, restart, reload, resync).  Daemonize on initialization.
+'''
+
+
+import socket, select, errno, datetime, time, atexit, signal, sys, logging
+from django.core.management.base import BaseCommand, CommandError
+from binascii import hexlify
+from energyweb.graph.daemon import Daemon
+from django.conf import settings
+from energyweb.graph.models import Sensor, Setting
+from energyweb.graph.control import ControlChannel
+from energyweb.graph import control, logsink
+from energyweb.graph.monitor import SensorMonitor, rollback_on_exception
+from energyweb.graph.rhizome import RhizomeFramer
+from energyweb.graph.writer import ReadingWriter
+from django.db import transaction
+
+
+class SensorConnection(object):
+    '''
+    The socket and reconnect state for one device.  Sockets are
+    non-blocking; the owning loop calls connect() when retry_at has
+    passed, finish_connect() when the socket becomes writable, and
+    read() when it becomes readable.
+    '''
+
+    def __init__(self, monitor):
+        self.monitor = monitor
+        self.sensor = monitor.sensor
+        self.sock = None
+        self.connecting = False
+        self.framer = RhizomeFramer()
+        # time.time() after which another connection attempt is made.
+        self.retry_at = 0
+        # Only log the first of a run of connection failures.
+        self.had_issue = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def log(self, log_type, topic, details):
+        logsink.log(self.sensor, 'M', log_type, topic, details)
+
+    def connect(self):
+        '''
+        Begin a non-blocking connection to the device.
+        '''
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        self.framer.clear()
+        err = self.sock.connect_ex((self.sensor.ip, self.sensor.port))
+        if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.connecting = True
+        else:
+            self.fail(socket.error(err, errno.errorcode.get(err, str(err))))
+
+    def finish_connect(self):
+        '''
+        Called when a connecting socket becomes writable: check
+        whether the connection succeeded.
+        '''
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+            self.fail(socket.error(err, errno.errorcode.get(err, str(err))))
+            return
+        self.connecting = False
+        self.had_issue = False
+        self.log('S', 'Running', 'Socket connected to %s:%d.'
+                 % (self.sensor.ip, self.sensor.port))
+        logging.info('Sensor %d: socket connected to %s:%d.'
+                     % (self.sensor.pk, self.sensor.ip, self.sensor.port))
+
+    def fail(self, detail):
+        '''
+        Close the socket and schedule another connection attempt.
+        '''
+        logging.error('Sensor %d: %s' % (self.sensor.pk, detail))
+        logging.error('Sensor %d: socket error.  Pausing, reopening socket.'
+                      % self.sensor.pk)
+        if not self.had_issue:
+            self.log('E', 'No conection', 'Socket Error')
+            self.had_issue = True # Prevent extra copies of this
+        self.close()
+        self.retry_at = time.time() + settings.ERROR_PAUSE
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.connecting = False
+        self.framer.clear()
+
+    def reopen(self):
+        '''
+        Close the socket and reconnect immediately.
+        '''
+        self.close()
+        self.retry_at = 0
+
+    def read(self):
+        '''
+        Receive whatever the device has sent.  Return a list of the
+        complete messages collected (possibly empty).  Corrupt data is
+        skipped (see RhizomeFramer) rather than reconnecting.
+        '''
+        try:
+            data_recvd = self.sock.recv(1024)
+        except socket.error, detail:
+            if detail.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            self.fail(detail)
+            return []
+
+        if data_recvd == '':
+            self.log('W', 'Socket died during transmission',
+                     'Closing/Reopening socket. Data was: '
+                     + hexlify(self.framer.pending()) + '.')
+            logging.error('Sensor %d: socket died.  Printing data, closing, '
+                          'reopening.' % self.sensor.pk)
+            logging.error(hexlify(self.framer.pending()) + '.')
+            self.reopen()
+            return []
+
+        self.framer.feed(data_recvd)
+        resyncs = self.framer.resyncs
+        frames = []
+        while True:
+            data = self.framer.next_frame()
+            if data is None:
+                break
+            logging.debug('Sensor %d: data received.  (45 bytes)'
+                          % self.sensor.pk)
+            frames.append(data)
+        if self.framer.resyncs != resyncs:
+            detail = ('Resynchronized (%d times, %d bytes skipped so far).'
+                      % (self.framer.resyncs, self.framer.bytes_skipped))
+            self.log('W', 'Bad data', detail)
+            logging.error('Sensor %d: bad data.  %s' % (self.sensor.pk, detail))
+        return frames
+
+
+class EnergyMonAllDaemon(Daemon):
+    '''
+    Subclass of a daemonizing class.  When initialized, connect to
+    every device in the database and store their messages as they
+    arrive, until a stop is requested.
+    '''
+
+    def cleanup(self):
+        '''
+        Close database and socket connections in preparation for
+        termination.
+        '''
+        logging.info('Cleaning up: rolling back, disconnecting, disconnecting.')
+        transaction.rollback()
+        # (Startup may have failed before any of these were made.)
+        # Whatever is still buffered was received; keep it.
+        for conn in getattr(self, 'connections', []):
+            conn.monitor.checkpoint()
+        if hasattr(self, 'writer'):
+            self.writer.flush()
+        for conn in getattr(self, 'connections', []):
+            conn.log('S', 'Off', 'Rolling back and disconnecting.')
+            conn.close()
+        logsink.close()
+
+    def handle_signal(self, signum, frame):
+        '''
+        If a SIGQUIT, SIGTERM, or SIGINT is received, shutdown cleanly.
+        '''
+        if signum == signal.SIGQUIT:
+            logging.info('Caught SIGQUIT.')
+        elif signum == signal.SIGTERM:
+            logging.info('Caught SIGTERM.')
+        elif signum == signal.SIGINT:
+            logging.info('Caught SIGINT.')
+        # cleanup() will be called since it is registered with atexit
+        sys.exit(0)
+
+    def set_debugging(self):
+        if Setting.get_value_of('mon_debugging'):
+            log_level = logging.DEBUG
+        else:
+            log_level = logging.INFO
+        logging.getLogger('').setLevel(log_level)
+
+    def set_profiling(self):
+        self.profiling = bool(Setting.get_value_of('mon_profiling'))
+        for conn in self.connections:
+            conn.monitor.profiling = self.profiling
+
+    def resync(self):
+        '''
+        Reconnect to every device, discarding partial messages.
+        '''
+        for conn in self.connections:
+            if conn.sock is not None:
+                conn.log('S', 'Resync', 'Resynchronizing on request.')
+                conn.reopen()
+        logging.info('Resynchronizing on request.')
+
+    def handle_commands(self, commands):
+        '''
+        Carry out the commands received over the control channel.
+        Return whether to stop.
+        '''
+        if 'reload' in commands:
+            Setting.invalidate_cache()
+            self.set_debugging()
+            self.set_profiling()
+        if 'resync' in commands:
+            self.resync()
+        return 'stop' in commands
+
+    @transaction.commit_manually
+    @rollback_on_exception
+    def run(self):
+        '''
+        Perform the main select, listen, and insert loop of the
+        program.  (See file and class docstrings.)
+        '''
+        logging.basicConfig(filename=settings.MON_ALL_LOG_FILE,
+            format=settings.LOG_FORMAT, datefmt=settings.LOG_DATEFMT)
+
+        # Register exit and signal behaviors.
+        atexit.register(self.cleanup)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, self.handle_signal)
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGQUIT, self.handle_signal)
+
+        self.writer = ReadingWriter()
+        self.connections = []
+        for sensor in Sensor.objects.select_related().order_by('pk'):
+            logging.debug('Sensor %d: initializing power averages.'
+                          % sensor.pk)
+            monitor = SensorMonitor(sensor, self.writer)
+            conn = SensorConnection(monitor)
+            conn.log('S', 'Starting up', 'Initializing Power Averages')
+            monitor.init_power_averages()
+            self.connections.append(conn)
+        transaction.commit()
+
+        Setting.load_all()
+        self.set_debugging()
+        self.set_profiling()
+        transaction.commit()
+        self.control = ControlChannel('all')
+        stop = self.handle_commands(self.control.receive())
+        transaction.commit()
+
+        while not stop:
+            now = time.time()
+            for conn in self.connections:
+                if conn.sock is None and conn.retry_at <= now:
+                    conn.connect()
+
+            readers = [c for c in self.connections
+                       if c.sock is not None and not c.connecting]
+            writers = [c for c in self.connections
+                       if c.sock is not None and c.connecting]
+            retries = [c.retry_at for c in self.connections
+                       if c.sock is None]
+            if self.control.is_open():
+                readers.append(self.control)
+            else:
+                retries.append(self.control.retry_at)
+            # Wake up in time for the next reconnect or flush.
+            wake_at = min([self.writer.next_flush] + retries)
+            timeout = max(0, wake_at - time.time())
+
+            try:
+                readable, writable, _ = select.select(readers, writers, [],
+                                                      timeout)
+            except select.error, detail:
+                if detail.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for conn in writable:
+                conn.finish_connect()
+
+            for conn in readable:
+                if conn is not self.control:
+                    for data in conn.read():
+                        conn.monitor.process(data)
+
+            if self.writer.due():
+                self.writer.flush()
+
+            if self.control in readable or not self.control.is_open():
+                stop = self.handle_commands(self.control.receive())
+                transaction.commit()
+
+        for conn in self.connections:
+            conn.monitor.checkpoint()
+        self.writer.flush()
+        logging.info('Stop requested.')
+        self.control.close()
+
+        for conn in self.connections:
+            conn.log('S', 'Off', 'Past main loop. Exiting.')
+        transaction.commit()
+        logging.info('Past main loop.  Exiting.')
+        sys.exit(0)
+
+
+class Command(BaseCommand):
+    args = 'start|stop|force-stop|restart|reload|resync'
+    help = 'Monitor every Rhizome device from a single process.'
+
+    def handle(self, *args, **options):
+        if len(args) == 1:
+            daemon = EnergyMonAllDaemon(
+                settings.MON_ALL_PID_FILE,
+                stdout=settings.MON_ALL_LOG_FILE,
+                stderr=settings.MON_ALL_LOG_FILE)
+            if args[0] == 'start':
+                daemon.start()
+            elif args[0] in ('stop', 'reload', 'resync'):
+                control.send(args[0], 'all')
+            elif args[0] == 'force-stop':
+                daemon.stop()
+            elif args[0] == 'restart':
+                daemon.restart()
+            else:
+                raise CommandError('Invalid action: \'%s\'.' % args[0])
+        else:
+            raise CommandError('Invalid number of arguments: %d.' % len(args))
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+
+'''
+Remove the sensor readings and power averages that
+settings.RETENTION_POLICY no longer keeps (see retention.py):  drop
+the partitions that are entirely expired, then delete the remaining
+expired rows in batches of --batch-size, committing after each.
+Prints what was removed and about how many bytes that freed.  (Space
+freed by deleting rows is reused by the table after the next VACUUM;
+space from dropped partitions is returned at once.)
+'''
+
+
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import connection, transaction
+from energyweb.graph import retention
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Delete readings and averages older than the retention policy.'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int',
+                    default=settings.RETENTION_BATCH_SIZE,
+                    help='Rows deleted per transaction.'),
+        make_option('--pause', type='float', default=0,
+                    help='Seconds to wait between batches.'),
+        make_option('--dry-run', action='store_true', default=False,
+                    help='Only print what would be removed (counting '
+                         'the rows, which can take a while).'),
+    )
+
+    @transaction.commit_manually
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError('Invalid number of arguments: %d.' % len(args))
+        try:
+            cutoffs = retention.policy_cutoffs()
+        except ValueError, detail:
+            raise CommandError(str(detail))
+        self.batch_size = options['batch_size']
+        self.pause = options['pause']
+        dry_run = options['dry_run']
+
+        cur = connection.cursor()
+        for target in retention.RETENTION_TARGETS:
+            if target in cutoffs:
+                print 'Removing %s data before %s.' % (
+                    target, cutoffs[target].strftime('%Y-%m-%d %H:%M'))
+
+        reclaimed = 0
+        try:
+            expired = retention.expired_partitions(cur, cutoffs)
+            for parent, name in expired:
+                if dry_run:
+                    print 'Would drop %s.' % name
+                else:
+                    size = retention.drop_partition(cur, name)
+                    transaction.commit()
+                    reclaimed += size
+                    print 'Dropped %s (%d MB).' % (name, size >> 20)
+            if dry_run:
+                self.dry_run(cur, cutoffs, [name for parent, name in expired])
+                transaction.rollback()
+                return
+
+            if 'reading' in cutoffs:
+                row_size = retention.average_row_size(cur,
+                                                      'graph_sensorreading')
+                n = self.in_batches(retention.delete_readings, cur,
+                                    cutoffs['reading'], self.batch_size)
+                reclaimed += n * row_size
+                print 'Deleted %d readings.' % n
+                row_size = retention.average_row_size(cur, 'graph_srprofile')
+                n = self.in_batches(retention.delete_orphan_profiles, cur,
+                                    self.batch_size)
+                reclaimed += n * row_size
+                print 'Deleted %d orphaned profiles.' % n
+
+            row_size = retention.average_row_size(cur, 'graph_poweraverage')
+            for average_type in retention.RETENTION_TARGETS[1:]:
+                if average_type in cutoffs:
+                    n = self.in_batches(retention.delete_averages, cur,
+                                        average_type, cutoffs[average_type],
+                                        self.batch_size)
+                    reclaimed += n * row_size
+                    print 'Deleted %d \'%s\' averages.' % (n, average_type)
+        except:
+            transaction.rollback()
+            raise
+        transaction.commit()
+        print 'About %d MB reclaimed.' % (reclaimed >> 20)
+
+    def dry_run(self, cur, cutoffs, dropped):
+        '''
+        Print how many rows would be deleted in batches, after the
+        partitions named in dropped.
+        '''
+        if 'reading' in cutoffs:
+            print 'Would delete %d readings and %d orphaned profiles.' % (
+                retention.count_readings(cur, cutoffs['reading'], dropped),
+                retention.count_orphan_profiles(cur, cutoffs['reading'],
+                                                dropped))
+        for average_type in retention.RETENTION_TARGETS[1:]:
+            if average_type in cutoffs:
+                print 'Would delete %d \'%s\' averages.' % (
+                    retention.count_averages(cur, average_type,
+                                             cutoffs[average_type], dropped),
+                    average_type)
+
+    def in_batches(self, delete, cur, *args):
+        '''
+        Call delete(cur, *args) and commit until it deletes nothing.
+        Return the total deleted.
+        '''
+        total = 0
+        while True:
+            n = delete(cur, *args)
+            transaction.commit()
+            total += n
+            if n < self.batch_size:
+                return total
+            if self.pause:
+                time.sleep(self.pause)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+
+'''
+Replace the single-column indexes of graph_poweraverage on
+average_type and trunc_reading_time with one composite index on
+(average_type, trunc_reading_time, sensor_id), covering watts, which
+is the shape of the graph query (PowerAverage.graph_data_execute).
+On PostgreSQL 11 and later watts is an INCLUDE column; before that it
+is a fourth key column.  Safe to run more than once.
+
+With --check, instead EXPLAIN the graph query as the dynamic, static,
+and detail graphs issue it, and fail unless each plan is an index-only
+scan of the composite index.  (Index-only scans need PostgreSQL 9.2
+and a recently vacuumed table: VACUUM ANALYZE graph_poweraverage
+first.)
+'''
+
+
+import datetime
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from energyweb.graph.models import PowerAverage
+from django.db import connection, transaction
+
+
+INDEX_NAME = 'graph_poweraverage_type_time_sensor'
+
+# The indexes syncdb created for the db_index fields (the _like index
+# is PostgreSQL's varchar_pattern_ops copy for CharFields).
+OLD_INDEX_NAMES = ('graph_poweraverage_average_type',
+                   'graph_poweraverage_average_type_like',
+                   'graph_poweraverage_trunc_reading_time')
+
+
+class ExplainCursor(object):
+    '''
+    Wraps a cursor so that each query is EXPLAINed rather than run.
+    '''
+
+    def __init__(self, cur):
+        self.cur = cur
+
+    def execute(self, sql, params=()):
+        self.cur.execute('EXPLAIN ' + sql, params)
+
+    def plan(self):
+        return '\n'.join([r[0] for r in self.cur.fetchall()])
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Create the composite graph index on graph_poweraverage.'
+    option_list = BaseCommand.option_list + (
+        make_option('--check', action='store_true', default=False,
+                    help='Check the graph query plans instead.'),
+    )
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError('Invalid number of arguments: %d.' % len(args))
+        cur = connection.cursor()
+        cur.execute('SHOW server_version_num;')
+        version = int(cur.fetchone()[0])
+        if options['check']:
+            self.check(cur, version)
+        else:
+            self.create(cur, version)
+            transaction.commit_unless_managed()
+
+    def create(self, cur, version):
+        cur.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s;',
+                    (INDEX_NAME,))
+        if cur.fetchone() is None:
+            if version >= 110000:
+                columns = '(average_type, trunc_reading_time, sensor_id) ' \
+                          'INCLUDE (watts)'
+            else:
+                columns = '(average_type, trunc_reading_time, sensor_id, ' \
+                          'watts)'
+            print 'Creating %s (this may take a while).' % INDEX_NAME
+            cur.execute('CREATE INDEX ' + INDEX_NAME
+                        + ' ON graph_poweraverage ' + columns + ';')
+        else:
+            print '%s already exists.' % INDEX_NAME
+        for name in OLD_INDEX_NAMES:
+            cur.execute('DROP INDEX IF EXISTS ' + name + ';')
+        print 'Dropped the single-column indexes.'
+
+    def check(self, cur, version):
+        if version < 90200:
+            raise CommandError('Index-only scans need PostgreSQL 9.2 '
+                               'or later.')
+        now = datetime.datetime.utcnow()
+        # (name, resolution, start, end) as the views ask for them.
+        shapes = (
+            ('dynamic', 'second*10', now - datetime.timedelta(0, 3600),
+             None),
+            ('static', 'hour', now - datetime.timedelta(30), now),
+            ('detail', 'minute*10', now - datetime.timedelta(1), now),
+        )
+        # A small table is cheaper to scan sequentially, which would
+        # hide whether the index can be used at all.
+        cur.execute('SET LOCAL enable_seqscan TO off;')
+        cur.execute('SET LOCAL enable_bitmapscan TO off;')
+        explain = ExplainCursor(cur)
+        failed = []
+        for name, res, start_dt, end_dt in shapes:
+            PowerAverage.graph_data_execute(explain, res, start_dt, end_dt)
+            plan = explain.plan()
+            ok = ('Index Only Scan using %s' % INDEX_NAME) in plan
+            print '%s: %s' % (name, ok and 'ok' or 'NOT index-only')
+            if not ok:
+                print plan
+                failed.append(name)
+        transaction.rollback_unless_managed()
+        if failed:
+            raise CommandError('No index-only scan for: %s.'
+                               % ', '.join(failed))
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+
+'''
+Manage the monthly partitions of graph_sensorreading and
+graph_poweraverage (see partitions.py).  Called with one argument:
+
+    convert   Turn the existing tables into partitioned ones (once;
+              stop the monitors first), then create partitions as for
+              create.
+    create    Create the partitions for this month and the next
+              PARTITION_MONTHS_AHEAD months, where missing.  Run this
+              regularly (e.g. daily from cron).
+    detach    Detach the monthly partitions before --before (YYYY-MM),
+              leaving them as ordinary tables to be backed up or
+              dropped.
+    list      Print the partitions and their sizes.
+
+Requires PostgreSQL 11 or later.
+'''
+
+
+import datetime
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import connection, transaction
+from energyweb.graph import partitions
+
+
+class Command(BaseCommand):
+    args = 'convert|create|detach|list'
+    help = 'Manage the monthly partitions of the reading and average tables.'
+    option_list = BaseCommand.option_list + (
+        make_option('--before', default=None,
+                    help='For detach: the first month (YYYY-MM) to keep.'),
+    )
+
+    @transaction.commit_manually
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Invalid number of arguments: %d.' % len(args))
+        action = args[0]
+        if action not in ('convert', 'create', 'detach', 'list'):
+            raise CommandError('Invalid action: \'%s\'.' % action)
+
+        cur = connection.cursor()
+        try:
+            try:
+                partitions.check_server_version(cur)
+            except ValueError, detail:
+                raise CommandError(str(detail))
+            getattr(self, action)(cur, options)
+        except:
+            transaction.rollback()
+            raise
+        transaction.commit()
+
+    def convert(self, cur, options):
+        for table in sorted(partitions.PARTITION_COLUMNS):
+            if partitions.is_partitioned(cur, table):
+                print '%s is already partitioned.' % table
+                continue
+            print 'Converting %s (this may take a while).' % table
+            cutoff = partitions.convert(cur, table)
+            print '    %s_legacy holds everything before %s.' \
+                  % (table, cutoff.strftime('%Y-%m'))
+        self.create(cur, options)
+
+    def create(self, cur, options):
+        this_month = partitions.month_start(datetime.datetime.now())
+        for table in sorted(partitions.PARTITION_COLUMNS):
+            if not partitions.is_partitioned(cur, table):
+                raise CommandError('%s is not partitioned; run convert '
+                                   'first.' % table)
+            for i in range(settings.PARTITION_MONTHS_AHEAD + 1):
+                month = partitions.add_months(this_month, i)
+                if partitions.create_partition(cur, table, month):
+                    print 'Created %s.' % partitions.partition_name(table,
+                                                                   month)
+
+    def detach(self, cur, options):
+        if options['before'] is None:
+            raise CommandError('detach requires --before.')
+        try:
+            before = datetime.datetime.strptime(options['before'], '%Y-%m')
+        except ValueError:
+            raise CommandError('Invalid month: \'%s\'.' % options['before'])
+        for table in sorted(partitions.PARTITION_COLUMNS):
+            for name in partitions.list_partitions(cur, table):
+                month = partitions.partition_month(name)
+                if month is not None and month < before:
+                    partitions.detach_partition(cur, table, name)
+                    print 'Detached %s.' % name
+
+    def list(self, cur, options):
+        for table in sorted(partitions.PARTITION_COLUMNS):
+            if not partitions.is_partitioned(cur, table):
+                print '%s: not partitioned' % table
+                continue
+            print '%s: %d MB' % (table,
+                                 partitions.table_size(cur, table) >> 20)
+            for name in partitions.list_partitions(cur, table):
+                print '    %s: %d MB' % (name,
+                                         partitions.table_size(cur, name) >> 20)
@@ -10,6 +10,7 @@
 from django.db import models
 from django.conf import settings
 from datetime import datetime, timedelta
+import time
 
 
 class SensorGroup(models.Model):
@@ -91,6 +92,18 @@ class PowerAverage(models.Model):
         'minute': timedelta(0, 60, 0),
         'second*10': timedelta(0, 10, 0)
     }
+    # The average type each is computed from by insert_averages
+    # (None: from the sensor readings).  Each period of a type is
+    # made of whole periods of its source.
+    BACKFILL_SOURCES = {
+        'month': 'day',
+        'week': 'day',
+        'day': 'hour',
+        'hour': 'minute*10',
+        'minute*10': 'minute',
+        'minute': 'second*10',
+        'second*10': None
+    }
     AVERAGE_TYPE_DESCRIPTIONS = {
         'month': '1 month',
         'week': '1 week',
@@ -103,12 +116,17 @@ class PowerAverage(models.Model):
 
     first_reading_time = models.DateTimeField()
     last_reading_time = models.DateTimeField()
-    trunc_reading_time = models.DateTimeField(db_index=True)
+    # The graph queries use a composite index on (average_type,
+    # trunc_reading_time, sensor_id), created by index_power_averages.
+    trunc_reading_time = models.DateTimeField()
 
     sensor = models.ForeignKey(Sensor)
     num_points = models.PositiveIntegerField()
     watts = models.FloatField()
-    average_type = models.CharField(max_length=32, db_index=True,
+    # The energy used in the period:  each reading counts for
+    # READING_INTERVAL seconds (see energy.py).
+    watt_hours = models.FloatField(default=0)
+    average_type = models.CharField(max_length=32,
         choices=[(t, t) for t in AVERAGE_TYPES])
 
     @classmethod
@@ -160,11 +178,14 @@ class PowerAverage(models.Model):
             raise ValueError('Unrecognized field \'%s\'.' % field)
 
     @classmethod
-    def graph_data_execute(cls, cur, res, start_dt, end_dt=None):
+    def graph_data_execute(cls, cur, res, start_dt, end_dt=None,
+                           sensor_group_ids=None, sensor_ids=None):
         '''
         Using the supplied DB cursor, execute a query that selects
         the data for e.g. a graph starting at datetime start_dt,
         ending at datetime end_dt, and having resolution res.
+        If sensor_group_ids or sensor_ids (lists of ids) are given,
+        only the data of those sensor groups or sensors is selected.
         '''
         cur.execute('''SELECT 
                          AVG(graph_poweraverage.watts) / 1000, 
@@ -178,6 +199,12 @@ class PowerAverage(models.Model):
 
                     + (end_dt is not None 
                        and ' AND graph_poweraverage.trunc_reading_time <= %s '
+                       or '')
+                    + (sensor_group_ids is not None
+                       and ' AND graph_sensor.sensor_group_id IN %s '
+                       or '')
+                    + (sensor_ids is not None
+                       and ' AND graph_poweraverage.sensor_id IN %s '
                        or '') + '''
 
                        GROUP BY 
@@ -190,25 +217,112 @@ class PowerAverage(models.Model):
                          graph_sensor.id ASC;''', 
 
                     (res, start_dt) 
-                    + (end_dt is not None and (end_dt,) or ()))
+                    + (end_dt is not None and (end_dt,) or ())
+                    + (sensor_group_ids is not None
+                       and (tuple(sensor_group_ids),) or ())
+                    + (sensor_ids is not None
+                       and (tuple(sensor_ids),) or ()))
 
     @classmethod
-    def insert_averages(cls, cur, average_type, sensor, 
-                        trunc_latest_reading_time):
+    def range_statistics_execute(cls, cur, sensor_ids, ranges):
         '''
-        Insert power averages for the given average type, for all
-        sensor readings before trunc_latest_reading_time.
+        Using the supplied DB cursor, execute a query that selects
+        statistics of the given sensors over several ranges at once.
+        ranges is a list of (key, average type, start datetime, end
+        datetime), start inclusive and end exclusive; several may have
+        the same key.  One row is selected per key and sensor with
+        averages in its ranges:  (key, sensor id, kilowatts of its
+        latest average, sum of its averages in kilowatts, sum of their
+        energy in kilowatt-hours).
+        '''
+        values_sql = ', '.join(['(%s, %s, %s, %s)'] * len(ranges))
+        params = []
+        for r in ranges:
+            params.extend(r)
+        params.append(tuple(sensor_ids))
+        cur.execute('''SELECT
+                         key,
+                         sensor_id,
+                         MAX(CASE WHEN recency = 1 THEN watts END) / 1000,
+                         SUM(watts) / 1000,
+                         SUM(watt_hours) / 1000
+                       FROM (SELECT
+                               r.key,
+                               pa.sensor_id,
+                               pa.watts,
+                               pa.watt_hours,
+                               row_number() OVER (
+                                 PARTITION BY r.key, pa.sensor_id
+                                 ORDER BY pa.trunc_reading_time DESC)
+                                 AS recency
+                             FROM graph_poweraverage AS pa
+                             INNER JOIN (VALUES ''' + values_sql + ''')
+                               AS r (key, average_type, start_dt, end_dt)
+                               ON pa.average_type = r.average_type
+                               AND pa.trunc_reading_time >= r.start_dt
+                               AND pa.trunc_reading_time < r.end_dt
+                             WHERE pa.sensor_id IN %s) AS ranged
+                       GROUP BY key, sensor_id;''',
+                    params)
+
+    @classmethod
+    def insert_averages(cls, cur, average_type, sensor,
+                        trunc_latest_reading_time, start_dt=None,
+                        end_dt=None):
         '''
-        trunc_sql = cls.average_type_sql(average_type, 'reading_time')
-        # The query below effectively does the following:
-        # 1. Finds all truncated reading times in graph_sensorreading,
-        #    before latest_trunc_reading, for this sensor id;
-        # 2. Removes all truncated reading times in graph_poweraverage,
-        #    before latest_trunc_reading, for this sensor id and
-        #    average type;
-        # 3. Computes the average power for each of the truncated
-        #    reading times that remain, and inserts those calculations
-        #    into graph_poweraverage.
+        Insert the missing power averages of the given average type
+        for the sensor, before trunc_latest_reading_time (so not its
+        open one), and only from the data between datetimes start_dt
+        (inclusive) and end_dt (exclusive), if given.  Return the
+        number of rows inserted.
+        The finest type (second*10) is computed from the sensor
+        readings, and each other type from the averages of the type
+        in BACKFILL_SOURCES, which must already be there:  far fewer
+        rows, and the same result, since the average of a period is
+        the average of its parts weighted by their num_points.
+        '''
+        source_type = cls.BACKFILL_SOURCES[average_type]
+        if source_type is None:
+            trunc_sql = cls.average_type_sql(average_type, 'reading_time')
+            time_field = 'reading_time'
+            source_sql = '''
+                SELECT
+                  MIN(reading_time) AS first_reading_time,
+                  MAX(reading_time) AS last_reading_time,
+                  ''' + trunc_sql + ''' AS trunc_reading_time,
+                  COUNT(*) AS num_points,
+                  AVG(awatthr + bwatthr + cwatthr) AS watts,
+                  SUM(awatthr + bwatthr + cwatthr) * %s / 3600.0
+                    AS watt_hours
+                FROM graph_sensorreading
+                WHERE sensor_id = %s'''
+            params = [settings.READING_INTERVAL, sensor.pk]
+        else:
+            trunc_sql = cls.average_type_sql(average_type,
+                                             'trunc_reading_time')
+            time_field = 'trunc_reading_time'
+            source_sql = '''
+                SELECT
+                  MIN(first_reading_time) AS first_reading_time,
+                  MAX(last_reading_time) AS last_reading_time,
+                  ''' + trunc_sql + ''' AS trunc_reading_time,
+                  SUM(num_points) AS num_points,
+                  SUM(watts * num_points) / SUM(num_points) AS watts,
+                  SUM(watt_hours) AS watt_hours
+                FROM graph_poweraverage
+                WHERE sensor_id = %s
+                  AND average_type = %s'''
+            params = [sensor.pk, source_type]
+        if start_dt is not None:
+            source_sql += ' AND ' + time_field + ' >= %s'
+            params.append(start_dt)
+        if end_dt is not None:
+            source_sql += ' AND ' + time_field + ' < %s'
+            params.append(end_dt)
+        source_sql += ' GROUP BY 3'
+
+        # The periods of the source rows, less those that are still
+        # open or already have an average.
         cur.execute('''
             INSERT INTO graph_poweraverage
               (first_reading_time,
@@ -217,39 +331,28 @@ class PowerAverage(models.Model):
               sensor_id,
               average_type,
               num_points,
-              watts)
-
+              watts,
+              watt_hours)
             SELECT
-              MIN(reading_time),
-              MAX(reading_time),
-              ''' + trunc_sql + ''' AS sr_trunc_reading_time,
+              source.first_reading_time,
+              source.last_reading_time,
+              source.trunc_reading_time,
               %s,
               %s,
-              COUNT(*),
-              AVG(awatthr + bwatthr + cwatthr)
-            FROM graph_sensorreading
-            WHERE sensor_id = %s
-              AND ''' + trunc_sql + ''' IN
-                (SELECT ''' + trunc_sql + '''
-                FROM graph_sensorreading
-                WHERE sensor_id = %s
-                  AND ''' + trunc_sql + ''' < %s
-                EXCEPT
-                SELECT trunc_reading_time
-                FROM graph_poweraverage
-                WHERE sensor_id = %s
-                  AND average_type = %s
-                  AND trunc_reading_time < %s)
-            GROUP BY sr_trunc_reading_time;
+              source.num_points,
+              source.watts,
+              source.watt_hours
+            FROM (''' + source_sql + ''') AS source
+            WHERE source.trunc_reading_time < %s
+              AND NOT EXISTS
+                (SELECT 1
+                FROM graph_poweraverage AS pa
+                WHERE pa.sensor_id = %s
+                  AND pa.average_type = %s
+                  AND pa.trunc_reading_time = source.trunc_reading_time);
             ''',
-            (sensor.pk, 
-             average_type, 
-             sensor.pk, 
-             sensor.pk, 
-             trunc_latest_reading_time, 
-             sensor.pk, 
-             average_type, 
-             trunc_latest_reading_time))
+            [sensor.pk, average_type] + params
+            + [trunc_latest_reading_time, sensor.pk, average_type])
         return cur.rowcount
 
     def __unicode__(self):
@@ -260,7 +363,249 @@ class PowerAverage(models.Model):
         unique_together = (('trunc_reading_time', 'sensor', 'average_type'),)
 
 
+class SensorGroupAverage(models.Model):
+    '''
+    The power average of a whole sensor group (building): the sum of
+    the power averages of its sensors for one period.  num_sensors is
+    the number of sensors that contributed, so a period for which some
+    sensor has no average can be told apart.  Kept up to date by the
+    monitors' writer and by create_power_averages, so that graphs need
+    not join and group graph_poweraverage on every request.
+    '''
+    average_type = models.CharField(max_length=32,
+        choices=[(t, t) for t in PowerAverage.AVERAGE_TYPES])
+    sensor_group = models.ForeignKey(SensorGroup)
+    trunc_reading_time = models.DateTimeField()
+
+    watts = models.FloatField()
+    num_sensors = models.PositiveIntegerField()
+
+    @classmethod
+    def graph_data_execute(cls, cur, res, start_dt, end_dt=None):
+        '''
+        Like PowerAverage.graph_data_execute, but select one row
+        (kilowatts, sensor group id, truncated reading time, number of
+        sensors) per sensor group and period.
+        '''
+        cur.execute('''SELECT
+                         watts / 1000,
+                         sensor_group_id,
+                         trunc_reading_time,
+                         num_sensors
+                       FROM graph_sensorgroupaverage
+                       WHERE average_type = %s
+                         AND trunc_reading_time >= %s '''
+
+                    + (end_dt is not None
+                       and ' AND trunc_reading_time <= %s '
+                       or '') + '''
+
+                       ORDER BY
+                         trunc_reading_time ASC,
+                         sensor_group_id ASC;''',
+
+                    (res, start_dt)
+                    + (end_dt is not None and (end_dt,) or ()))
+
+    @classmethod
+    def refresh(cls, cur, keys):
+        '''
+        Recompute the sensor group averages identified by keys, a list
+        of (average_type, sensor group id, truncated reading time)
+        tuples, from graph_poweraverage.  Return the number of rows
+        written.
+        '''
+        if not keys:
+            return 0
+        key_sql = ', '.join(['(%s, %s, %s)'] * len(keys))
+        params = []
+        for key in keys:
+            params.extend(key)
+        return cls._refresh_where(cur,
+            '''(pa.average_type, s.sensor_group_id, pa.trunc_reading_time)
+               IN (''' + key_sql + ')', params)
+
+    @classmethod
+    def refresh_range(cls, cur, average_type, sensor_group, end_dt=None):
+        '''
+        Recompute every sensor group average of the given average type
+        and sensor group (before datetime end_dt, if given).  Return
+        the number of rows written.
+        '''
+        where_sql = 'pa.average_type = %s AND s.sensor_group_id = %s'
+        params = [average_type, sensor_group.pk]
+        if end_dt is not None:
+            where_sql += ' AND pa.trunc_reading_time < %s'
+            params.append(end_dt)
+        return cls._refresh_where(cur, where_sql, params)
+
+    @classmethod
+    def _refresh_where(cls, cur, where_sql, params):
+        # where_sql refers to graph_poweraverage as pa and graph_sensor
+        # as s.  (PostgreSQL 8.4 has no upsert, so the affected rows
+        # are deleted and inserted again.)
+        cur.execute('''
+            DELETE FROM graph_sensorgroupaverage
+            WHERE (average_type, sensor_group_id, trunc_reading_time) IN
+              (SELECT pa.average_type, s.sensor_group_id,
+                 pa.trunc_reading_time
+               FROM graph_poweraverage pa
+               INNER JOIN graph_sensor s ON pa.sensor_id = s.id
+               WHERE ''' + where_sql + ''');
+            ''', params)
+        cur.execute('''
+            INSERT INTO graph_sensorgroupaverage
+              (average_type,
+              sensor_group_id,
+              trunc_reading_time,
+              watts,
+              num_sensors)
+
+            SELECT
+              pa.average_type,
+              s.sensor_group_id,
+              pa.trunc_reading_time,
+              SUM(pa.watts),
+              COUNT(*)
+            FROM graph_poweraverage pa
+            INNER JOIN graph_sensor s ON pa.sensor_id = s.id
+            WHERE ''' + where_sql + '''
+            GROUP BY pa.average_type, s.sensor_group_id,
+              pa.trunc_reading_time;
+            ''', params)
+        return cur.rowcount
+
+    def __unicode__(self):
+        return u'%s for %s starting %s' % (self.sensor_group,
+                                           self.average_type,
+                                           self.trunc_reading_time)
+
+    class Meta:
+        # Also serves as the index for graph queries, which select
+        # one average type and a range of times.
+        unique_together = (('average_type', 'sensor_group',
+                            'trunc_reading_time'),)
+
+
+class EnergyPrefix(models.Model):
+    '''
+    A running total of a sensor's energy:  the watt-hours and number
+    of readings of all of its hour power averages before prefix_time
+    (an hour boundary).  The monitors add one whenever an hour's
+    average closes (see rollup.py), and create_power_averages
+    rebuilds them all, so that the energy or average power between
+    any two hours is the difference of two of them (see energy.py).
+    '''
+    sensor = models.ForeignKey(Sensor)
+    prefix_time = models.DateTimeField()
+    watt_hours = models.FloatField()
+    num_points = models.PositiveIntegerField()
+
+    @classmethod
+    def rebuild(cls, cur, sensor, end_dt):
+        '''
+        Replace the sensor's running totals by ones computed from its
+        hour power averages before datetime end_dt (which should be
+        the start of its open hour).  Return the number of rows
+        written.
+        The totals up to its first hour average still in the database
+        are kept, and the new ones continue from them:  the hours of
+        months archived and purged (see archive_readings) count only
+        through those.
+        '''
+        cur.execute('''SELECT MIN(trunc_reading_time)
+                       FROM graph_poweraverage
+                       WHERE sensor_id = %s
+                         AND average_type = 'hour'
+                         AND trunc_reading_time < %s;''',
+                    (sensor.pk, end_dt))
+        first_dt = cur.fetchone()[0]
+        if first_dt is None:
+            return 0
+        cur.execute('''SELECT watt_hours, num_points
+                       FROM graph_energyprefix
+                       WHERE sensor_id = %s
+                         AND prefix_time <= %s
+                       ORDER BY prefix_time DESC
+                       LIMIT 1;''', (sensor.pk, first_dt))
+        base = cur.fetchone() or (0.0, 0)
+        cur.execute('''DELETE FROM graph_energyprefix
+                       WHERE sensor_id = %s
+                         AND prefix_time > %s;''', (sensor.pk, first_dt))
+        cur.execute('''
+            INSERT INTO graph_energyprefix
+              (sensor_id, prefix_time, watt_hours, num_points)
+            SELECT
+              sensor_id,
+              trunc_reading_time + interval '1 hour',
+              %s + SUM(watt_hours) OVER running,
+              %s + SUM(num_points) OVER running
+            FROM graph_poweraverage
+            WHERE sensor_id = %s
+              AND average_type = 'hour'
+              AND trunc_reading_time < %s
+            WINDOW running AS (ORDER BY trunc_reading_time);''',
+            (base[0], base[1], sensor.pk, end_dt))
+        return cur.rowcount
+
+    @classmethod
+    def sums_execute(cls, cur, sensor_ids, ranges, lower_dt=None,
+                     upper_dt=None):
+        '''
+        Using the supplied DB cursor, execute a query that selects
+        (sensor id, watt-hours, number of readings) for each of the
+        given sensors:  the running total at upper_dt less the one at
+        lower_dt (if given; each being the latest at or before that
+        time), plus the power averages in ranges, a list of (average
+        type, start datetime, end datetime) as energy.cover() gives,
+        start inclusive and end exclusive.
+        '''
+        parts = []
+        params = []
+        for sign, dt in (('', upper_dt), ('-', lower_dt)):
+            if dt is not None:
+                parts.append('''SELECT
+                                  sensor_id,
+                                  ''' + sign + '''watt_hours,
+                                  ''' + sign + '''num_points
+                                FROM (SELECT DISTINCT ON (sensor_id)
+                                        sensor_id, watt_hours, num_points
+                                      FROM graph_energyprefix
+                                      WHERE sensor_id IN %s
+                                        AND prefix_time <= %s
+                                      ORDER BY sensor_id, prefix_time DESC)
+                                  AS prefix''')
+                params.extend([tuple(sensor_ids), dt])
+        if ranges:
+            parts.append('''SELECT
+                              pa.sensor_id,
+                              pa.watt_hours,
+                              pa.num_points
+                            FROM graph_poweraverage AS pa
+                            INNER JOIN (VALUES '''
+                         + ', '.join(['(%s, %s, %s)'] * len(ranges)) + ''')
+                              AS r (average_type, start_dt, end_dt)
+                              ON pa.average_type = r.average_type
+                              AND pa.trunc_reading_time >= r.start_dt
+                              AND pa.trunc_reading_time < r.end_dt
+                            WHERE pa.sensor_id IN %s''')
+            for r in ranges:
+                params.extend(r)
+            params.append(tuple(sensor_ids))
+        cur.execute('SELECT sensor_id, SUM(watt_hours), SUM(num_points) '
+                    'FROM (' + ' UNION ALL '.join(parts) + ') AS parts '
+                    'GROUP BY sensor_id;', params)
+
+    def __unicode__(self):
+        return u'%s before %s' % (self.sensor, self.prefix_time)
+
+    class Meta:
+        unique_together = (('sensor', 'prefix_time'),)
+
+
 class SRProfile(models.Model):
+    # Once graph_sensorreading is partitioned (see partitions.py) the
+    # database no longer enforces this foreign key.
     sensor_reading = models.ForeignKey(SensorReading)
 
     power_average_inserts = models.IntegerField()
@@ -269,12 +614,23 @@ class SRProfile(models.Model):
     transaction_time = models.IntegerField()
 
 
+# Setting values cached by this process (see Setting.get_value_of):
+# {'values': {name: value}, 'version': (latest updated_at, count),
+#  'checked': time.time() of the last version check}
+_setting_cache = {'values': None, 'version': None, 'checked': 0}
+
+
 class Setting(models.Model):
-    VALUE_TYPE_CHOICES = (('bool', 'Boolean'),)
+    VALUE_TYPE_CHOICES = (('bool', 'Boolean'),
+                          ('int', 'Integer'),
+                          ('float', 'Number'),
+                          ('string', 'Text'))
 
     name = models.CharField(max_length=32, unique=True)
     value_type = models.CharField(max_length=32, choices=VALUE_TYPE_CHOICES)
     value = models.TextField(blank=True)
+    # Used to tell whether cached values are out of date.
+    updated_at = models.DateTimeField(auto_now=True)
 
     def get_value(self):
         if self.value_type == 'bool':
@@ -282,15 +638,63 @@ class Setting(models.Model):
                 return True
             elif self.value == 'false':
                 return False
-            else:
-                raise ValueError('Value does not match value type %s: .' % (self.value_type, self.value))
+        elif self.value_type in ('int', 'float'):
+            try:
+                return {'int': int, 'float': float}[self.value_type](self.value)
+            except ValueError:
+                pass
+        elif self.value_type == 'string':
+            return self.value
         else:
             raise ValueError('Invalid value type: %s.' % self.value_type)
+        raise ValueError('Value does not match value type %s: %s.'
+                         % (self.value_type, self.value))
 
     @classmethod
-    def get_value_of(cls, name):
-        s = cls.objects.get(name=name)
-        return s.get_value()
+    def get_value_of(cls, name, default=None):
+        '''
+        Return the value of the setting name, or default if there is
+        no such setting.  Values are cached:  all of them are loaded
+        by the first call, and reloaded when the table has changed
+        (checked at most every SETTING_CACHE_CHECK seconds, and at once
+        after invalidate_cache()).
+        '''
+        now = time.time()
+        if _setting_cache['values'] is None:
+            cls.load_all()
+        elif now - _setting_cache['checked'] >= settings.SETTING_CACHE_CHECK:
+            _setting_cache['checked'] = now
+            if cls._version() != _setting_cache['version']:
+                cls.load_all()
+        return _setting_cache['values'].get(name, default)
+
+    @classmethod
+    def load_all(cls):
+        '''
+        (Re)load every setting into the cache with a single query.
+        '''
+        values = {}
+        latest = None
+        for s in cls.objects.all():
+            values[s.name] = s.get_value()
+            latest = max(latest, s.updated_at)
+        _setting_cache['values'] = values
+        _setting_cache['version'] = (latest, len(values))
+        _setting_cache['checked'] = time.time()
+
+    @classmethod
+    def _version(cls):
+        from django.db.models import Max, Count
+        d = cls.objects.aggregate(Max('updated_at'), Count('id'))
+        return (d['updated_at__max'], d['id__count'])
+
+    @classmethod
+    def invalidate_cache(cls):
+        '''
+        Reload the settings at the next get_value_of() (e.g. because
+        the monitors were told they changed).
+        '''
+        _setting_cache['values'] = None
 
     def set_value(self, value):
         if self.value_type == 'bool':
@@ -298,6 +702,8 @@ class Setting(models.Model):
                 self.value = 'true'
             else:
                 self.value = 'false'
+        elif self.value_type in ('int', 'float', 'string'):
+            self.value = str(value)
         else:
             raise ValueError('Invalid value type: %s.' % self.value_type)
         self.save()
@@ -307,6 +713,15 @@ class Setting(models.Model):
         s = cls.objects.get(name=name)
         return s.set_value(value)
 
+    def save(self, *args, **kwargs):
+        super(Setting, self).save(*args, **kwargs)
+        self.invalidate_cache()
+        # Have the running monitors reload their settings (once this
+        # transaction commits; see control.py).
+        from django.db import connection
+        from energyweb.graph import control
+        control.notify(connection.cursor())
+
     def __unicode__(self):
         return u'%s: %s' % (self.name, self.value)
 
@@ -363,6 +778,17 @@ class LogMessage(models.Model):
     topic = models.CharField(max_length=32)
     details = models.TextField()
 
+    # Repeats of a message are written as one (see logsink.py):
+    # reading_time is when it was first seen, last_time when it was
+    # last seen (reading_time, if not given), and count how many times.
+    count = models.IntegerField(default=1)
+    last_time = models.DateTimeField(blank=True)
+
+    def save(self, *args, **kwargs):
+        if self.last_time is None:
+            self.last_time = self.reading_time
+        super(LogMessage, self).save(*args, **kwargs)
+
 class viewCount(models.Model):
     '''
     Keeps track of page views by page and by day.
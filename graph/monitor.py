@@ -0,0 +1,97 @@
+'''
+    Interprets and stores the messages sent by Rhizome Systems energy
+    monitoring devices.
+
+    Shared by the single-sensor monitor (energymon) and the monitor
+    that manages every sensor from one process (energymon_all).  The
+    daemons are responsible for sockets, signals, and flushing the
+    writer; this module only turns a 45-byte message into rows.
+'''
+
+import datetime, time, logging
+from django.conf import settings
+from django.db import transaction
+from energyweb.graph.rollup import RollupEngine
+from energyweb.graph.rhizome import decode
+
+
+def rollback_on_exception(f):
+    '''
+    Catch any exception, rollback the transaction, then re-raise the
+    exception.
+    '''
+    def _f(*args, **kwargs):
+        try:
+            return f(*args, **kwargs)
+        except:
+            transaction.rollback()
+            raise
+    return _f
+
+
+class SensorMonitor(object):
+    '''
+    Keeps the in-progress power averages for one sensor (see rollup.py)
+    and passes the readings received from its device to a
+    ReadingWriter (see writer.py), which may be shared by several
+    monitors.
+    '''
+
+    def __init__(self, sensor, writer, profiling=False):
+        self.sensor = sensor
+        self.writer = writer
+        self.rollup = RollupEngine(sensor, writer)
+        self.profiling = profiling
+
+        # If the sensor is three-phase, we want to add all three power
+        # measurements to obtain the aggregate.  If the sensor is single
+        # phase, only the first two measurements are meaningful---so
+        # we'll zero the third.
+        self.factor = sensor.factor
+        self.phase_factor = (sensor.three_phase and 1 or 0)
+
+    def init_power_averages(self):
+        '''
+        Recover the in-progress power averages of this sensor (see
+        RollupEngine.load), so that new readings can be added to them.
+        '''
+        self.rollup.load()
+
+    def checkpoint(self):
+        '''
+        Have the in-progress power averages written at the next flush.
+        '''
+        self.rollup.checkpoint()
+
+    def process(self, data):
+        '''
+        Interpret a validated 45-byte message, add it to the power
+        averages, and hand the reading to the writer.  Nothing reaches
+        the database until the writer is flushed.
+        '''
+        if self.profiling:
+            transaction_start = time.time()
+        # If the rudimentary validation succeeded, proceed to
+        # interpret the data for processing and storage.
+        logging.debug('Data validated.')
+        reading = decode(data, self.factor)
+        reading_time = datetime.datetime.now()
+
+        # Precompute averages (we have 10 seconds until the
+        # next message.
+        watts = (reading.awatthr + reading.bwatthr
+                 + reading.cwatthr * self.phase_factor)
+
+        (num_pa_inserts, num_pa_updates) = self.rollup.add(reading_time,
+                                                            watts)
+
+        profile = None
+        if self.profiling:
+            profile = {
+                'power_average_inserts': num_pa_inserts,
+                'power_average_updates': num_pa_updates,
+                'transaction_time': int((time.time() - transaction_start)
+                                        * 1000.0)}
+        self.writer.add_reading(self.sensor.pk, reading_time, reading,
+                                profile)
+        logging.debug('Data processed.')
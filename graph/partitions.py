@@ -0,0 +1,254 @@
+'''
+    Monthly partitioning of the large tables (PostgreSQL 11 or later).
+
+    graph_sensorreading is partitioned by RANGE of reading_time, one
+    partition per month.  graph_poweraverage is partitioned by RANGE of
+    trunc_reading_time, one partition per month, and each month by LIST
+    of average_type:  the three fine average types (which make up
+    nearly all of the rows) each get their own sub-partition and the
+    coarse ones share one.  Queries that give a time range (and an
+    average type) only scan the partitions that can match, and backups
+    and retention can work a month (and average type) at a time.
+
+    convert() turns the existing tables into partitioned ones in
+    place:  the old table is kept, unchanged, as one partition holding
+    everything before the first monthly partition, and a default
+    partition catches rows for months that have no partition yet.
+    create_partition() adds a month, moving any rows the default
+    partition has for it.
+
+    Partitions are named <table>_yYYYYmMM (with a _<kind> suffix for
+    the average type sub-partitions); the old table becomes
+    <table>_legacy.
+'''
+
+import datetime, re
+
+
+# The partitioned tables and the column each is partitioned on.
+PARTITION_COLUMNS = {
+    'graph_sensorreading': 'reading_time',
+    'graph_poweraverage': 'trunc_reading_time',
+}
+
+# The sub-partitions of each month of graph_poweraverage: (suffix,
+# average types).
+POWER_AVERAGE_KINDS = (
+    ('second10', ('second*10',)),
+    ('minute', ('minute',)),
+    ('minute10', ('minute*10',)),
+    ('coarse', ('hour', 'day', 'week', 'month')),
+)
+
+MIN_SERVER_VERSION = 110000
+
+MONTH_RE = re.compile(r'_y(\d{4})m(\d{2})$')
+
+
+def month_start(dt):
+    return datetime.datetime(dt.year, dt.month, 1)
+
+
+def add_months(dt, n):
+    '''
+    Return the first of the month n months after datetime dt's.
+    '''
+    months = dt.year * 12 + dt.month - 1 + n
+    return datetime.datetime(months // 12, months % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    return '%s_y%04dm%02d' % (table, month.year, month.month)
+
+
+def partition_month(name):
+    '''
+    Return the month (a datetime) of a monthly partition, given its
+    name, or None if it is not a monthly partition.
+    '''
+    m = MONTH_RE.search(name)
+    if m is None:
+        return None
+    return datetime.datetime(int(m.group(1)), int(m.group(2)), 1)
+
+
+def server_version(cur):
+    cur.execute('SHOW server_version_num;')
+    return int(cur.fetchone()[0])
+
+
+def check_server_version(cur):
+    if server_version(cur) < MIN_SERVER_VERSION:
+        raise ValueError('Partitioning requires PostgreSQL 11 or later.')
+
+
+def is_partitioned(cur, table):
+    cur.execute('''SELECT c.relkind FROM pg_class c
+                   WHERE c.relname = %s
+                     AND pg_table_is_visible(c.oid);''', (table,))
+    r = cur.fetchone()
+    return r is not None and r[0] == 'p'
+
+
+def list_partitions(cur, table):
+    '''
+    Return the names of the partitions directly under table, sorted.
+    '''
+    cur.execute('''SELECT c.relname FROM pg_inherits i
+                   INNER JOIN pg_class c ON i.inhrelid = c.oid
+                   WHERE i.inhparent = %s::regclass
+                   ORDER BY c.relname;''', (table,))
+    return [r[0] for r in cur.fetchall()]
+
+
+# Selects from table and (recursively) its partitions, as t (and their
+# pg_class rows as c).
+TREE_SQL = '''WITH RECURSIVE tree(relid) AS
+                (SELECT %%s::regclass::oid
+                 UNION ALL
+                 SELECT i.inhrelid FROM pg_inherits i
+                 INNER JOIN tree ON i.inhparent = tree.relid)
+              SELECT %s
+              FROM tree t INNER JOIN pg_class c ON c.oid = t.relid;'''
+
+
+def table_size(cur, table):
+    '''
+    Return the bytes used by table, its indexes, and (if it is
+    partitioned) all of its partitions.
+    '''
+    cur.execute(TREE_SQL % 'COALESCE(SUM(pg_total_relation_size(t.relid)), 0)',
+                (table,))
+    return int(cur.fetchone()[0])
+
+
+def table_rows(cur, table):
+    '''
+    Return the planner's estimate of the rows in table (including all
+    of its partitions).
+    '''
+    cur.execute(TREE_SQL % 'COALESCE(SUM(c.reltuples), 0)', (table,))
+    return int(cur.fetchone()[0])
+
+
+def convert(cur, table, now=None):
+    '''
+    Turn table (one of PARTITION_COLUMNS) into a partitioned table.
+    The existing rows stay where they are, in <table>_legacy, which
+    becomes the partition for everything before next month.  The
+    monitors must be stopped while this runs.  Foreign keys that
+    reference table (only graph_srprofile's) are dropped, since
+    PostgreSQL 11 cannot enforce them against a partitioned table.
+    '''
+    column = PARTITION_COLUMNS[table]
+    legacy = table + '_legacy'
+    if now is None:
+        now = datetime.datetime.now()
+
+    # Remember the indexes and foreign keys to recreate on the new
+    # table before renaming the old one's.
+    cur.execute('''SELECT indexname, indexdef FROM pg_indexes
+                   WHERE tablename = %s;''', (table,))
+    indexes = cur.fetchall()
+    cur.execute('''SELECT conname, pg_get_constraintdef(oid)
+                   FROM pg_constraint
+                   WHERE conrelid = %s::regclass AND contype = 'f';''',
+                (table,))
+    foreign_keys = cur.fetchall()
+    cur.execute('''SELECT conrelid::regclass, conname FROM pg_constraint
+                   WHERE confrelid = %s::regclass AND contype = 'f';''',
+                (table,))
+    for referencing_table, name in cur.fetchall():
+        cur.execute('ALTER TABLE %s DROP CONSTRAINT %s;'
+                    % (referencing_table, name))
+
+    cur.execute('SELECT MAX(%s) FROM %s;' % (column, table))
+    latest = cur.fetchone()[0]
+    if latest is not None:
+        latest = latest.replace(tzinfo=None)
+    cutoff = add_months(max(now, latest or now), 1)
+
+    cur.execute('ALTER TABLE %s RENAME TO %s;' % (table, legacy))
+    for name, definition in indexes:
+        cur.execute('ALTER INDEX %s RENAME TO %s;'
+                    % (name, name[:56] + '_legacy'))
+
+    if table == 'graph_poweraverage':
+        primary_key = 'id, average_type, trunc_reading_time'
+    else:
+        primary_key = 'id, ' + column
+    cur.execute('''CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)
+                   PARTITION BY RANGE (%s);''' % (table, legacy, column))
+    cur.execute('ALTER TABLE %s ADD CONSTRAINT %s_pkey PRIMARY KEY (%s);'
+                % (table, table, primary_key))
+    # The id sequence must outlive the legacy partition.
+    cur.execute('ALTER SEQUENCE %s_id_seq OWNED BY %s.id;' % (table, table))
+    for name, definition in indexes:
+        if ' UNIQUE ' in definition:
+            # The primary key (recreated above) and unique
+            # constraints that include the partition keys (the power
+            # average one does) can be kept; others can't.
+            if name.endswith('_pkey'):
+                continue
+            if column not in definition:
+                continue
+        cur.execute(definition.replace(legacy, table) + ';')
+    for name, definition in foreign_keys:
+        cur.execute('ALTER TABLE %s ADD CONSTRAINT %s %s;'
+                    % (table, name, definition))
+
+    cur.execute('''ALTER TABLE %s ATTACH PARTITION %s
+                   FOR VALUES FROM (MINVALUE) TO (%%s);''' % (table, legacy),
+                (cutoff,))
+    cur.execute('CREATE TABLE %s_default PARTITION OF %s DEFAULT;'
+                % (table, table))
+    return cutoff
+
+
+def create_partition(cur, table, month):
+    '''
+    Create the partition of table for the month starting at datetime
+    month (and, for graph_poweraverage, its average type
+    sub-partitions), unless it already exists.  Rows the default
+    partition holds for that month are moved into it.  Return whether
+    a partition was created.
+    '''
+    column = PARTITION_COLUMNS[table]
+    name = partition_name(table, month)
+    if name in list_partitions(cur, table):
+        return False
+    start = month_start(month)
+    end = add_months(start, 1)
+
+    # Build the partition as a separate table and attach it when it
+    # is complete, since the default partition can't keep rows that
+    # belong to a new partition.
+    if table == 'graph_poweraverage':
+        cur.execute('''CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)
+                       PARTITION BY LIST (average_type);''' % (name, table))
+        for suffix, average_types in POWER_AVERAGE_KINDS:
+            cur.execute('CREATE TABLE %s_%s PARTITION OF %s FOR VALUES IN ('
+                        % (name, suffix, name)
+                        + ', '.join(['%s'] * len(average_types)) + ');',
+                        average_types)
+    else:
+        cur.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS);'
+                    % (name, table))
+    cur.execute('''WITH moved AS
+                     (DELETE FROM %s_default
+                      WHERE %s >= %%s AND %s < %%s
+                      RETURNING *)
+                   INSERT INTO %s SELECT * FROM moved;'''
+                % (table, column, column, name), (start, end))
+    cur.execute('''ALTER TABLE %s ATTACH PARTITION %s
+                   FOR VALUES FROM (%%s) TO (%%s);''' % (table, name),
+                (start, end))
+    return True
+
+
+def detach_partition(cur, table, name):
+    '''
+    Detach the partition name from table, leaving it as an ordinary
+    table (to be backed up, archived, or dropped).
+    '''
+    cur.execute('ALTER TABLE %s DETACH PARTITION %s;' % (table, name))
@@ -0,0 +1,149 @@
+'''
+    Turns the rows of a graph query into a (time x sensor) matrix.
+
+    The graph queries (PowerAverage.graph_data_execute and the like)
+    return one row per sensor and period:  (kilowatts, sensor id,
+    truncated reading time), ordered by time, sensor group, and
+    sensor.  build_pivot() places them into a NumPy matrix with one
+    row per period, from the first period to the last with gaps
+    included, and one column per sensor, grouped by sensor group.
+    Missing readings are NaN.  Building totals and timestamps are then
+    whole-array operations, rather than a Python loop per cell.
+
+    Requires NumPy.
+'''
+
+import datetime
+import numpy
+
+
+class Pivot(object):
+    '''
+    periods: the truncated reading time of each row, as datetimes.
+    layout: [(sensor group id, [sensor id, ...]), ...], in column
+        order.
+    values: a (len(periods) x number of sensors) array of kilowatts,
+        NaN where a sensor has no reading.
+    '''
+
+    def __init__(self, periods, layout, values):
+        self.periods = periods
+        self.layout = layout
+        self.values = values
+
+    def __len__(self):
+        return len(self.periods)
+
+    def group_columns(self):
+        '''
+        Return [(sensor group id, first column, end column), ...].
+        '''
+        columns = []
+        start = 0
+        for sg_id, sensor_ids in self.layout:
+            columns.append((sg_id, start, start + len(sensor_ids)))
+            start += len(sensor_ids)
+        return columns
+
+    def partial_sums(self):
+        '''
+        Return an array like values, but where each entry is the sum
+        of that sensor's reading and those of the sensors before it in
+        its group (NaN once any of them is missing).  The last column
+        of each group is therefore the building total.
+        '''
+        sums = numpy.empty_like(self.values)
+        for sg_id, start, end in self.group_columns():
+            # NaN propagates through the sum, as None did before.
+            sums[:, start:end] = numpy.cumsum(self.values[:, start:end],
+                                              axis=1)
+        return sums
+
+    def group_sums(self):
+        '''
+        Return a (len(periods) x number of groups) array of building
+        totals, NaN where any of a building's sensors has no reading.
+        '''
+        sums = self.partial_sums()
+        return sums[:, [end - 1 for sg_id, start, end in
+                        self.group_columns()]]
+
+    def timestamps_ms(self):
+        '''
+        Return the periods as an array of milliseconds since the epoch
+        (treating the naive periods as UTC, as the graphs do).
+        '''
+        periods = numpy.array(self.periods, dtype='datetime64[ms]')
+        return periods.astype(numpy.int64)
+
+
+def _to_float(value):
+    if value is None:
+        return numpy.nan
+    return float(value)
+
+
+def build_pivot(rows, per_incr, layout, first=None):
+    '''
+    Build a Pivot from rows of (kilowatts or None, sensor id,
+    truncated reading time) in graph query order, for periods
+    per_incr (a timedelta) apart.  layout is as for Pivot; rows of
+    sensors not in it are ignored.  The first period is first if
+    given (to continue a previous Pivot; no row may be before it),
+    else the first row's time.  Return None if there are no rows.
+    '''
+    column_of = {}
+    for sensor_id in [s for sg_id, sensor_ids in layout
+                      for s in sensor_ids]:
+        column_of[sensor_id] = len(column_of)
+    rows = [r for r in rows if r[1] in column_of]
+    if not rows:
+        return None
+
+    if first is None:
+        first = rows[0][2]
+    times = numpy.array([r[2] for r in rows], dtype='datetime64[us]')
+    offsets = (times - numpy.datetime64(first, 'us')).astype(numpy.int64)
+    step = ((per_incr.days * 86400 + per_incr.seconds) * 1000000
+            + per_incr.microseconds)
+    index = offsets // step
+    columns = numpy.array([column_of[r[1]] for r in rows])
+    cells = index * len(column_of) + columns
+
+    if (offsets % step).any() or len(numpy.unique(cells)) != len(cells):
+        # Periods that don't fall on the grid (e.g. months, which are
+        # not all the same length) or repeat (e.g. when the clocks go
+        # back):  place the rows one by one.
+        return _build_pivot_sequential(rows, per_incr, layout, column_of,
+                                       first)
+
+    num_periods = int(index[-1]) + 1
+    values = numpy.empty((num_periods, len(column_of)))
+    values.fill(numpy.nan)
+    values.flat[cells] = [_to_float(r[0]) for r in rows]
+    periods = [first + i * per_incr for i in xrange(num_periods)]
+    return Pivot(periods, layout, values)
+
+
+def _build_pivot_sequential(rows, per_incr, layout, column_of, first):
+    '''
+    Build a Pivot by walking the rows in order, as the graphs always
+    used to:  a row belongs to the current period if its time is not
+    after it, and each sensor takes at most one row per period.
+    '''
+    periods = []
+    table = []
+    i = 0
+    per = first
+    while i < len(rows):
+        cells = [numpy.nan] * len(column_of)
+        for sg_id, sensor_ids in layout:
+            for sensor_id in sensor_ids:
+                if i < len(rows) and rows[i][2] <= per \
+                        and rows[i][1] == sensor_id:
+                    cells[column_of[sensor_id]] = _to_float(rows[i][0])
+                    i += 1
+        periods.append(per)
+        table.append(cells)
+        per += per_incr
+    return Pivot(periods, layout, numpy.array(table, dtype=float))
@@ -0,0 +1,148 @@
+'''
+    Bulk export of raw sensor readings, for the data access page.
+
+    The readings are selected with COPY ... TO STDOUT, which PostgreSQL
+    formats as CSV itself, far faster than fetching rows into Python.
+    psycopg2's copy_expert() writes that output to a file object, a
+    row at a time, and only returns when it is done, so it runs in a
+    thread of its own, collecting the rows into chunks of about
+    COPY_CHUNK_SIZE bytes and putting those into a bounded queue;
+    stream() yields from the queue as the response is sent.  The
+    thread therefore never gets more than RAW_EXPORT_QUEUE_SIZE chunks
+    ahead of the client, and the export takes the same memory however
+    long its range.  If the COPY fails part of the way, stream() raises
+    ExportFailed, so that the response is cut off rather than ending
+    as if the CSV were complete.
+'''
+
+import logging, threading, Queue
+from django.conf import settings
+from energyweb.graph import connections
+from energyweb.graph.rhizome import READING_FIELDS
+
+
+RAW_COLUMNS = ('sensor_id', 'reading_time') + READING_FIELDS
+
+# Bytes of rows put into the queue at a time.
+COPY_CHUNK_SIZE = 65536
+
+# Mark the end of the output in the queue, and a failed COPY.
+_DONE = object()
+_FAILED = object()
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+class ExportFailed(Exception):
+    pass
+
+
+class _QueueFile(object):
+    '''
+    The file object copy_expert() writes to:  collects the writes (one
+    per row) and puts them into a queue about COPY_CHUNK_SIZE bytes at
+    a time, waiting while it is full, until cancelled.
+    '''
+
+    def __init__(self, queue, cancelled):
+        self.queue = queue
+        self.cancelled = cancelled
+        self.buffer = []
+        self.size = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= COPY_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.put(''.join(self.buffer))
+            self.buffer = []
+            self.size = 0
+
+    def put(self, item):
+        while True:
+            if self.cancelled.isSet():
+                # (Aborts the COPY.)
+                raise ExportCancelled()
+            try:
+                self.queue.put(item, True, 1)
+                return
+            except Queue.Full:
+                pass
+
+
+def copy_sql(cur, sensor_ids, start_dt, end_dt):
+    '''
+    Return the COPY statement exporting the readings of the given
+    sensors from start_dt (inclusive) to end_dt (exclusive), as CSV
+    with a header line.
+    '''
+    return ('COPY (SELECT ' + ', '.join(RAW_COLUMNS)
+            + cur.mogrify(''' FROM graph_sensorreading
+                              WHERE sensor_id IN %s
+                                AND reading_time >= %s
+                                AND reading_time < %s
+                              ORDER BY sensor_id, reading_time''',
+                          (tuple(sensor_ids), start_dt, end_dt))
+            + ') TO STDOUT WITH CSV HEADER;')
+
+
+def stream(sensor_ids, start_dt, end_dt):
+    '''
+    Generate the CSV of the readings of the given sensors from
+    start_dt to end_dt, in chunks.  Uses a connection of its own (see
+    connections.py).  If the generator is closed early (e.g. because
+    the client went away), the COPY is abandoned; if the COPY fails,
+    raises ExportFailed after the chunks before it.
+    '''
+    conn = connections.connect()
+    queue = Queue.Queue(settings.RAW_EXPORT_QUEUE_SIZE)
+    cancelled = threading.Event()
+
+    def copy():
+        out = _QueueFile(queue, cancelled)
+        try:
+            cur = conn.cursor()
+            cur.copy_expert(copy_sql(cur, sensor_ids, start_dt, end_dt), out)
+            conn.rollback()
+            out.flush()
+            out.put(_DONE)
+        except ExportCancelled:
+            pass
+        except Exception, detail:
+            if not cancelled.isSet():
+                logging.error('Raw export failed: %s' % detail)
+                try:
+                    # (Not the rows collected:  the client gets an
+                    # error either way.)
+                    out.put(_FAILED)
+                except ExportCancelled:
+                    pass
+
+    thread = threading.Thread(target=copy, name='RawExport')
+    thread.setDaemon(True)
+    thread.start()
+    try:
+        while True:
+            chunk = queue.get()
+            if chunk is _DONE:
+                break
+            if chunk is _FAILED:
+                raise ExportFailed('The export of the readings failed.')
+            yield chunk
+    finally:
+        cancelled.set()
+        if thread.isAlive() and hasattr(conn, 'cancel'):
+            # Stop the query rather than wait for its next chunk.
+            # (psycopg2 2.3 and later.)
+            try:
+                conn.cancel()
+            except Exception:
+                pass
+        thread.join()
+        conn.close()
@@ -0,0 +1,79 @@
+'''
+    Caches the JSON behind the polled views (dynamic_graph_data and
+    statistics_table_data), so that however many browsers are polling,
+    each tick costs one set of queries.
+
+    A response is cached under (view, resolution, start, scope) and
+    the current data generation.  The start is exact, since a response
+    holds the points from it on; views without one (the table) are
+    cached per GRAPH_CACHE_BUCKET-second bucket of the time instead.
+    (Clients polling the dynamic graph all ask from the last record of
+    their previous response, so they still share entries.)  The
+    monitors' writer bumps the generation whenever it writes the
+    averages the polled views show (see invalidate()), so a new
+    generation means new keys and the old entries simply expire.
+    This only works across processes with a shared cache backend
+    (memcached); GRAPH_CACHE_TIMEOUT bounds how stale an entry can get
+    otherwise.
+'''
+
+import calendar, datetime
+from django.conf import settings
+from django.core.cache import cache
+
+
+GENERATION_KEY = 'energyweb_graph_generation'
+
+# Writing averages of these types changes what the polled views show.
+INVALIDATING_TYPES = ('second*10', 'minute')
+
+# (The longest timeout memcached accepts.)
+GENERATION_TIMEOUT = 30 * 24 * 3600
+
+
+def generation():
+    g = cache.get(GENERATION_KEY)
+    if g is None:
+        cache.add(GENERATION_KEY, 0, GENERATION_TIMEOUT)
+        g = cache.get(GENERATION_KEY, 0)
+    return g
+
+
+def invalidate():
+    '''
+    Start a new generation, so that no cached response is used again.
+    '''
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        # Not cached yet (or evicted).
+        cache.add(GENERATION_KEY, 1, GENERATION_TIMEOUT)
+
+
+def bucket(dt):
+    '''
+    Return the start of the cache bucket of datetime dt, in seconds
+    since the epoch.
+    '''
+    t = calendar.timegm(dt.timetuple())
+    return t - t % settings.GRAPH_CACHE_BUCKET
+
+
+def cached(view, res, start_dt, scope, compute):
+    '''
+    Return the cached result for these arguments, calling compute()
+    (which must return something picklable, e.g. a JSON string) and
+    caching its result if there is none.  start_dt is None for views
+    whose result does not depend on a start time.
+    '''
+    if start_dt is None:
+        start = 'b%d' % bucket(datetime.datetime.utcnow())
+    else:
+        start = '%d' % calendar.timegm(start_dt.timetuple())
+    key = 'energyweb_graph:%s:%s:%s:%s:%d' % (view, res, start, scope,
+                                              generation())
+    result = cache.get(key)
+    if result is None:
+        result = compute()
+        cache.set(key, result, settings.GRAPH_CACHE_TIMEOUT)
+    return result
@@ -0,0 +1,217 @@
+'''
+    Enforces settings.RETENTION_POLICY, which says how many days of
+    raw sensor readings and of each type of power average to keep.
+
+    Where a table is partitioned (see partitions.py), partitions that
+    hold nothing but expired rows are dropped whole.  Remaining expired
+    rows are deleted in batches of a bounded size, each in its own
+    transaction, so that no lock is held for long and the monitors can
+    keep writing in between.
+'''
+
+import datetime
+from django.conf import settings
+from energyweb.graph.models import PowerAverage
+from energyweb.graph import partitions
+
+
+# What the policy can name:  raw readings, or a type of power average.
+RETENTION_TARGETS = ('reading',) + PowerAverage.AVERAGE_TYPES
+
+
+def policy_cutoffs(policy=None, now=None):
+    '''
+    Return a dictionary mapping each target in the policy (default:
+    settings.RETENTION_POLICY) that expires to the datetime before
+    which its rows are expired.  Targets kept forever are left out.
+    '''
+    if policy is None:
+        policy = settings.RETENTION_POLICY
+    if now is None:
+        now = datetime.datetime.now()
+    cutoffs = {}
+    for target, days in policy.iteritems():
+        if target not in RETENTION_TARGETS:
+            raise ValueError('Invalid retention target \'%s\'.' % target)
+        if days is not None:
+            cutoffs[target] = now - datetime.timedelta(days)
+    return cutoffs
+
+
+def expired_partitions(cur, cutoffs):
+    '''
+    Return the names of the partitions (or, for graph_poweraverage,
+    average type sub-partitions) that only hold expired rows, as a list
+    of (parent table, partition) pairs.  (Not the legacy partition,
+    which holds every month before partitioning.)
+    '''
+    expired = []
+    if partitions.is_partitioned(cur, 'graph_sensorreading') \
+            and 'reading' in cutoffs:
+        for name in partitions.list_partitions(cur, 'graph_sensorreading'):
+            month = partitions.partition_month(name)
+            if month is not None \
+                    and partitions.add_months(month, 1) <= cutoffs['reading']:
+                expired.append(('graph_sensorreading', name))
+    if partitions.is_partitioned(cur, 'graph_poweraverage'):
+        for name in partitions.list_partitions(cur, 'graph_poweraverage'):
+            month = partitions.partition_month(name)
+            if month is None:
+                continue
+            end = partitions.add_months(month, 1)
+            existing = partitions.list_partitions(cur, name)
+            for suffix, average_types in partitions.POWER_AVERAGE_KINDS:
+                sub_name = '%s_%s' % (name, suffix)
+                if sub_name not in existing:
+                    continue
+                for average_type in average_types:
+                    if average_type not in cutoffs \
+                            or end > cutoffs[average_type]:
+                        break
+                else:
+                    expired.append((name, sub_name))
+    return expired
+
+
+def drop_partition(cur, name):
+    '''
+    Drop a partition, returning the bytes it used.
+    '''
+    size = partitions.table_size(cur, name)
+    cur.execute('DROP TABLE %s;' % name)
+    return size
+
+
+def delete_readings(cur, cutoff, batch_size):
+    '''
+    Delete up to batch_size sensor readings from before cutoff, and
+    their profiles.  Return the number of readings deleted.
+    '''
+    cur.execute('''SELECT id FROM graph_sensorreading
+                   WHERE reading_time < %s
+                   LIMIT %s;''', (cutoff, batch_size))
+    ids = [r[0] for r in cur.fetchall()]
+    if not ids:
+        return 0
+    cur.execute('''DELETE FROM graph_srprofile
+                   WHERE sensor_reading_id IN %s;''', (tuple(ids),))
+    cur.execute('''DELETE FROM graph_sensorreading
+                   WHERE reading_time < %s AND id IN %s;''',
+                (cutoff, tuple(ids)))
+    return cur.rowcount
+
+
+def delete_orphan_profiles(cur, batch_size):
+    '''
+    Delete up to batch_size profiles of readings that were dropped with
+    their partition.  (Reading ids grow with time, so these are the
+    profiles of readings older than the oldest remaining one.)  Return
+    the number deleted.
+    '''
+    cur.execute('''DELETE FROM graph_srprofile
+                   WHERE id IN
+                     (SELECT id FROM graph_srprofile
+                      WHERE sensor_reading_id <
+                        (SELECT COALESCE(MIN(id), 0)
+                         FROM graph_sensorreading)
+                      LIMIT %s);''', (batch_size,))
+    return cur.rowcount
+
+
+def delete_averages(cur, average_type, cutoff, batch_size):
+    '''
+    Delete up to batch_size power averages and up to batch_size
+    sensor group averages of average_type from before cutoff.  Return
+    the larger of the numbers deleted.
+    '''
+    cur.execute('''DELETE FROM graph_sensorgroupaverage
+                   WHERE id IN
+                     (SELECT id FROM graph_sensorgroupaverage
+                      WHERE average_type = %s
+                        AND trunc_reading_time < %s
+                      LIMIT %s);''', (average_type, cutoff, batch_size))
+    num_deleted = cur.rowcount
+    cur.execute('''DELETE FROM graph_poweraverage
+                   WHERE average_type = %s
+                     AND trunc_reading_time < %s
+                     AND id IN
+                       (SELECT id FROM graph_poweraverage
+                        WHERE average_type = %s
+                          AND trunc_reading_time < %s
+                        LIMIT %s);''',
+                (average_type, cutoff, average_type, cutoff, batch_size))
+    return max(num_deleted, cur.rowcount)
+
+
+# For counting what would be deleted (in dry runs):  rows outside
+# the partitions named by the (non-empty) tuple parameter, which are
+# dropped whole before any rows are deleted.
+_NOT_DROPPED_SQL = '''tableoid NOT IN (SELECT oid FROM pg_class
+                                       WHERE relname IN %s)'''
+
+
+def _dropped_names(dropped):
+    # (IN () is a syntax error.)
+    return tuple(dropped) or ('',)
+
+
+def count_readings(cur, cutoff, dropped=()):
+    '''
+    Return the number of sensor readings delete_readings would delete
+    before cutoff, once the partitions named in dropped are gone.
+    '''
+    cur.execute('''SELECT COUNT(*) FROM graph_sensorreading
+                   WHERE reading_time < %s
+                     AND ''' + _NOT_DROPPED_SQL + ';',
+                (cutoff, _dropped_names(dropped)))
+    return cur.fetchone()[0]
+
+
+def count_orphan_profiles(cur, cutoff, dropped=()):
+    '''
+    Return the number of profiles delete_orphan_profiles would delete
+    once the readings before cutoff are gone:  those of readings older
+    than the oldest kept, other than the profiles delete_readings
+    deletes with their readings.
+    '''
+    cur.execute('''SELECT COUNT(*) FROM graph_srprofile p
+                   WHERE p.sensor_reading_id <
+                       (SELECT COALESCE(MIN(id), 0)
+                        FROM graph_sensorreading
+                        WHERE reading_time >= %s)
+                     AND NOT EXISTS
+                       (SELECT 1 FROM graph_sensorreading
+                        WHERE id = p.sensor_reading_id
+                          AND reading_time < %s
+                          AND ''' + _NOT_DROPPED_SQL + ');',
+                (cutoff, cutoff, _dropped_names(dropped)))
+    return cur.fetchone()[0]
+
+
+def count_averages(cur, average_type, cutoff, dropped=()):
+    '''
+    Return the number delete_averages would delete of average_type
+    before cutoff, once the partitions named in dropped are gone (the
+    larger of the power averages' and sensor group averages').
+    '''
+    cur.execute('''SELECT COUNT(*) FROM graph_sensorgroupaverage
+                   WHERE average_type = %s
+                     AND trunc_reading_time < %s;''',
+                (average_type, cutoff))
+    num_group = cur.fetchone()[0]
+    cur.execute('''SELECT COUNT(*) FROM graph_poweraverage
+                   WHERE average_type = %s
+                     AND trunc_reading_time < %s
+                     AND ''' + _NOT_DROPPED_SQL + ';',
+                (average_type, cutoff, _dropped_names(dropped)))
+    return max(num_group, cur.fetchone()[0])
+
+
+def average_row_size(cur, table):
+    '''
+    Estimate the bytes each row of table takes (with its indexes).
+    '''
+    rows = partitions.table_rows(cur, table)
+    if rows < 1:
+        return 0
+    return partitions.table_size(cur, table) / rows
@@ -0,0 +1,222 @@
+'''
+    Decodes the messages sent by Rhizome Systems energy monitoring
+    devices.
+
+    Each message (frame) is 45 bytes, all integers big-endian:
+
+        bytes  0-3   'RTSD' (the magic string marking a frame)
+        byte   4     rindex
+        bytes  5-22  {a,b,c}watthr, {a,b,c}varhr, {a,b,c}vahr (16 bits)
+        bytes 23-40  {a,b,c}irms, {a,b,c}vrms (24 bits)
+        bytes 41-42  frequency (the top 12 bits)
+        byte  43     temperature register (0xDF at 25C, 3C per step)
+        byte  44     unused
+
+    decode() unpacks one frame with a precompiled struct.Struct,
+    reading straight out of the receive buffer, into a RhizomeReading.
+    decode_many() decodes a whole string of frames at once with NumPy,
+    for replaying and backfilling stored data.
+'''
+
+import struct
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+MAGIC = 'RTSD' # 52 54 53 44 in hex
+FRAME_LENGTH = 45
+
+# Fields of a decoded frame, in the same order as the corresponding
+# columns of graph_sensorreading.
+READING_FIELDS = ('rindex',
+                  'awatthr', 'bwatthr', 'cwatthr',
+                  'avarhr', 'bvarhr', 'cvarhr',
+                  'avahr', 'bvahr', 'cvahr',
+                  'airms', 'birms', 'cirms',
+                  'avrms', 'bvrms', 'cvrms',
+                  'freq', 'tempc')
+
+# Fields that are scaled by the sensor's conversion factor.
+FACTOR_FIELDS = ('awatthr', 'bwatthr', 'cwatthr',
+                 'avarhr', 'bvarhr', 'cvarhr',
+                 'avahr', 'bvahr', 'cvahr',
+                 'airms', 'birms', 'cirms')
+
+TEMP_OFFSET = 0xdf
+
+RhizomeReading = namedtuple('RhizomeReading', READING_FIELDS)
+
+# struct has no 24-bit integer, so each 24-bit value is read as a
+# byte (the high 8 bits) followed by a short (the low 16 bits).
+FRAME_STRUCT = struct.Struct('>4sB9H' + 'BH' * 6 + 'HBx')
+
+
+def is_frame(data, offset=0):
+    '''
+    Return whether data (a string or bytearray) holds a frame's magic
+    string at offset.
+    '''
+    return data[offset:offset + 4] == MAGIC
+
+
+def decode(data, factor=1, offset=0):
+    '''
+    Decode the frame starting at offset in data (anything struct
+    accepts: a string, bytearray, or buffer), returning a
+    RhizomeReading.  The magic string is not checked; see is_frame.
+    '''
+    (magic, rindex,
+     awatthr, bwatthr, cwatthr,
+     avarhr, bvarhr, cvarhr,
+     avahr, bvahr, cvahr,
+     airms_hi, airms_lo, birms_hi, birms_lo, cirms_hi, cirms_lo,
+     avrms_hi, avrms_lo, bvrms_hi, bvrms_lo, cvrms_hi, cvrms_lo,
+     freq, temp) = FRAME_STRUCT.unpack_from(data, offset)
+    return RhizomeReading(
+        rindex,
+        factor * awatthr, factor * bwatthr, factor * cwatthr,
+        factor * avarhr, factor * bvarhr, factor * cvarhr,
+        factor * avahr, factor * bvahr, factor * cvahr,
+        factor * ((airms_hi << 16) | airms_lo),
+        factor * ((birms_hi << 16) | birms_lo),
+        factor * ((cirms_hi << 16) | cirms_lo),
+        (avrms_hi << 16) | avrms_lo,
+        (bvrms_hi << 16) | bvrms_lo,
+        (cvrms_hi << 16) | cvrms_lo,
+        freq >> 4,
+        # for tempc:  at 25C, register = DF = Offset
+        25 + (temp - TEMP_OFFSET) * 3)
+
+
+if numpy is not None:
+    FRAME_DTYPE = numpy.dtype(
+        [('magic', 'S4'), ('rindex', 'u1')]
+        + [(f, '>u2') for f in READING_FIELDS[1:10]]
+        + [(f + suffix, t) for f in READING_FIELDS[10:16]
+           for (suffix, t) in (('_hi', 'u1'), ('_lo', '>u2'))]
+        + [('freq', '>u2'), ('tempc', 'u1'), ('unused', 'u1')])
+    assert FRAME_DTYPE.itemsize == FRAME_LENGTH
+
+
+def decode_many(data, factor=1):
+    '''
+    Decode a string of back-to-back frames (its length must be a
+    multiple of FRAME_LENGTH) with NumPy.  Return a dictionary mapping
+    each of READING_FIELDS to an array with one entry per frame, plus
+    'valid', a boolean array marking the frames with the right magic
+    string.  Requires NumPy.
+    '''
+    if numpy is None:
+        raise ImportError('decode_many requires NumPy.')
+    if len(data) % FRAME_LENGTH:
+        raise ValueError('Data length %d is not a multiple of %d.'
+                         % (len(data), FRAME_LENGTH))
+    frames = numpy.frombuffer(data, dtype=FRAME_DTYPE)
+    d = {'valid': frames['magic'] == MAGIC,
+         'rindex': frames['rindex'].astype(numpy.int32)}
+    for f in READING_FIELDS[1:10]:
+        d[f] = frames[f].astype(numpy.int64)
+    for f in READING_FIELDS[10:16]:
+        d[f] = ((frames[f + '_hi'].astype(numpy.int64) << 16)
+                | frames[f + '_lo'])
+    d['freq'] = frames['freq'].astype(numpy.int32) >> 4
+    d['tempc'] = 25 + (frames['tempc'].astype(numpy.int32) - TEMP_OFFSET) * 3
+    if factor != 1:
+        for f in FACTOR_FIELDS:
+            d[f] = d[f] * factor
+    return d
+
+
+class RhizomeFramer(object):
+    '''
+    Splits the byte stream from a device into frames.  Data from each
+    recv() is passed to feed(); next_frame() then returns complete
+    frames one at a time.  Bytes left over after a frame are kept for
+    the next one.  If the buffer does not start with the magic string
+    (a corrupt or partial frame), the framer skips ahead to the next
+    occurrence of it instead of giving up on the connection; each such
+    skip counts as a resync.
+    '''
+
+    def __init__(self):
+        self.buffer = bytearray()
+        # Index of the first unconsumed byte in buffer.  Consumed bytes
+        # are only discarded once they make up half the buffer, so each
+        # byte is moved at most once or twice.
+        self.start = 0
+        self.resyncs = 0
+        self.bytes_skipped = 0
+        self.in_sync = True
+
+    def __len__(self):
+        return len(self.buffer) - self.start
+
+    def feed(self, data):
+        self.buffer.extend(data)
+
+    def clear(self):
+        '''
+        Discard any buffered bytes (e.g. when the connection is
+        reopened).  The resync counters are kept.
+        '''
+        self.buffer = bytearray()
+        self.start = 0
+
+    def pending(self):
+        '''
+        Return the bytes not yet returned as part of a frame.
+        '''
+        return str(self.buffer[self.start:])
+
+    def _consume(self, n):
+        self.start += n
+        if self.start * 2 >= len(self.buffer):
+            del self.buffer[:self.start]
+            self.start = 0
+
+    def _skip(self, n):
+        '''
+        Discard n bytes that are not part of a frame.  A run of skips
+        between two good frames counts as one resync.
+        '''
+        if self.in_sync:
+            self.resyncs += 1
+            self.in_sync = False
+        self.bytes_skipped += n
+        self._consume(n)
+
+    def next_frame(self):
+        '''
+        Return the next complete frame (a string of FRAME_LENGTH
+        bytes, starting with the magic string), or None if more data
+        is needed.
+        '''
+        while True:
+            i = self.buffer.find(MAGIC, self.start)
+            if i < 0:
+                # Keep just enough to complete a magic string split
+                # across two recv() calls.
+                skip = len(self) - min(len(self), len(MAGIC) - 1)
+                if skip:
+                    self._skip(skip)
+                return None
+            if i > self.start:
+                self._skip(i - self.start)
+            if len(self) < FRAME_LENGTH:
+                return None
+            # A magic string inside the frame means this one was cut
+            # short and the next has already begun.  (By chance, a
+            # frame's data matches it about once in 10**8 frames.)
+            j = self.buffer.find(MAGIC, self.start + 1,
+                                 self.start + FRAME_LENGTH)
+            if j >= 0:
+                self._skip(j - self.start)
+                continue
+            frame = str(self.buffer[self.start:self.start + FRAME_LENGTH])
+            self._consume(FRAME_LENGTH)
+            self.in_sync = True
+            return frame
@@ -0,0 +1,225 @@
+'''
+    In-memory power average rollups for the energy monitors.
+
+    For each sensor, the RollupEngine keeps the open (in-progress)
+    bucket of every average type as a running sum and count.  A bucket
+    is written to graph_poweraverage when it closes, i.e. when a
+    reading arrives that falls into the next bucket.  Open buckets are
+    only written at checkpoints (every MON_ROLLUP_CHECKPOINT_INTERVAL
+    seconds, and on shutdown), so most readings cause no UPDATEs at
+    all.  On restart, load() recovers the open buckets from the last
+    checkpoint plus any readings stored since.
+
+    When an hour's bucket closes, the sensor's running energy total
+    (EnergyPrefix; see energy.py) is carried past it and written too.
+'''
+
+import time, logging
+from django.conf import settings
+from django.db.models import Avg, Max, Min, Count
+from energyweb.graph.models import PowerAverage, SensorReading, \
+                                   EnergyPrefix
+
+
+class Bucket(object):
+    '''
+    The running total of one open power average.  power_average is the
+    PowerAverage object the bucket is written to (so that a bucket
+    written at a checkpoint keeps its primary key).
+    '''
+    __slots__ = ('average_type', 'trunc_reading_time', 'watt_sum',
+                 'num_points', 'first_reading_time', 'last_reading_time',
+                 'power_average')
+
+    def __init__(self, sensor, average_type, trunc_reading_time,
+                 power_average=None):
+        self.average_type = average_type
+        self.trunc_reading_time = trunc_reading_time
+        self.watt_sum = 0.0
+        self.num_points = 0
+        self.first_reading_time = None
+        self.last_reading_time = None
+        if power_average is None:
+            power_average = PowerAverage(sensor=sensor,
+                                         average_type=average_type,
+                                         trunc_reading_time=trunc_reading_time)
+        self.power_average = power_average
+
+    def add(self, reading_time, watts, num_points=1):
+        self.watt_sum += watts * num_points
+        self.num_points += num_points
+        if (self.first_reading_time is None
+            or reading_time < self.first_reading_time):
+            self.first_reading_time = reading_time
+        if (self.last_reading_time is None
+            or reading_time > self.last_reading_time):
+            self.last_reading_time = reading_time
+
+    def to_power_average(self):
+        '''
+        Copy the running total into the bucket's PowerAverage (which
+        is returned, unsaved).
+        '''
+        pa = self.power_average
+        pa.watts = self.watt_sum / self.num_points
+        pa.watt_hours = self.watt_sum * settings.READING_INTERVAL / 3600.0
+        pa.num_points = self.num_points
+        pa.first_reading_time = self.first_reading_time
+        pa.last_reading_time = self.last_reading_time
+        return pa
+
+
+class RollupEngine(object):
+    '''
+    Open power average buckets for one sensor.  Closed buckets and
+    checkpoints are handed to writer (a ReadingWriter).
+    '''
+
+    def __init__(self, sensor, writer, checkpoint_interval=None):
+        if checkpoint_interval is None:
+            checkpoint_interval = settings.MON_ROLLUP_CHECKPOINT_INTERVAL
+        self.sensor = sensor
+        self.writer = writer
+        self.checkpoint_interval = checkpoint_interval
+        self.buckets = dict([[t, None] for t in PowerAverage.AVERAGE_TYPES])
+        self.next_checkpoint = time.time() + checkpoint_interval
+        # The latest running energy total (an EnergyPrefix), if any.
+        self.prefix = None
+
+    def load(self):
+        '''
+        Recover the open bucket of each average type: start from the
+        latest power average in the database (the last checkpoint) and
+        add any readings stored after it.  Buckets with no checkpoint
+        at all are computed from the readings.  Recovered buckets are
+        written at the next checkpoint.
+        '''
+        try:
+            self.prefix = EnergyPrefix.objects.filter(
+                sensor=self.sensor).latest('prefix_time')
+        except EnergyPrefix.DoesNotExist:
+            self.prefix = None
+        power_average_qs = PowerAverage.objects.filter(
+            sensor=self.sensor).order_by('-trunc_reading_time')
+        sensor_reading_qs = SensorReading.objects.filter(
+            sensor=self.sensor).order_by('-reading_time')
+        try:
+            latest_reading = sensor_reading_qs.latest('reading_time')
+        except SensorReading.DoesNotExist:
+            return
+
+        for average_type in PowerAverage.AVERAGE_TYPES:
+            # Don't confuse trunc_latest_reading_time with the
+            # similarly-named column of graph_poweraverage.
+            # trunc_latest_reading_time is the truncated
+            # reading_time of the latest row in graph_sensorreading
+            # for this sensor.
+            trunc_latest_reading_time = PowerAverage.date_trunc(
+                average_type, latest_reading.reading_time)
+
+            try:
+                latest_average = power_average_qs.filter(
+                    average_type=average_type).latest('trunc_reading_time')
+            except PowerAverage.DoesNotExist:
+                latest_average = None
+
+            if latest_average is not None and (trunc_latest_reading_time
+                == latest_average.trunc_reading_time):
+                bucket = Bucket(self.sensor, average_type,
+                                trunc_latest_reading_time, latest_average)
+                bucket.add(latest_average.first_reading_time,
+                           latest_average.watts, latest_average.num_points)
+                bucket.add(latest_average.last_reading_time, 0, 0)
+                since = latest_average.last_reading_time
+            else:
+                # (A later checkpoint than the latest reading can't
+                # happen; treat it like a missing one.)
+                bucket = Bucket(self.sensor, average_type,
+                                trunc_latest_reading_time)
+                since = None
+
+            qs = sensor_reading_qs.filter(
+                reading_time__gte=trunc_latest_reading_time)
+            if since is not None:
+                qs = qs.filter(reading_time__gt=since)
+            aggr = qs.aggregate(
+                awatthr=Avg('awatthr'),
+                bwatthr=Avg('bwatthr'),
+                cwatthr=Avg('cwatthr'),
+                num_points=Count('sensor'),
+                first_reading_time=Min('reading_time'),
+                last_reading_time=Max('reading_time'))
+            if aggr['num_points']:
+                watts = aggr['awatthr'] + aggr['bwatthr'] + aggr['cwatthr']
+                bucket.add(aggr['first_reading_time'], watts,
+                           aggr['num_points'])
+                bucket.add(aggr['last_reading_time'], 0, 0)
+
+            if bucket.num_points:
+                self.buckets[average_type] = bucket
+        self.checkpoint()
+
+    def add(self, reading_time, watts):
+        '''
+        Add a reading to the open bucket of every average type.
+        Buckets that the reading closes are handed to the writer.
+        Return (number of buckets opened, number handed to the writer).
+        '''
+        num_opened = 0
+        num_written = 0
+        for average_type in PowerAverage.AVERAGE_TYPES:
+            trunc_reading_time = PowerAverage.date_trunc(average_type,
+                                                         reading_time)
+            bucket = self.buckets[average_type]
+            if (bucket is None
+                or bucket.trunc_reading_time != trunc_reading_time):
+                if bucket is not None:
+                    power_average = bucket.to_power_average()
+                    self.writer.add_average(power_average)
+                    num_written += 1
+                    if average_type == 'hour':
+                        self.close_hour(power_average)
+                bucket = Bucket(self.sensor, average_type,
+                                trunc_reading_time)
+                self.buckets[average_type] = bucket
+                num_opened += 1
+            bucket.add(reading_time, watts)
+
+        if time.time() >= self.next_checkpoint:
+            num_written += self.checkpoint()
+        return (num_opened, num_written)
+
+    def close_hour(self, power_average):
+        '''
+        Hand the writer the running energy total after a closed hour
+        average.
+        '''
+        start = power_average.trunc_reading_time
+        if self.prefix is not None and self.prefix.prefix_time > start:
+            # Already counted (e.g. rebuilt by create_power_averages).
+            return
+        watt_hours = power_average.watt_hours
+        num_points = power_average.num_points
+        if self.prefix is not None:
+            watt_hours += self.prefix.watt_hours
+            num_points += self.prefix.num_points
+        self.prefix = EnergyPrefix(
+            sensor=self.sensor,
+            prefix_time=start + PowerAverage.AVERAGE_TYPE_TIMEDELTAS['hour'],
+            watt_hours=watt_hours, num_points=num_points)
+        self.writer.add_prefix(self.prefix)
+
+    def checkpoint(self):
+        '''
+        Hand every open bucket to the writer.  Return the number of
+        buckets handed over.
+        '''
+        self.next_checkpoint = time.time() + self.checkpoint_interval
+        num_written = 0
+        for bucket in self.buckets.itervalues():
+            if bucket is not None:
+                self.writer.add_average(bucket.to_power_average())
+                num_written += 1
+        logging.debug('Sensor %d: checkpointed %d open averages.'
+                      % (self.sensor.pk, num_written))
+        return num_written
@@ -21,3 +21,231 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+
+from binascii import unhexlify
+from energyweb.graph import rhizome
+
+class RhizomeDecodeTest(TestCase):
+    FRAME = unhexlify('525453440006c706c80588046d029602d3081f0768064207b5a2'
+                      '074dd605e3d308d29908d70808d55b03c0e000')
+
+    def test_decode(self):
+        """
+        Tests that a frame from the faker profiles decodes to the
+        values the original ord()-based decoding gave.
+        """
+        r = rhizome.decode(self.FRAME)
+        self.failUnless(rhizome.is_frame(self.FRAME))
+        self.failUnlessEqual((r.rindex, r.awatthr, r.bwatthr, r.cwatthr),
+                             (0, 1735, 1736, 1416))
+        self.failUnlessEqual((r.airms, r.avrms, r.freq, r.tempc),
+                             (505250, 578201, 60, 28))
+
+    def test_decode_factor(self):
+        """
+        Tests that the factor scales power and current but not voltage.
+        """
+        r = rhizome.decode(self.FRAME, 2)
+        self.failUnlessEqual((r.awatthr, r.airms, r.avrms),
+                             (3470, 1010500, 578201))
+
+    def test_decode_many(self):
+        """
+        Tests that decoding many frames at once agrees with decode().
+        """
+        if rhizome.numpy is None:
+            return
+        bad = 'XXXX' + self.FRAME[4:]
+        d = rhizome.decode_many(self.FRAME + bad, 2)
+        self.failUnlessEqual(list(d['valid']), [True, False])
+        r = rhizome.decode(self.FRAME, 2)
+        for field in rhizome.READING_FIELDS:
+            self.failUnlessEqual(d[field][0], getattr(r, field))
+
+    def test_framer(self):
+        """
+        Tests that the framer keeps leftover bytes between feeds and
+        skips junk and truncated frames.
+        """
+        framer = rhizome.RhizomeFramer()
+        stream = (self.FRAME + 'junk' + self.FRAME[:20] + self.FRAME
+                  + self.FRAME)
+        frames = []
+        for i in range(0, len(stream), 7):
+            framer.feed(stream[i:i + 7])
+            while True:
+                frame = framer.next_frame()
+                if frame is None:
+                    break
+                frames.append(frame)
+        self.failUnlessEqual(frames, [self.FRAME] * 3)
+        self.failUnlessEqual(framer.resyncs, 1)
+        self.failUnlessEqual(framer.bytes_skipped, 24)
+
+
+import datetime
+from energyweb.graph import archive
+
+class ArchiveColumnTest(TestCase):
+    def test_round_trip(self):
+        """
+        Tests that each kind of column decodes to what was encoded,
+        when added in several chunks.
+        """
+        t = datetime.datetime(2011, 3, 1, 12, 0, 0, 250000)
+        columns = {
+            'time': [t + datetime.timedelta(0, 10 * i) for i in range(25)],
+            'int': [1000 + (i * 37) % 11 - 5 for i in range(25)],
+            'float': [i / 3.0 for i in range(25)],
+        }
+        for kind, values in columns.iteritems():
+            encoder = archive.ColumnEncoder(kind)
+            encoder.add(values[:10])
+            encoder.add(values[10:])
+            data = encoder.finish()
+            self.failUnlessEqual(
+                archive.decode_column(kind, data, len(values)), values)
+
+
+from energyweb.graph.models import Setting
+
+class SettingCacheTest(TestCase):
+    def test_typed_values(self):
+        self.failUnlessEqual(Setting(value_type='int', value='3').get_value(),
+                             3)
+        self.failUnlessEqual(
+            Setting(value_type='float', value='2.5').get_value(), 2.5)
+        self.assertRaises(ValueError,
+                          Setting(value_type='bool', value='yes').get_value)
+
+    def test_cache(self):
+        Setting.objects.create(name='test_setting', value_type='int',
+                               value='1')
+        self.failUnlessEqual(Setting.get_value_of('test_setting'), 1)
+        Setting.set_value_of('test_setting', 2)
+        self.failUnlessEqual(Setting.get_value_of('test_setting'), 2)
+        self.failUnlessEqual(Setting.get_value_of('no_such_setting', 5), 5)
+
+
+from energyweb.graph.models import Sensor, LogMessage
+from energyweb.graph.logsink import LogSink
+
+class LogSinkTest(TestCase):
+    def test_coalesce(self):
+        """
+        Tests that repeats of a message are written as one row.
+        """
+        sensor = Sensor.objects.all()[0]
+        before = LogMessage.objects.count()
+        sink = LogSink()
+        for i in range(3):
+            sink.log(sensor, 'M', 'E', 'No conection', 'Socket Error')
+        sink.flush()
+        sink.log(sensor, 'M', 'E', 'No conection', 'Socket Error')
+        sink.flush()
+        self.failUnlessEqual(LogMessage.objects.count(), before + 1)
+        self.failUnlessEqual(LogMessage.objects.latest('pk').count, 4)
+
+
+from energyweb.graph import pivot
+
+class ColumnDumpTest(TestCase):
+    def test_columns(self):
+        """
+        Tests that the columns format has the points of the pairs.
+        """
+        # (data.py reads the sensor groups when imported.)
+        from energyweb.graph import data
+        t = datetime.datetime(2011, 3, 1, 12, 0, 0)
+        rows = [(1.5, 1, t), (2.0, 2, t),
+                (None, 1, t + datetime.timedelta(0, 20)),
+                (0.0, 2, t + datetime.timedelta(0, 20))]
+        p = pivot.build_pivot(rows, datetime.timedelta(0, 10),
+                              [(1, [1]), (2, [2])])
+        self.failUnlessEqual(data._pivot_columns(p),
+                             {'point_start': 1298980800000,
+                              'point_interval': 10000,
+                              'sg_values': {1: [1.5, None, None],
+                                            2: [2.0, None, 0.0]}})
+
+
+from energyweb.graph import downsample
+
+class DownsampleTest(TestCase):
+    def test_downsample(self):
+        """
+        Tests that downsampling keeps the ends, the peak, and gaps.
+        """
+        x = range(0, 1000, 10)
+        y = [1.0] * 100
+        y[42] = 9.0
+        y[70] = float('nan')
+        pairs = downsample.downsample(x, y, 10)
+        self.failUnlessEqual(pairs[0], [0, 1.0])
+        self.failUnlessEqual(pairs[-1], [990, 1.0])
+        self.failUnless([420, 9.0] in pairs)
+        self.failUnless([700, None] in pairs)
+
+
+from energyweb.graph import energy
+
+class EnergyCoverTest(TestCase):
+    def test_cover(self):
+        """
+        Tests that a range is split into the coarsest whole periods.
+        """
+        d = datetime.datetime
+        self.failUnlessEqual(
+            energy.cover(d(2011, 3, 1, 0, 5), d(2011, 3, 3, 12)),
+            [('minute', d(2011, 3, 1, 0, 5), d(2011, 3, 1, 0, 10)),
+             ('minute*10', d(2011, 3, 1, 0, 10), d(2011, 3, 1, 1)),
+             ('hour', d(2011, 3, 1, 1), d(2011, 3, 2)),
+             ('day', d(2011, 3, 2), d(2011, 3, 3)),
+             ('hour', d(2011, 3, 3), d(2011, 3, 3, 12))])
+
+
+from energyweb.graph.models import PowerAverage, EnergyPrefix
+
+class EnergyPrefixTest(TestCase):
+    def test_sums(self):
+        """
+        Tests that a range's energy is the same from running totals.
+        """
+        from django.db import connection
+        sensor = Sensor.objects.all()[0]
+        d = datetime.datetime
+        for hour in range(5):
+            t = d(2011, 3, 1, hour)
+            PowerAverage.objects.create(
+                sensor=sensor, average_type='hour', trunc_reading_time=t,
+                first_reading_time=t, last_reading_time=t,
+                num_points=360, watts=1000.0 * hour, watt_hours=1000.0 * hour)
+        EnergyPrefix.rebuild(connection.cursor(), sensor, d(2011, 3, 1, 5))
+        self.failUnlessEqual(
+            energy.sums_by_sensor([sensor.pk], d(2011, 3, 1, 1),
+                                  d(2011, 3, 1, 4)),
+            {sensor.pk: (6000.0, 1080)})
+
+    def test_rebuild_after_purge(self):
+        """
+        Tests that rebuilding keeps the totals of purged hours.
+        """
+        from django.db import connection
+        sensor = Sensor.objects.all()[0]
+        d = datetime.datetime
+        for hour in range(5):
+            t = d(2011, 3, 1, hour)
+            PowerAverage.objects.create(
+                sensor=sensor, average_type='hour', trunc_reading_time=t,
+                first_reading_time=t, last_reading_time=t,
+                num_points=360, watts=1000.0, watt_hours=1000.0)
+        cur = connection.cursor()
+        EnergyPrefix.rebuild(cur, sensor, d(2011, 3, 1, 5))
+        PowerAverage.objects.filter(
+            sensor=sensor, trunc_reading_time__lt=d(2011, 3, 1, 2)).delete()
+        EnergyPrefix.rebuild(cur, sensor, d(2011, 3, 1, 5))
+        self.failUnlessEqual(
+            energy.sums_by_sensor([sensor.pk], d(2011, 3, 1, 0),
+                                  d(2011, 3, 1, 5)),
+            {sensor.pk: (5000.0, 1800)})
@@ -18,6 +18,7 @@ urlpatterns = patterns('energyweb.graph.views',
     (r'^detail/(?P<building>[a-z]+)/(?P<resolution>[a-z]+)/(?P<start_time>\d+)/table_data.json$','detail_table_data'),
     (r'^energytable/$', 'energy_table_mode',{'scope':'residential'}), # Energy Statistics Table
     (r'^energytable/data.json$', 'statistics_table_data'),
+    (r'^live/$', 'live_updates'), # Server-Sent Events for the pages above
     (r'^static/$', 'static_graph'), # Custom Graph -- For user defined time ranges
     (r'^static/(?P<start>\d+)/to/(?P<end>\d+)/(?P<res>[a-z]+(\*10)?)/data.json$', 'static_graph_data'),
     (r'^static/(?P<start>\d+)/to/(?P<end>\d+)/(?P<res>[a-z]+(\*10)?)/data.csv$', 'download_csv'),
@@ -29,6 +30,7 @@ urlpatterns = patterns('energyweb.graph.views',
     (r'^dataaccess/$', 'data_access'),
     (r'^dataaccess/(?P<start>\d+)/to/(?P<end>\d+)/(?P<res>[a-z]+(\*10)?)/data.json$', 'data_access_data'),
     (r'^dataaccess/(?P<start>\d+)/to/(?P<end>\d+)/(?P<res>[a-z]+(\*10)?)/data.csv$', 'download_csv'),
+    (r'^dataaccess/(?P<start>\d+)/to/(?P<end>\d+)/readings.csv$', 'raw_export'),
     (r'^logout/$', 'logout'),
     (r'^changepass/$', 'change_password'),
 )
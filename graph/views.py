@@ -16,7 +16,7 @@ from functools import wraps
 
 from django.shortcuts import render_to_response
 from django.core import serializers
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest
 from django.http import HttpResponseRedirect
 from django.template import RequestContext
 from django.core.urlresolvers import reverse
@@ -33,6 +33,9 @@ import calendar, datetime, simplejson, time
 from constants import *
 
 import energyweb.graph.data as data
+import energyweb.graph.responsecache as responsecache
+import energyweb.graph.live as live
+import energyweb.graph.rawexport as rawexport
 
 DYNAMIC_START_TIME = datetime.timedelta(0,3600*2,0)
 
@@ -51,6 +54,7 @@ def energy_table(request):
         {'sensor_groups': data.SENSOR_GROUPS,
          'data_url': reverse('energyweb.graph.views.statistics_table_data'
                              ) + '?junk=' + junk,
+         'live_url': reverse('energyweb.graph.views.live_updates'),
          'scope': 'residential'},
         context_instance=RequestContext(request))
 
@@ -76,6 +80,8 @@ def energy_table_mode(request,scope):
                          'data_url': reverse(
                              'energyweb.graph.views.statistics_table_data'
                              ) + '?junk=' + junk,
+                         'live_url': reverse(
+                             'energyweb.graph.views.live_updates'),
                          'scope': scope,
                          'dynamic_graph_url': reverse(
                              'energyweb.graph.views.dynamic_graph_mode',
@@ -91,7 +97,14 @@ def energy_table_mode(request,scope):
 def statistics_table_data(request):
     '''
     A view returning the JSON data used to populate the averages table.
+    (Cached; see responsecache.py.)
     '''
+    return HttpResponse(
+        responsecache.cached('statistics_table_data', 'minute', None, 'all',
+                             _statistics_table_json),
+        mimetype='application/json')
+
+def _statistics_table_json():
     all_averages = data._get_averages()
 
     data_url = reverse('energyweb.graph.views.statistics_table_data') \
@@ -108,9 +121,7 @@ def statistics_table_data(request):
         }
              
     # Use json to transfer the data from Python to Javascript
-    json_serializer = serializers.get_serializer("json")()
-    return HttpResponse(simplejson.dumps(d),
-                        mimetype='application/json')
+    return simplejson.dumps(d)
 
 def dynamic_graph(request):
     '''
@@ -129,6 +140,7 @@ def dynamic_graph(request):
          'data_url': reverse('energyweb.graph.views.dynamic_graph_data', 
                              kwargs={'input_data': start_date}) +\
              '?junk=' + junk,
+         'live_url': reverse('energyweb.graph.views.live_updates'),
          'scope':'residential'},
         context_instance=RequestContext(request))
 
@@ -149,6 +161,7 @@ def dynamic_graph_mode(request,scope):
                  'data_url': reverse('energyweb.graph.views.dynamic_graph_data',
                                      kwargs={'input_data': start_date}
                                      ) + '?junk=' + junk,
+                 'live_url': reverse('energyweb.graph.views.live_updates'),
                  'scope':scope,
                  'dynamic_graph_url': reverse(
                     'energyweb.graph.views.dynamic_graph_mode', 
@@ -164,13 +177,20 @@ def dynamic_graph_mode(request,scope):
 def dynamic_graph_data(request, input_data):
     '''
     A view returning the JSON data used to populate the dynamic graph.
+    (Cached; see responsecache.py.)
     '''
     # Set the maximum possible start time to two hours ago
     # to prevent excessive drawing of data
     max_time = datetime.datetime.now() -DYNAMIC_START_TIME
     start = max( datetime.datetime.utcfromtimestamp(int(int(input_data)/1000)) ,
                  max_time )
-    
+
+    return HttpResponse(
+        responsecache.cached('dynamic_graph_data', 'second*10', start, 'all',
+                             lambda: _dynamic_graph_json(start)),
+        mimetype='application/json')
+
+def _dynamic_graph_json(start):
     # Grab the xy pairs
     data_dump = data._make_data_dump( calendar.timegm(start.timetuple()) ,
                         None,
@@ -185,9 +205,22 @@ def dynamic_graph_data(request, input_data):
                                    '?junk=' + junk
         data_dump['data_url'] = data_url
     
-    json_serializer = serializers.get_serializer("json")()
-    return HttpResponse(simplejson.dumps(data_dump),
-                        mimetype='application/json')
+    return simplejson.dumps(data_dump)
+
+def live_updates(request):
+    '''
+    A view streaming new dynamic graph points and table averages as
+    Server-Sent Events (see live.py), for the dynamic graph, table,
+    and status pages.
+    '''
+    try:
+        last_id = int(request.META.get('HTTP_LAST_EVENT_ID', ''))
+    except ValueError:
+        last_id = None
+    response = HttpResponse(live.stream(last_id),
+                            mimetype='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    return response
 
 def static_graph(request):
     '''
@@ -285,7 +318,10 @@ def static_graph_data(request, start, end, res):
     # Increase the viewCount for today
     data.increase_count(CUSTOM_GRAPH)
 
-    data_dump = data._make_data_dump(start, end, res)
+    if request.GET.get('format') == 'columns':
+        data_dump = data._make_column_dump(start, end, res)
+    else:
+        data_dump = data._make_data_dump(start, end, res)
     
     json_serializer = serializers.get_serializer("json")()
     return HttpResponse(simplejson.dumps(data_dump),
@@ -432,7 +468,9 @@ def signal_processing(request):
                         {'sensor_groups': data._get_sensor_groups()[0],
                          'data_url': reverse(
                              'energyweb.graph.views.signal_processing_data')
-                         + '?junk=' + junk},
+                         + '?junk=' + junk,
+                         'live_url': reverse(
+                             'energyweb.graph.views.live_updates')},
                     context_instance=RequestContext(request))
 
 @login_required
@@ -468,7 +506,7 @@ def data_access(request):
         '''
         now = datetime.datetime.now()
         one_day_ago = now - datetime.timedelta(1)
-        form = data.CustomGraphForm(initial={
+        form = data.DataAccessForm(initial={
             'start': one_day_ago,
             'end': now
         })
@@ -481,7 +519,7 @@ def data_access(request):
         return _show_only_form()
 
     _get = _clean_input(request.GET.copy())
-    form = data.CustomGraphForm(_get)
+    form = data.DataAccessForm(_get)
 
     if not form.is_valid():
         return _show_only_form()
@@ -502,9 +540,14 @@ def data_access(request):
     # generate the URLs for data dumps
     download_url = reverse('energyweb.graph.views.download_csv',
                            kwargs=keyword_args) + '?junk=' + junk
+    raw_url = reverse('energyweb.graph.views.raw_export',
+                      kwargs={'start': str(int_start),
+                              'end': str(int_end)}) \
+              + '?sensors=' + ','.join(form.cleaned_data['sensors'])
 
     final_args = {
                   'download_url': download_url,
+                  'raw_url': raw_url,
                   'form': form,
                   'form_action': reverse('energyweb.graph.views.data_access'),
                   'res': res}
@@ -513,13 +556,51 @@ def data_access(request):
                               final_args,
                               context_instance=RequestContext(request))
 
+@login_required
+def raw_export(request, start, end):
+    '''
+    A view streaming the raw sensor readings from start to end (in
+    seconds since the epoch) as CSV, for the sensors listed in the
+    sensors parameter (comma-separated ids; default all).  A 400 if
+    the parameter is not integers, or names no known sensor.
+    See rawexport.py.
+    '''
+    try:
+        sensor_ids = [int(s) for s in
+                      request.GET.get('sensors', '').split(',') if s]
+    except ValueError:
+        return HttpResponseBadRequest('Invalid sensors: \'%s\'.'
+                                      % request.GET['sensors'])
+    if not sensor_ids:
+        sensor_ids = data.SENSOR_IDS
+    sensor_ids = [s for s in sensor_ids if s in data.SENSOR_IDS]
+    if not sensor_ids:
+        return HttpResponseBadRequest('No such sensors.')
+    data.increase_count(DATA_DOWNLOAD)
+    start_dt = datetime.datetime.utcfromtimestamp(int(start))
+    end_dt = datetime.datetime.utcfromtimestamp(int(end))
+
+    chunks = rawexport.stream(sensor_ids, start_dt, end_dt)
+    gzipped = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+    if gzipped:
+        chunks = data._gzip_chunks(chunks)
+    response = HttpResponse(chunks, mimetype='text/csv')
+    response['Content-Disposition'] = \
+        'attachment; filename=readings-%s-%s.csv' % (start, end)
+    if gzipped:
+        response['Content-Encoding'] = 'gzip'
+    return response
+
 @login_required
 def data_access_data(request, start, end, res):
     '''
     A view returning the JSON data used to populate the static graph.
     '''
 
-    data_dump = data._make_data_dump(start, end, res)
+    if request.GET.get('format') == 'columns':
+        data_dump = data._make_column_dump(start, end, res)
+    else:
+        data_dump = data._make_data_dump(start, end, res)
 
     json_serializer = serializers.get_serializer("json")()
     return HttpResponse(simplejson.dumps(data_dump),
@@ -0,0 +1,189 @@
+'''
+    Write-behind buffer for the energy monitors.
+
+    Rather than inserting each sensor reading and saving every power
+    average as soon as a message arrives, the monitors hand them to a
+    ReadingWriter.  The writer holds them in memory and periodically
+    flushes everything in one transaction: all buffered readings go in
+    a single multi-row INSERT, and each modified power average is
+    saved once no matter how many readings touched it.  The sensor
+    group averages covering the saved power averages are recomputed in
+    the same transaction, and the cached graph responses (see
+    responsecache.py) are invalidated after it.  The web servers are
+    notified in the same transaction, so that they push the new data
+    to browsers (see live.py).
+'''
+
+import time, logging
+from django.conf import settings
+from django.db import connection, transaction, DatabaseError
+from energyweb.graph.models import SRProfile, SensorGroupAverage
+from energyweb.graph.rhizome import READING_FIELDS
+from energyweb.graph import live, responsecache
+
+
+# Columns of graph_sensorreading written by the monitors, in the order
+# used by the INSERT statement.
+READING_COLUMNS = ('sensor_id', 'reading_time') + READING_FIELDS
+
+DURABILITY_CHOICES = ('sync', 'async')
+
+
+class ReadingWriter(object):
+    '''
+    Buffers sensor readings, their profiles, modified power averages
+    and new running energy totals, and writes them out when flush() is
+    called.  Callers
+    should call flush() whenever due() is true (and once more before
+    exiting).
+
+    flush_interval: seconds between flushes.
+    flush_size: flush early once this many readings are buffered.
+    max_queue: the most readings held in memory; if the database is
+        unavailable for long enough to fill it, the oldest readings
+        are dropped.
+    durability: 'sync' waits for each flush to reach disk; 'async'
+        lets PostgreSQL acknowledge the commit first (a crash may lose
+        the last flush, but never corrupts anything).
+    '''
+
+    def __init__(self, flush_interval=None, flush_size=None, max_queue=None,
+                 durability=None):
+        if flush_interval is None:
+            flush_interval = settings.MON_WRITE_FLUSH_INTERVAL
+        if flush_size is None:
+            flush_size = settings.MON_WRITE_FLUSH_SIZE
+        if max_queue is None:
+            max_queue = settings.MON_WRITE_MAX_QUEUE
+        if durability is None:
+            durability = settings.MON_WRITE_DURABILITY
+        if durability not in DURABILITY_CHOICES:
+            raise ValueError('Invalid durability \'%s\'.' % durability)
+
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.max_queue = max_queue
+        self.durability = durability
+
+        # Each entry is (tuple of READING_COLUMNS values, profile dict
+        # or None).
+        self.readings = []
+        # Power averages modified since the last flush, keyed by id()
+        # so each is saved only once.
+        self.averages = {}
+        # New running energy totals (see energy.py).
+        self.prefixes = []
+        self.dropped = 0
+        self.next_flush = time.time() + self.flush_interval
+
+    def add_reading(self, sensor_id, reading_time, reading, profile=None):
+        '''
+        Buffer a sensor reading, given as a RhizomeReading (see
+        rhizome.py) or any sequence of values in READING_FIELDS order.
+        profile, if given, holds the other SRProfile fields; the
+        profile is inserted with the reading.
+        '''
+        if len(self.readings) >= self.max_queue:
+            self.readings.pop(0)
+            self.dropped += 1
+            logging.error('Write buffer full; dropped a reading (%d so far).'
+                          % self.dropped)
+        self.readings.append(((sensor_id, reading_time) + tuple(reading),
+                              profile))
+
+    def add_average(self, power_average):
+        '''
+        Mark a PowerAverage as modified; it will be saved at the next
+        flush.
+        '''
+        self.averages[id(power_average)] = power_average
+
+    def add_prefix(self, prefix):
+        '''
+        Buffer a new EnergyPrefix; it will be saved at the next flush.
+        '''
+        self.prefixes.append(prefix)
+
+    def pending(self):
+        return len(self.readings) + len(self.averages) + len(self.prefixes)
+
+    def due(self):
+        return (len(self.readings) >= self.flush_size
+                or time.time() >= self.next_flush)
+
+    def flush(self):
+        '''
+        Write everything buffered in one transaction and commit.
+        Return the number of readings written.  If the database
+        rejects the write, roll back and keep the buffer for the next
+        attempt.
+        '''
+        self.next_flush = time.time() + self.flush_interval
+        if not self.readings and not self.averages and not self.prefixes:
+            return 0
+
+        readings = self.readings
+        try:
+            cur = connection.cursor()
+            if self.durability == 'async':
+                cur.execute('SET LOCAL synchronous_commit TO OFF;')
+
+            ids = self._insert_readings(cur, [r[0] for r in readings])
+            for (values, profile), reading_id in zip(readings, ids):
+                if profile is not None:
+                    SRProfile.objects.create(sensor_reading_id=reading_id,
+                                             **profile)
+
+            group_keys = {}
+            for power_average in self.averages.itervalues():
+                power_average.save()
+                group_keys[(power_average.average_type,
+                            power_average.sensor.sensor_group_id,
+                            power_average.trunc_reading_time)] = True
+            SensorGroupAverage.refresh(cur, group_keys.keys())
+            for prefix in self.prefixes:
+                prefix.save()
+            invalidating = False
+            for power_average in self.averages.itervalues():
+                if power_average.average_type in \
+                        responsecache.INVALIDATING_TYPES:
+                    invalidating = True
+                    break
+            if invalidating:
+                live.notify(cur)
+        except DatabaseError, detail:
+            transaction.rollback()
+            logging.error('Flush of %d readings failed: %s'
+                          % (len(readings), detail))
+            return 0
+
+        if transaction.is_managed():
+            transaction.commit()
+        else:
+            transaction.commit_unless_managed()
+        logging.debug('Flushed %d readings and %d averages.'
+                      % (len(readings), len(self.averages)))
+        if invalidating:
+            # The graph and table responses are now out of date.
+            responsecache.invalidate()
+        self.readings = []
+        self.averages = {}
+        self.prefixes = []
+        return len(readings)
+
+    def _insert_readings(self, cur, rows):
+        '''
+        Insert the given rows of READING_COLUMNS values with a single
+        statement, returning their new ids (in the same order).
+        '''
+        if not rows:
+            return []
+        row_sql = '(' + ', '.join(['%s'] * len(READING_COLUMNS)) + ')'
+        params = []
+        for row in rows:
+            params.extend(row)
+        cur.execute('INSERT INTO graph_sensorreading ('
+                    + ', '.join(READING_COLUMNS) + ') VALUES '
+                    + ', '.join([row_sql] * len(rows))
+                    + ' RETURNING id;', params)
+        return [r[0] for r in cur.fetchall()]
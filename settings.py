@@ -133,6 +133,100 @@ TEMPLATE_CONTEXT_PROCESSORS = (
 MON_PID_FILE_TEMPL = '/var/local/energyweb/run/energymon.%d.pid'
 MON_LOG_FILE_TEMPL = '/var/local/energyweb/log/energymon.%d.log'
 
+# Used by energymon_all, which monitors every sensor from one process.
+MON_ALL_PID_FILE = '/var/local/energyweb/run/energymon_all.pid'
+MON_ALL_LOG_FILE = '/var/local/energyweb/log/energymon_all.log'
+
+# Write-behind buffering of sensor readings (see graph/writer.py).
+# Readings are flushed every MON_WRITE_FLUSH_INTERVAL seconds, or
+# sooner once MON_WRITE_FLUSH_SIZE are buffered.  At most
+# MON_WRITE_MAX_QUEUE are held if the database is unavailable.
+# MON_WRITE_DURABILITY is 'sync' (wait for each flush to reach disk) or
+# 'async' (faster; a crash may lose the last flush).
+MON_WRITE_FLUSH_INTERVAL = 10
+MON_WRITE_FLUSH_SIZE = 200
+MON_WRITE_MAX_QUEUE = 10000
+MON_WRITE_DURABILITY = 'sync'
+
+# Seconds between writes of the in-progress (not yet closed) power
+# averages (see graph/rollup.py).  Closed averages are always written
+# at the next flush.
+MON_ROLLUP_CHECKPOINT_INTERVAL = 300
+
+# Months of partitions (see graph/partitions.py) to create ahead of
+# the current one.
+PARTITION_MONTHS_AHEAD = 3
+
+# Days of data to keep, for raw readings ('reading') and each average
+# type; None (or leaving a type out) keeps it forever.  Enforced by
+# ./manage.py enforce_retention, RETENTION_BATCH_SIZE rows at a time.
+RETENTION_POLICY = {
+    'reading': 90,
+    'second*10': 365,
+}
+RETENTION_BATCH_SIZE = 10000
+
+# Where archive_readings writes the columnar archive files (see
+# graph/archive.py), and how many readings it fetches at a time.
+ARCHIVE_DIR = '/var/local/energyweb/archive'
+ARCHIVE_CHUNK_SIZE = 10000
+
+# Where create_power_averages records the tasks it has finished, so
+# that an interrupted backfill can resume.
+BACKFILL_CHECKPOINT = '/var/local/energyweb/backfill.json'
+
+# The monitors invalidate cached graph responses (see
+# graph/responsecache.py) when new data arrives, so the cache must be
+# shared between processes.  Responses are cached for at most
+# GRAPH_CACHE_TIMEOUT seconds (those that do not depend on a start
+# time, per GRAPH_CACHE_BUCKET seconds).
+CACHE_BACKEND = 'memcached://127.0.0.1:11211/'
+GRAPH_CACHE_BUCKET = 10
+GRAPH_CACHE_TIMEOUT = 60
+
+# Processes cache the Setting table (see graph/models.py), checking at
+# most every SETTING_CACHE_CHECK seconds whether it has changed.  (The
+# monitors are also told at once; see graph/control.py.)
+SETTING_CACHE_CHECK = 30
+
+# LogMessages from the monitors and fakers are written every
+# LOG_FLUSH_INTERVAL seconds (see graph/logsink.py).  At most
+# LOG_RATE_LIMIT are written per sensor and topic every LOG_RATE_PERIOD
+# seconds; repeats within it are counted instead.
+LOG_FLUSH_INTERVAL = 5
+LOG_RATE_LIMIT = 5
+LOG_RATE_PERIOD = 600
+
+# Seconds between a sensor's readings.  Each reading counts for this
+# long in the energy (watt-hour) totals (see graph/energy.py).
+READING_INTERVAL = 10
+
+# Static graphs are downsampled to about GRAPH_MAX_POINTS points per
+# building, from a resolution with no more than GRAPH_SOURCE_POINTS
+# periods (see graph/data.py).
+GRAPH_MAX_POINTS = 2000
+GRAPH_SOURCE_POINTS = 20000
+
+# Decimal places of the kilowatts sent to the static graph (in its
+# columns format; see graph/data.py).
+GRAPH_DECIMALS = 3
+
+# CSV downloads are generated (and sent) CSV_CHUNK_SIZE rows at a time.
+CSV_CHUNK_SIZE = 10000
+
+# Raw reading exports (see graph/rawexport.py) run at most this many
+# 64 KB chunks ahead of the client.
+RAW_EXPORT_QUEUE_SIZE = 16
+
+# Live updates (see graph/live.py):  each open event stream gets a
+# keepalive comment every LIVE_HEARTBEAT seconds, and is closed after
+# LIVE_MAX_SECONDS, so that server threads turn over; the browser
+# reopens it LIVE_RETRY seconds later, from the last event it saw.
+# Each open stream holds a server thread (see INSTALL.txt).
+LIVE_HEARTBEAT = 15
+LIVE_MAX_SECONDS = 120
+LIVE_RETRY = 1
+
 FAKER_PID_FILE_TEMPL = '/var/local/energyweb/run/energyfaker.%d.pid'
 FAKER_LOG_FILE_TEMPL = '/var/local/energyweb/log/energyfaker.%d.log'
 
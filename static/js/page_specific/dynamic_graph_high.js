@@ -74,21 +74,44 @@ $(function () {
 		    // Update the graph!
 		    load: function() {
 			var chart_series = this.series; // get the series in scope
-			// Refresh data every 10 seconds
-			setInterval(function() {
-
-			    $.getJSON(data_url, function(data) {
-				// Add a datapoint for each sensor
-				
-				$.each(sensor_groups, function(index, cur_sg) {
-				    group_id = cur_sg[0];
-				    if (chart_series[index]) {
-					chart_series[index].addPoint(
-					    data.sg_xy_pairs[group_id].pop(), true, true);
+
+			function add_points(data) {
+			    // Add the points newer than each series' last one
+			    $.each(sensor_groups, function(index, cur_sg) {
+				group_id = cur_sg[0];
+				var series = chart_series[index];
+				if (!series || !(group_id in data.sg_xy_pairs)) {
+				    return;
+				}
+				var last = series.data.length ?
+				    series.data[series.data.length - 1].x : null;
+				$.each(data.sg_xy_pairs[group_id], function(i, point) {
+				    if (last === null || point[0] > last) {
+					series.addPoint(point, false, true);
 				    }
 				});
 			    });
-			}, 10000); // time between redraws in milliseconds
+			    chart.redraw();
+			}
+
+			function poll() {
+			    // Refresh data every 10 seconds
+			    setInterval(function() {
+				$.getJSON(data_url, function(data) {
+				    // Add a datapoint for each sensor
+				    $.each(sensor_groups, function(index, cur_sg) {
+					group_id = cur_sg[0];
+					if (chart_series[index]) {
+					    chart_series[index].addPoint(
+						data.sg_xy_pairs[group_id].pop(), true, true);
+					}
+				    });
+				});
+			    }, 10000); // time between redraws in milliseconds
+			}
+
+			// Have new points pushed to us if we can, else poll.
+			live_subscribe({points: add_points}, poll);
 		    }
 		}
 	    },
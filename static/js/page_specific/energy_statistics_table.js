@@ -40,6 +40,25 @@ $(function ()
         // used in the graph, not really here.
 	desired_first_record = data.desired_first_record;
 
+        // get the sensor groups
+        if (first_time) {
+            sensor_groups = data.sensor_groups;
+	    first_time = false;
+	    update_table(data);
+	    // Have new averages pushed to us if we can, else poll.
+	    live_subscribe({averages: update_table}, function() {
+		setTimeout(refreshdata, 10000);
+	    });
+	    return;
+        }
+
+	update_table(data);
+	setTimeout(refreshdata, 10000);
+    }
+
+    // Updates the table from a set of min/week/month averages
+    function update_table(data)
+    {
 	var missed_min_average,
             missed_week_average,
 	    missed_month_average,
@@ -49,12 +68,6 @@ $(function ()
 	    group_week_average,
 	    group_month_average;
 
-        // get the sensor groups
-        if (first_time) {
-            sensor_groups = data.sensor_groups;
-	    first_time = false;
-        }
-
         $.each(sensor_groups, function(index, snr_gp){
             group_current = 0;
 	    group_week_average = 0;
@@ -100,7 +113,6 @@ $(function ()
         });
 	
         $("#energystats").tablesorter({widgets: ['zebra']}); 
-	setTimeout(refreshdata, 10000);
     }
 
     // Get data from server and pass it to the table builder function.
@@ -0,0 +1,37 @@
+// Subscribes to the live updates stream (see graph/live.py).
+//
+// handlers maps event names ('points', 'averages', 'tick') to
+// functions, each called with the event's parsed JSON data.  If the
+// browser has no EventSource, live_url is not set, or the stream keeps
+// failing, fallback() is called (once) instead, so that the page can
+// poll as it used to.
+function live_subscribe(handlers, fallback) {
+    if (!window.EventSource || typeof live_url == 'undefined' || !live_url) {
+        fallback();
+        return;
+    }
+
+    // MAGIC: give up after this many failed attempts in a row.
+    var max_errors = 3;
+    var errors = 0;
+    var source = new EventSource(live_url);
+
+    $.each(handlers, function(name, handler) {
+        source.addEventListener(name, function(e) {
+            handler($.parseJSON(e.data));
+        }, false);
+    });
+
+    source.onopen = function() {
+        errors = 0;
+    };
+    source.onerror = function() {
+        // (The browser reconnects by itself after an error, and when
+        // the server ends the stream.)
+        errors += 1;
+        if (errors >= max_errors) {
+            source.close();
+            fallback();
+        }
+    };
+}
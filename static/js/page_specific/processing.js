@@ -2,6 +2,7 @@ $(function () {
     // This function is a callback, called when the DOM is loaded
 
     var first_time = true;
+    var polling = false;
     var sensor_groups = null;
 
     // Updates a data cell of ID name to have val
@@ -27,6 +28,7 @@ $(function () {
         data_url = data.data_url;
         var sensor_id, group_id;
 
+        var subscribe = first_time;
         if (first_time) {
             sensor_groups = data.sensor_groups;
 	    first_time = false;
@@ -56,7 +58,16 @@ $(function () {
         });
 
 	$('#monstatus').tablesorter({widgets: ['zebra']}); 
-        setTimeout(refreshdata, 10000);
+        if (subscribe) {
+            // Refresh whenever new data is pushed to us if we can,
+            // else poll.
+            live_subscribe({tick: refreshdata}, function() {
+                polling = true;
+                setTimeout(refreshdata, 10000);
+            });
+        } else if (polling) {
+            setTimeout(refreshdata, 10000);
+        }
     }
     
     function refreshdata() {
@@ -3,7 +3,6 @@ var chart;
 $(function () {
     // This function is a callback, called when the DOM is loaded
 
-    var sg_xy_pairs = {};
     var sensor_groups = null;
 
     function getdata_json_cb(data) {
@@ -19,15 +18,25 @@ $(function () {
 
 	sensor_groups = data.sensor_groups;
 	
-	// Get the xy points, color, and label for each sensor group
+	// Get the points, color, and label for each sensor group.
+	// (The data is in columns:  one y value per point, evenly
+	// spaced from point_start; unless it was downsampled, when
+	// it is [x,y] points.)
 	for (var i=0; i < sensor_groups.length; i++) {
 	    group_id = sensor_groups[i][0];
-	    sg_xy_pairs[group_id] = data.sg_xy_pairs[group_id];
-	        
-	    data_series.push({
-		name: sensor_groups[i][1],
-		data: sg_xy_pairs[group_id]
-	    });
+	    if (data.downsampled) {
+		data_series.push({
+		    name: sensor_groups[i][1],
+		    data: data.sg_xy_pairs[group_id]
+		});
+	    } else {
+		data_series.push({
+		    name: sensor_groups[i][1],
+		    data: data.sg_values[group_id],
+		    pointStart: data.point_start,
+		    pointInterval: data.point_interval
+		});
+	    }
 	    data_colors.push('#' + sensor_groups[i][2]);
 	}
 
@@ -141,5 +150,5 @@ $(function () {
 
     // It is expected that data_url was defined previously (before
     // loading this file).
-    $.getJSON(data_url, getdata_json_cb);
+    $.getJSON(data_url + '&format=columns', getdata_json_cb);
 });
\ No newline at end of file